@@ -31,10 +31,41 @@
 #
 # pylint: disable=W0613
 #
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
 import unittest
+from contextlib import redirect_stderr, redirect_stdout
 from unittest.mock import patch
 
 import ztpserver.app
+import ztpserver.repository
+from ztpserver.config import runtime
+from ztpserver.constants import CONTENT_TYPE_YAML
+from ztpserver.serializers import dump, load
+from ztpserver.topology import NeighbordbCache, compile_neighbordb, neighbordb_path
+
+NEIGHBORDB = {
+    "patterns": [
+        {"name": "exact", "definition": "test", "interfaces": [{"Ethernet1": "spine1:Ethernet1"}]},
+        {"name": "spine2", "definition": "test", "interfaces": [{"any": "spine2:any"}]},
+        {"name": "spine1", "definition": "test", "interfaces": [{"Ethernet1": "spine1:any"}]},
+    ]
+}
+
+PLUGINS_DIR = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "plugins")
+
+
+def node_entry(serialnumber, device, port):
+    return json.dumps(
+        {
+            "serialnumber": serialnumber,
+            "neighbors": {"Ethernet1": [{"device": device, "port": port}]},
+        }
+    )
 
 
 class TestApp(unittest.TestCase):
@@ -46,6 +77,197 @@ class TestApp(unittest.TestCase):
         obj = ztpserver.app.start_wsgiapp()
         self.assertIsInstance(obj, ztpserver.controller.Router)
 
+    def test_reload_neighbordb(self):
+        plugin_cache = ztpserver.app.plugin_cache
+        plugin_cache.set(("plugin", "url", "node0", None), "url", 60)
+        self.addCleanup(plugin_cache.invalidate)
+
+        ztpserver.app.reload_neighbordb()
+        self.assertIs(plugin_cache.get(("plugin", "url", "node0", None)), plugin_cache.MISSING)
+
+
+class TestCompileNeighbordb(unittest.TestCase):
+    def setUp(self):
+        data_root = runtime.default.data_root
+        runtime.set_value("data_root", tempfile.mkdtemp(), "default")
+        self.addCleanup(shutil.rmtree, runtime.default.data_root)
+        self.addCleanup(runtime.set_value, "data_root", data_root, "default")
+
+    def compile(self):
+        with redirect_stdout(io.StringIO()):
+            return ztpserver.app.compile_neighbordb_snapshot(False)
+
+    def test_compile(self):
+        dump(NEIGHBORDB, neighbordb_path(), CONTENT_TYPE_YAML)
+        filename = self.compile()
+        self.assertTrue(filename.startswith(os.path.join(runtime.default.data_root, ".ztps")))
+
+        with patch("ztpserver.topology.compile_neighbordb") as m_compile:
+            neighbordb = NeighbordbCache().get("test")
+            self.assertFalse(m_compile.called)
+        self.assertEqual([x.name for x in neighbordb.get_patterns()], ["exact", "spine2", "spine1"])
+
+    def test_compile_missing(self):
+        self.assertRaises(SystemExit, self.compile)
+
+    def test_compile_invalid(self):
+        dump({"patterns": [{"name": "test"}]}, neighbordb_path(), CONTENT_TYPE_YAML)
+        self.assertRaises(SystemExit, self.compile)
+
+
+class TestMatchNodes(unittest.TestCase):
+    def setUp(self):
+        neighbordb = compile_neighbordb("test", NEIGHBORDB)
+        patcher = patch("ztpserver.app.load_neighbordb", return_value=neighbordb)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        fd, self.filename = tempfile.mkstemp()
+        self.addCleanup(os.remove, self.filename)
+        with os.fdopen(fd, "w") as nodes:
+            nodes.write(
+                "\n".join(
+                    [
+                        node_entry("conflict", "spine1", "Ethernet1"),
+                        node_entry("matched", "spine2", "Ethernet1"),
+                        "",
+                        node_entry("unmatched", "spine3", "Ethernet1"),
+                        "{bogus",
+                        json.dumps({"neighbors": {}}),
+                    ]
+                )
+            )
+
+    def match_nodes(self, processes):
+        output = io.StringIO()
+        with redirect_stdout(output), redirect_stderr(io.StringIO()):
+            failures = ztpserver.app.match_nodes(self.filename, processes)
+        return failures, [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_match_nodes(self):
+        failures, results = self.match_nodes(1)
+
+        self.assertEqual(failures, 3)
+        self.assertEqual(
+            results[:3],
+            [
+                {
+                    "line": 1,
+                    "node": "conflict",
+                    "status": "conflict",
+                    "pattern": "exact",
+                    "matches": ["exact", "spine1"],
+                },
+                {
+                    "line": 2,
+                    "node": "matched",
+                    "status": "matched",
+                    "pattern": "spine2",
+                    "matches": ["spine2"],
+                },
+                {
+                    "line": 4,
+                    "node": "unmatched",
+                    "status": "unmatched",
+                    "pattern": None,
+                    "matches": [],
+                },
+            ],
+        )
+        self.assertEqual(
+            [(x["line"], x["status"]) for x in results[3:]], [(5, "error"), (6, "error")]
+        )
+
+    def test_match_nodes_process_pool(self):
+        self.assertEqual(self.match_nodes(2), self.match_nodes(1))
+
+    def test_match_nodes_spawn_default(self):
+        # the workers are forked, even where spawn is the default
+        method = multiprocessing.get_start_method(allow_none=True)
+        multiprocessing.set_start_method("spawn", force=True)
+        self.addCleanup(multiprocessing.set_start_method, method, force=True)
+        self.assertEqual(self.match_nodes(2), self.match_nodes(1))
+
+
+class TestPreallocate(unittest.TestCase):
+    def setUp(self):
+        data_root = runtime.default.data_root
+        runtime.set_value("data_root", tempfile.mkdtemp(), "default")
+        self.addCleanup(shutil.rmtree, runtime.default.data_root)
+        self.addCleanup(runtime.set_value, "data_root", data_root, "default")
+
+        # Use the actual repository, even if another test replaced it
+        patcher = patch(
+            "ztpserver.controller.create_repository", ztpserver.repository.create_repository
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        data_root = runtime.default.data_root
+        shutil.copytree(PLUGINS_DIR, os.path.join(data_root, "plugins"))
+        os.mkdir(os.path.join(data_root, "resources"))
+        dump(
+            {"10.0.0.1": None, "10.0.0.2": None},
+            os.path.join(data_root, "resources", "pool"),
+            CONTENT_TYPE_YAML,
+        )
+        for node_id in ["node1", "node2"]:
+            os.makedirs(os.path.join(data_root, "nodes", node_id))
+            dump(
+                {
+                    "name": "test",
+                    "actions": [
+                        {
+                            "name": "configure ma1",
+                            "action": "add_config",
+                            "attributes": {"ip": "allocate('pool')"},
+                        }
+                    ],
+                },
+                os.path.join(data_root, "nodes", node_id, "definition"),
+                CONTENT_TYPE_YAML,
+            )
+
+        fd, self.filename = tempfile.mkstemp()
+        self.addCleanup(os.remove, self.filename)
+        with os.fdopen(fd, "w") as nodes:
+            nodes.write("node1\n# planned\n\nnode2\nmissing\n")
+
+    def preallocate(self):
+        output = io.StringIO()
+        with redirect_stdout(output), redirect_stderr(io.StringIO()):
+            errors = ztpserver.app.preallocate_nodes(self.filename, 2)
+        return errors, [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_plugin_cache_stats(self):
+        with self.assertLogs("ztpserver", "INFO") as logs:
+            self.preallocate()
+        self.assertTrue(any("PluginCache(" in x for x in logs.output), logs.output)
+
+    def test_preallocate(self):
+        errors, results = self.preallocate()
+
+        self.assertEqual(errors, 1)
+        self.assertEqual([x["node"] for x in results], ["node1", "node2", "missing"])
+        self.assertEqual([x["status"] for x in results], ["ok", "ok", "error"])
+        allocated = {x["node"]: x["resources"]["allocate('pool')"] for x in results[:2]}
+        self.assertEqual(sorted(allocated.values()), ["10.0.0.1", "10.0.0.2"])
+
+        for node_id, ip in allocated.items():
+            attributes = load(
+                os.path.join(runtime.default.data_root, "nodes", node_id, "attributes"),
+                CONTENT_TYPE_YAML,
+            )
+            self.assertEqual(attributes, {"pinned_resources": {"allocate('pool')": ip}})
+
+        # the allocations are written to the pool file before exiting
+        pool = load(os.path.join(runtime.default.data_root, "resources", "pool"), CONTENT_TYPE_YAML)
+        self.assertEqual({v: k for k, v in pool.items()}, allocated)
+
+        # already pinned
+        errors, results = self.preallocate()
+        self.assertEqual([x.get("resources") for x in results], [{}, {}, None])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,255 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# pylint: disable=R0904,C0103
+
+import asyncio
+import http.client
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from webob.static import FileApp
+
+from ztpserver.asgi import ASGIApplication, FileWrapper, HTTPConnection, HTTPServer
+
+CONTENTS = os.urandom(300 * 1024)
+
+
+def application(environ, start_response):
+    path = environ["PATH_INFO"]
+    if path == "/file":
+        return FileApp(environ["test.filename"])(environ, start_response)
+    if path == "/echo":
+        body = environ["wsgi.input"].read()
+        start_response("200 OK", [("Content-Length", str(len(body)))])
+        return [body]
+    if path == "/lazy":
+        return lazy_application(environ, start_response)
+
+    start_response("404 Not Found", [("Content-Length", "0")])
+    return []
+
+
+def lazy_application(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    yield b"lazy"
+    yield b"-response"
+
+
+class TestASGIApplication(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.write(fd, CONTENTS)
+        os.close(fd)
+
+        def app(environ, start_response):
+            environ["test.filename"] = self.filename
+            return application(environ, start_response)
+
+        self.app = ASGIApplication(app, threads=2)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.app.executor.shutdown()
+        os.remove(self.filename)
+
+    def request(self, path, method="GET", headers=None, body=b""):
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": b"",
+            "headers": headers or [],
+        }
+        received = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+
+        async def receive():
+            return received.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.app(scope, receive, send))
+
+        start = sent[0]
+        self.assertEqual(start["type"], "http.response.start")
+        self.assertFalse(sent[-1]["more_body"])
+        body = b"".join(message.get("body", b"") for message in sent[1:])
+        return start["status"], dict(start["headers"]), body, len(sent) - 1
+
+    def test_file(self):
+        status, headers, body, messages = self.request("/file")
+        self.assertEqual(status, 200)
+        self.assertEqual(int(headers[b"content-length"]), len(CONTENTS))
+        self.assertEqual(body, CONTENTS)
+        # streamed one block at a time
+        self.assertGreater(messages, 4)
+
+    def test_file_range(self):
+        status, _, body, _ = self.request("/file", headers=[(b"range", b"bytes=1000-70000")])
+        self.assertEqual(status, 206)
+        self.assertEqual(body, CONTENTS[1000:70001])
+
+    def test_head(self):
+        status, headers, body, _ = self.request("/file", method="HEAD")
+        self.assertEqual(status, 200)
+        self.assertEqual(int(headers[b"content-length"]), len(CONTENTS))
+        self.assertEqual(body, b"")
+
+    def test_body(self):
+        status, _, body, _ = self.request(
+            "/echo", method="POST", headers=[(b"content-type", b"text/plain")], body=b"data"
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b"data")
+
+    def test_lazy_start_response(self):
+        status, _, body, _ = self.request("/lazy")
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b"lazy-response")
+
+    def test_zerocopysend(self):
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/file",
+            "query_string": b"",
+            "headers": [(b"range", b"bytes=1000-70000")],
+            "extensions": {"http.response.zerocopysend": {}},
+        }
+        received = [{"type": "http.request", "body": b"", "more_body": False}]
+        sent = []
+
+        async def receive():
+            return received.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        with patch.object(self.app, "send_file") as m_send_file:
+            self.loop.run_until_complete(self.app(scope, receive, send))
+        self.assertFalse(m_send_file.called)
+
+        message = sent[1]
+        self.assertEqual(message["type"], "http.response.zerocopysend")
+        self.assertEqual((message["offset"], message["count"]), (1000, 69001))
+
+    def test_file_wrapper_range(self):
+        with open(self.filename, "rb") as fhandler:
+            wrapper = FileWrapper(fhandler, 4096).app_iter_range(10, 9000)
+            self.assertEqual(b"".join(wrapper), CONTENTS[10:9000])
+
+
+class TestHTTPServer(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.write(fd, CONTENTS)
+        os.close(fd)
+
+        def app(environ, start_response):
+            environ["test.filename"] = self.filename
+            return application(environ, start_response)
+
+        self.server = HTTPServer(ASGIApplication(app, threads=2), "127.0.0.1", 0)
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.server.start())
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+        self.server.app.executor.shutdown()
+        os.remove(self.filename)
+
+    def connect(self):
+        host, port = self.server.server_address
+        return http.client.HTTPConnection(host, port, timeout=10)
+
+    def test_keepalive(self):
+        conn = self.connect()
+        conn.request("GET", "/file")
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.read(), CONTENTS)
+        sock = conn.sock
+
+        conn.request("POST", "/echo", body=b"payload")
+        resp = conn.getresponse()
+        self.assertEqual(resp.read(), b"payload")
+        self.assertIs(conn.sock, sock)
+        conn.close()
+
+    def test_sendfile(self):
+        conn = self.connect()
+        with patch(
+            "ztpserver.asgi.HTTPConnection.sendfile",
+            autospec=True,
+            side_effect=HTTPConnection.sendfile,
+        ) as m_sendfile:
+            conn.request("GET", "/file")
+            resp = conn.getresponse()
+            self.assertEqual(resp.read(), CONTENTS)
+
+            conn.request("GET", "/file", headers={"Range": "bytes=1000-70000"})
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 206)
+            self.assertEqual(resp.read(), CONTENTS[1000:70001])
+        conn.close()
+        self.assertEqual(m_sendfile.call_count, 2)
+
+    def test_undelimited_response(self):
+        conn = self.connect()
+        conn.request("GET", "/lazy")
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader("Connection"), "close")
+        self.assertEqual(resp.read(), b"lazy-response")
+        conn.close()
+
+    def test_not_found(self):
+        conn = self.connect()
+        conn.request("GET", "/missing")
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 404)
+        resp.read()
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -32,10 +32,14 @@
 # pylint: disable=C0102,C0103,E1103,W0613,C0302,E1120
 #
 
+import gzip
 import json
+import os
 import random
+import time
 import unittest
 from test.server.server_test_lib import (
+    add_folder,
     create_attributes,
     create_bootstrap_conf,
     create_definition,
@@ -55,9 +59,11 @@ from webob import Request
 import ztpserver.config
 import ztpserver.controller
 import ztpserver.repository
+import ztpserver.topology
 from ztpserver import constants
 from ztpserver.controller import DEFINITION_FN, PATTERN_FN
 from ztpserver.repository import FileObjectError, FileObjectNotFound
+from ztpserver.serializers import load
 
 
 class RouterUnitTests(unittest.TestCase):
@@ -143,7 +149,9 @@ class MetaControllerUnitTests(unittest.TestCase):
         path = "/".join([random_string()] * random.randint(1, 4))
 
         controller = ztpserver.controller.MetaController()
-        resp = controller.metadata(None, type=random.choice(["files", "actions"]), path_info=path)
+        resp = controller.metadata(
+            Request.blank(""), type=random.choice(["files", "actions"]), path_info=path
+        )
 
         self.assertEqual(resp["body"], "")
         self.assertEqual(resp["content_type"], constants.CONTENT_TYPE_HTML)
@@ -161,7 +169,7 @@ class MetaControllerUnitTests(unittest.TestCase):
 
         controller = ztpserver.controller.MetaController()
         resp = controller.metadata(
-            None, type=random.choice(["files", "actions"]), path_info=random_string()
+            Request.blank(""), type=random.choice(["files", "actions"]), path_info=random_string()
         )
 
         self.assertEqual(resp["body"], "")
@@ -180,18 +188,54 @@ class MetaControllerUnitTests(unittest.TestCase):
 
         controller = ztpserver.controller.MetaController()
         resp = controller.metadata(
-            None, type=random.choice(["files", "actions"]), path_info=random_string()
+            Request.blank(""), type=random.choice(["files", "actions"]), path_info=random_string()
         )
 
         self.assertEqual(resp["body"], {"sha1": sha1, "size": size})
         self.assertEqual(resp["content_type"], constants.CONTENT_TYPE_JSON)
 
+    @patch("ztpserver.controller.create_repository")
+    def test_algorithm(self, m_repository):
+        file_resource = m_repository.return_value.get_file.return_value
+        file_resource.hash.return_value = random_string()
+        file_resource.size.return_value = 10
+
+        controller = ztpserver.controller.MetaController()
+        resp = controller.metadata(
+            Request.blank("?algorithm=sha256"), type="files", path_info=random_string()
+        )
+
+        self.assertEqual(resp["body"], {"sha256": file_resource.hash.return_value, "size": 10})
+        file_resource.hash.assert_called_with("sha256", block=False)
+
+    @patch("ztpserver.controller.create_repository")
+    def test_algorithm_invalid(self, m_repository):
+        controller = ztpserver.controller.MetaController()
+        resp = controller.metadata(
+            Request.blank("?algorithm=crc32"), type="files", path_info=random_string()
+        )
+
+        self.assertEqual(resp["status"], constants.HTTP_STATUS_BAD_REQUEST)
+        self.assertFalse(m_repository.return_value.get_file.called)
+
+    @patch("ztpserver.controller.create_repository")
+    def test_pending(self, m_repository):
+        file_resource = m_repository.return_value.get_file.return_value
+        file_resource.hash.return_value = None
+        file_resource.size.return_value = 10
+
+        controller = ztpserver.controller.MetaController()
+        resp = controller.metadata(Request.blank(""), type="files", path_info=random_string())
+
+        self.assertEqual(resp["body"], {"pending": True, "size": 10})
+
 
 class BootstrapConfigUnitTests(unittest.TestCase):
     @patch("ztpserver.controller.create_repository")
     @patch("string.Template.safe_substitute")
     def test_index_success(self, m_substitute, m_repository):
         m_substitute.return_value = random_string()
+        m_repository.return_value.get_file.return_value.name = random_string()
 
         controller = ztpserver.controller.BootstrapController()
 
@@ -216,7 +260,10 @@ class BootstrapConfigUnitTests(unittest.TestCase):
 
     @patch("ztpserver.controller.create_repository")
     def test_index_bootstrap_inaccessible_failure(self, m_repository):
-        cfg = {"return_value.read.side_effect": FileObjectError}
+        cfg = {
+            "return_value.read.side_effect": FileObjectError,
+            "return_value.name": random_string(),
+        }
         m_repository.return_value.get_file.configure_mock(**cfg)
 
         controller = ztpserver.controller.BootstrapController()
@@ -355,6 +402,7 @@ class BootstrapConfigUnitTests(unittest.TestCase):
 class BootstrapUnitTests(unittest.TestCase):
     def setUp(self):
         self.m_repository = Mock()
+        self.m_repository.return_value.get_file.return_value.name = random_string()
         ztpserver.controller.create_repository = self.m_repository
 
     @patch("string.Template.safe_substitute")
@@ -446,6 +494,76 @@ class FilesControllerIntegrationTests(unittest.TestCase):
         self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
         self.assertEqual(resp.content_type, constants.CONTENT_TYPE_OTHER)
         self.assertEqual(resp.text, contents)
+        self.assertTrue(resp.etag)
+        self.assertEqual(resp.accept_ranges, "bytes")
+
+    @patch("ztpserver.controller.create_repository")
+    def test_get_file_range(self, m_repository):
+        contents = random_string() * 10
+        filepath = write_file(contents)
+        m_repository.return_value.get_file.return_value.name = filepath
+        url = f"/files/{filepath}"
+        etag = Request.blank(url).get_response(ztpserver.controller.Router()).etag
+
+        request = Request.blank(url, headers={"Range": "bytes=5-", "If-Range": f'"{etag}"'})
+        resp = request.get_response(ztpserver.controller.Router())
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.text, contents[5:])
+        self.assertEqual(resp.content_range.stop, len(contents))
+
+        # The file changed: the whole file is returned
+        request = Request.blank(url, headers={"Range": "bytes=5-", "If-Range": '"stale"'})
+        resp = request.get_response(ztpserver.controller.Router())
+        self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+        self.assertEqual(resp.text, contents)
+
+        request = Request.blank(url, headers={"Range": f"bytes={len(contents)}-"})
+        resp = request.get_response(ztpserver.controller.Router())
+        self.assertEqual(resp.status_code, 416)
+
+    @patch("ztpserver.controller.create_repository")
+    def test_get_file_not_modified(self, m_repository):
+        filepath = write_file(random_string())
+        m_repository.return_value.get_file.return_value.name = filepath
+        url = f"/files/{filepath}"
+        etag = Request.blank(url).get_response(ztpserver.controller.Router()).etag
+
+        request = Request.blank(url, headers={"If-None-Match": f'"{etag}"'})
+        resp = request.get_response(ztpserver.controller.Router())
+        self.assertEqual(resp.status_code, constants.HTTP_STATUS_NOT_MODIFIED)
+
+    @patch("ztpserver.controller.create_repository")
+    def test_get_file_x_sendfile(self, m_repository):
+        filepath = write_file(random_string())
+        m_repository.return_value.get_file.return_value.name = filepath
+
+        ztpserver.config.runtime.set_value("offload", "x-sendfile", "files")
+        self.addCleanup(ztpserver.config.runtime.set_value, "offload", "off", "files")
+
+        request = Request.blank(f"/files/{filepath}")
+        resp = request.get_response(ztpserver.controller.Router())
+        self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+        self.assertEqual(resp.content_type, constants.CONTENT_TYPE_OTHER)
+        self.assertEqual(resp.headers["X-Sendfile"], filepath)
+        self.assertEqual(resp.body, b"")
+        self.assertTrue(resp.etag)
+
+    @patch("ztpserver.controller.create_repository")
+    def test_get_file_x_accel_redirect(self, m_repository):
+        filepath = write_file(random_string(), filename="image 1.swi")
+        m_repository.return_value.get_file.return_value.name = filepath
+
+        data_root = ztpserver.config.runtime.default.data_root
+        ztpserver.config.runtime.set_value("data_root", os.path.dirname(filepath), "default")
+        self.addCleanup(ztpserver.config.runtime.set_value, "data_root", data_root, "default")
+        ztpserver.config.runtime.set_value("offload", "x-accel-redirect", "files")
+        self.addCleanup(ztpserver.config.runtime.set_value, "offload", "off", "files")
+
+        request = Request.blank("/files/image%201.swi")
+        resp = request.get_response(ztpserver.controller.Router())
+        self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+        self.assertEqual(resp.headers["X-Accel-Redirect"], "/ztps-data/image%201.swi")
+        self.assertEqual(resp.body, b"")
 
     @patch("ztpserver.controller.create_repository")
     def test_get_missing_file(self, m_repository):
@@ -467,7 +585,7 @@ class ActionsControllerIntegrationTests(unittest.TestCase):
     @patch("ztpserver.controller.create_repository")
     def test_get_action_success(self, m_repository):
         contents = random_string()
-        cfg = {"return_value.read.return_value": contents}
+        cfg = {"return_value.read.return_value": contents, "return_value.name": random_string()}
         m_repository.return_value.get_file.configure_mock(**cfg)
 
         filename = random_string()
@@ -757,7 +875,7 @@ class NodesControllerUnitTests(unittest.TestCase):
         request = Mock(json={"neighbors": {}})
         node = Mock(serialnumber=random_string(), systemmac=random_string())
 
-        m_load_neighbordb.return_value.match_node.return_value = [mock_match()]
+        m_load_neighbordb.return_value.first_match.return_value = mock_match()
         controller = ztpserver.controller.NodesController()
 
         (resp, state) = controller.post_node(
@@ -778,11 +896,8 @@ class NodesControllerUnitTests(unittest.TestCase):
         request = Mock(json={"neighbors": {}})
         node = Mock(serialnumber=random_string(), systemmac=random_string())
 
-        m_load_neighbordb.return_value.match_node.return_value = [
-            mock_match(),
-            mock_match(),
-            mock_match(),
-        ]
+        matches = [mock_match(), mock_match(), mock_match()]
+        m_load_neighbordb.return_value.first_match.return_value = matches[0]
 
         controller = ztpserver.controller.NodesController()
         (resp, state) = controller.post_node(
@@ -792,6 +907,31 @@ class NodesControllerUnitTests(unittest.TestCase):
         self.assertEqual(state, "dump_node")
         self.assertIsInstance(resp, dict)
         self.assertEqual(resp["status"], constants.HTTP_STATUS_CREATED)
+        controller.repository.get_file.assert_any_call(f"definitions/{matches[0].definition}")
+        m_load_neighbordb.return_value.match_node.assert_not_called()
+
+    @patch("ztpserver.controller.load_neighbordb")
+    def test_post_node_report_all_matches(self, m_load_neighbordb):
+        ztpserver.config.runtime.set_value("report_all_matches", True, "neighbordb")
+        self.addCleanup(
+            ztpserver.config.runtime.set_value, "report_all_matches", False, "neighbordb"
+        )
+
+        request = Mock(json={"neighbors": {}})
+        node = Mock(serialnumber=random_string(), systemmac=random_string())
+
+        matches = [mock_match(), mock_match(), mock_match()]
+        m_load_neighbordb.return_value.match_node.return_value = matches
+
+        controller = ztpserver.controller.NodesController()
+        (resp, state) = controller.post_node(
+            {}, request=request, node=node, node_id=self.identifier(node)
+        )
+
+        self.assertEqual(state, "dump_node")
+        self.assertEqual(resp["status"], constants.HTTP_STATUS_CREATED)
+        controller.repository.get_file.assert_any_call(f"definitions/{matches[0].definition}")
+        m_load_neighbordb.return_value.first_match.assert_not_called()
 
     @patch("ztpserver.controller.load_neighbordb")
     def test_post_node_success_multiple_matches_systemmac(self, m_load_neighbordb):
@@ -803,7 +943,7 @@ class NodesControllerUnitTests(unittest.TestCase):
         request = Mock(json={"neighbors": {}})
         node = Mock(serialnumber=random_string(), systemmac=random_string())
 
-        m_load_neighbordb.return_value.match_node.return_value = []
+        m_load_neighbordb.return_value.first_match.return_value = None
 
         controller = ztpserver.controller.NodesController()
         (resp, state) = controller.post_node(
@@ -826,7 +966,7 @@ class NodesControllerUnitTests(unittest.TestCase):
         pattern = Mock()
         del pattern.definition
 
-        m_load_neighbordb.return_value.match_node.return_value = [pattern]
+        m_load_neighbordb.return_value.first_match.return_value = pattern
 
         controller = ztpserver.controller.NodesController()
         self.assertRaises(
@@ -990,9 +1130,10 @@ class NodesControllerUnitTests(unittest.TestCase):
         self.assertEqual(state, "do_resources")
         self.assertIsInstance(resp, dict)
 
-    def test_do_resources_success(self):
+    @patch("ztpserver.controller.load_resources")
+    def test_do_resources_success(self, m_load_resources):
         var_foo = random_string()
-        ztpserver.controller.load_resources = Mock(return_value={"foo": var_foo})
+        m_load_resources.return_value = {"foo": var_foo}
 
         definition = create_definition()
         definition.add_action(name="dummy action", attributes={"foo": random_string()})
@@ -1084,7 +1225,7 @@ class NodesControllerPostFsmIntegrationTests(unittest.TestCase):
         m_repository.configure_mock(**cfg)
 
         pattern_name = random_string()
-        cfg = {"return_value.match_node.return_value": [mock_match(name=pattern_name)]}
+        cfg = {"return_value.first_match.return_value": mock_match(name=pattern_name)}
         m_load_neighbordb.configure_mock(**cfg)
 
         body = node.as_json().encode("utf8")
@@ -1417,6 +1558,382 @@ class DefinitionStartupConfigTests(unittest.TestCase):
         self.assertEqual(actions, ["replace_config", action_name_2])
 
 
+class NodeFolderTestCase(unittest.TestCase):
+    """Serves GET /nodes/{id} from a node folder in a real repository"""
+
+    def setUp(self):
+        self.data_root = ztpserver.config.runtime.default.data_root
+        ztpserver.config.runtime.set_value("data_root", add_folder(), "default")
+        ztpserver.config.runtime.set_value("disable_topology_validation", True, "default")
+        ztpserver.controller.definition_cache.invalidate()
+
+        # Use the actual repository, even if another test replaced it
+        patcher = patch(
+            "ztpserver.controller.create_repository", ztpserver.repository.create_repository
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("ztpserver.controller.load_resources", ztpserver.topology.load_resources)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.node = create_node()
+        self.folder = os.path.join(
+            ztpserver.config.runtime.default.data_root, "nodes", self.node.serialnumber
+        )
+        os.makedirs(self.folder)
+        self.write(".node", self.node.as_json())
+        self.write(
+            "definition",
+            json.dumps(
+                {
+                    "name": random_string(),
+                    "actions": [
+                        {
+                            "name": random_string(),
+                            "action": "add_config",
+                            "attributes": {"hostname": "$hostname", "ip": "allocate('pool')"},
+                        }
+                    ],
+                }
+            ),
+        )
+        self.write("attributes", json.dumps({"hostname": "first"}))
+
+    def tearDown(self):
+        ztpserver.config.runtime.set_value("data_root", self.data_root, "default")
+        ztpserver.config.runtime.set_value("disable_topology_validation", False, "default")
+        ztpserver.controller.definition_cache.invalidate()
+        remove_all()
+
+    def write(self, filename, contents):
+        with open(os.path.join(self.folder, filename), "w", encoding="utf8") as fd:
+            fd.write(contents)
+
+    def get_attributes(self):
+        request = Request.blank(f"/nodes/{self.node.serialnumber}", method="GET")
+        resp = request.get_response(ztpserver.controller.Router())
+        self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+        return json.loads(resp.body)["actions"][0]["attributes"]
+
+
+class DefinitionCacheIntegrationTests(NodeFolderTestCase):
+    @patch("ztpserver.topology.run_plugin")
+    def test_cached_definition(self, m_run_plugin):
+        m_run_plugin.side_effect = ["10.0.0.1", "10.0.0.2"]
+        hits = ztpserver.controller.definition_cache.stats["hits"]
+
+        with patch.object(
+            ztpserver.controller.NodesController,
+            "get_definition",
+            autospec=True,
+            side_effect=ztpserver.controller.NodesController.get_definition,
+        ) as m_get_definition:
+            self.assertEqual(self.get_attributes(), {"hostname": "first", "ip": "10.0.0.1"})
+            self.assertEqual(self.get_attributes(), {"hostname": "first", "ip": "10.0.0.2"})
+
+        # plugins run on every request
+        self.assertEqual(m_run_plugin.call_count, 2)
+        self.assertEqual(m_get_definition.call_count, 1)
+        self.assertEqual(ztpserver.controller.definition_cache.stats["hits"], hits + 1)
+
+    @patch("ztpserver.topology.run_plugin")
+    def test_cached_definition_invalidated(self, m_run_plugin):
+        m_run_plugin.return_value = "10.0.0.1"
+
+        self.assertEqual(self.get_attributes()["hostname"], "first")
+        self.write("attributes", json.dumps({"hostname": "second-node"}))
+        self.assertEqual(self.get_attributes()["hostname"], "second-node")
+
+
+class ResourcesIntegrationTests(NodeFolderTestCase):
+    def get(self):
+        request = Request.blank(f"/nodes/{self.node.serialnumber}", method="GET")
+        return request.get_response(ztpserver.controller.Router())
+
+    @patch("ztpserver.topology.run_plugin")
+    def test_concurrent_plugins(self, m_run_plugin):
+        def run_plugin(function, node_id, arg, node):
+            time.sleep(0.2)
+            return f"{function}:{arg}"
+
+        m_run_plugin.side_effect = run_plugin
+        self.write(
+            "definition",
+            json.dumps(
+                {
+                    "name": random_string(),
+                    "actions": [
+                        {
+                            "name": random_string(),
+                            "action": "add_config",
+                            "attributes": {"ip": "allocate('pool')", "vlan": ["db('vlan')", 1]},
+                        },
+                        {
+                            "name": random_string(),
+                            "action": "add_config",
+                            "attributes": {"url": "db('url')", "ip": "allocate('pool')"},
+                        },
+                    ],
+                }
+            ),
+        )
+
+        start = time.monotonic()
+        resp = self.get()
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+        self.assertEqual(
+            [x["attributes"] for x in json.loads(resp.body)["actions"]],
+            [
+                {"ip": "allocate:pool", "vlan": ["db:vlan", 1]},
+                {"url": "db:url", "ip": "allocate:pool"},
+            ],
+        )
+        self.assertEqual(m_run_plugin.call_count, 3)
+
+    @patch("ztpserver.topology.run_plugin")
+    def test_plugin_failure(self, m_run_plugin):
+        m_run_plugin.side_effect = RuntimeError("boom")
+        self.assertEqual(self.get().status_code, constants.HTTP_STATUS_BAD_REQUEST)
+
+
+class PreallocateIntegrationTests(NodeFolderTestCase):
+    def get_attributes_file(self):
+        return load(os.path.join(self.folder, "attributes"), constants.CONTENT_TYPE_YAML)
+
+    def preallocate(self):
+        return ztpserver.controller.NodesController().preallocate(self.node.serialnumber)
+
+    @patch("ztpserver.controller.run_plugin")
+    @patch("ztpserver.topology.run_plugin")
+    def test_preallocate(self, m_run_plugin, m_preallocate_plugin):
+        m_preallocate_plugin.return_value = "10.0.0.1"
+
+        self.assertEqual(self.preallocate(), {"allocate('pool')": "10.0.0.1"})
+        m_preallocate_plugin.assert_called_once()
+        self.assertEqual(
+            m_preallocate_plugin.call_args[0][:3], ("allocate", self.node.serialnumber, "pool")
+        )
+
+        self.assertEqual(
+            self.get_attributes_file(),
+            {"hostname": "first", "pinned_resources": {"allocate('pool')": "10.0.0.1"}},
+        )
+
+        # pinned resources are used instead of running the plugins
+        self.assertEqual(self.get_attributes(), {"hostname": "first", "ip": "10.0.0.1"})
+        self.assertEqual(self.get_attributes(), {"hostname": "first", "ip": "10.0.0.1"})
+        m_run_plugin.assert_not_called()
+
+        # ... and kept
+        self.assertEqual(self.preallocate(), {})
+        m_preallocate_plugin.assert_called_once()
+
+    @patch("ztpserver.controller.run_plugin")
+    def test_preallocate_variables(self, m_run_plugin):
+        m_run_plugin.side_effect = lambda function, node_id, arg, node: f"{function}:{arg}"
+        self.write("attributes", json.dumps({"hostname": "first", "vlan": "sqlite('vlans')"}))
+        self.write(
+            "definition",
+            json.dumps(
+                {
+                    "name": random_string(),
+                    "attributes": {"ip": ["allocate('pool')", "static"]},
+                    "actions": [
+                        {
+                            "name": random_string(),
+                            "action": "add_config",
+                            "attributes": {
+                                "ip": "$ip",
+                                "vlan": "$vlan",
+                                "variables": {"ip": "allocate('pool')"},
+                            },
+                        }
+                    ],
+                }
+            ),
+        )
+
+        self.assertEqual(
+            self.preallocate(),
+            {"allocate('pool')": "allocate:pool", "sqlite('vlans')": "sqlite:vlans"},
+        )
+        self.assertEqual(m_run_plugin.call_count, 2)
+        self.assertEqual(
+            self.get_attributes(),
+            {
+                "ip": ["allocate:pool", "static"],
+                "vlan": "sqlite:vlans",
+                "variables": {"ip": "allocate:pool"},
+            },
+        )
+
+    def test_preallocate_no_resources(self):
+        self.write("definition", json.dumps({"name": random_string(), "actions": []}))
+        self.assertEqual(self.preallocate(), {})
+        self.assertEqual(self.get_attributes_file(), {"hostname": "first"})
+
+    def test_preallocate_missing_definition(self):
+        os.remove(os.path.join(self.folder, "definition"))
+        self.assertRaises(ztpserver.controller.FileObjectNotFound, self.preallocate)
+
+
+class ConditionalGetIntegrationTests(unittest.TestCase):
+    def setUp(self):
+        self.data_root = ztpserver.config.runtime.default.data_root
+        ztpserver.config.runtime.set_value("data_root", add_folder(), "default")
+
+        # Use the actual repository, even if another test replaced it
+        patcher = patch(
+            "ztpserver.controller.create_repository", ztpserver.repository.create_repository
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.write("bootstrap/bootstrap", "SERVER = '$SERVER'\n")
+        self.write("actions/test", random_string())
+        self.write("nodes/SN1/startup-config", random_string())
+
+    def tearDown(self):
+        ztpserver.config.runtime.set_value("data_root", self.data_root, "default")
+        remove_all()
+
+    def write(self, filename, contents):
+        path = os.path.join(ztpserver.config.runtime.default.data_root, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf8") as fd:
+            fd.write(contents)
+
+    def get(self, url, **headers):
+        return Request.blank(url, headers=headers).get_response(ztpserver.controller.Router())
+
+    def test_not_modified(self):
+        for url in ["/bootstrap", "/actions/test", "/nodes/SN1/startup-config"]:
+            resp = self.get(url)
+            self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+            self.assertTrue(resp.etag)
+            self.assertTrue(resp.last_modified)
+
+            with patch("ztpserver.repository.FileObject.read") as m_read:
+                cached = self.get(url, **{"If-None-Match": f'"{resp.etag}"'})
+                self.assertEqual(cached.status_code, constants.HTTP_STATUS_NOT_MODIFIED)
+                self.assertEqual(cached.etag, resp.etag)
+                self.assertFalse(cached.body)
+
+                cached = self.get(url, **{"If-Modified-Since": resp.headers["Last-Modified"]})
+                self.assertEqual(cached.status_code, constants.HTTP_STATUS_NOT_MODIFIED)
+                self.assertFalse(m_read.called)
+
+            resp = self.get(url, **{"If-None-Match": "*"})
+            self.assertEqual(resp.status_code, constants.HTTP_STATUS_NOT_MODIFIED)
+
+            resp = self.get(url, **{"If-None-Match": '"stale"'})
+            self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+
+    def test_modified(self):
+        etag = self.get("/actions/test").etag
+        # change the size too: the mtime may not change within a clock tick
+        self.write("actions/test", "x" * 100)
+
+        resp = self.get("/actions/test", **{"If-None-Match": f'"{etag}"'})
+        self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+        self.assertNotEqual(resp.etag, etag)
+
+    def test_bootstrap_server_url(self):
+        etag = self.get("/bootstrap").etag
+
+        server_url = ztpserver.config.runtime.default.server_url
+        ztpserver.config.runtime.set_value("server_url", "http://192.0.2.1:8080", "default")
+        self.addCleanup(ztpserver.config.runtime.set_value, "server_url", server_url, "default")
+
+        resp = self.get("/bootstrap", **{"If-None-Match": f'"{etag}"'})
+        self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+        self.assertIn("http://192.0.2.1:8080", resp.text)
+
+
+class CompressionIntegrationTests(unittest.TestCase):
+    def setUp(self):
+        self.data_root = ztpserver.config.runtime.default.data_root
+        ztpserver.config.runtime.set_value("data_root", add_folder(), "default")
+
+        # Use the actual repository, even if another test replaced it
+        patcher = patch(
+            "ztpserver.controller.create_repository", ztpserver.repository.create_repository
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        ztpserver.config.runtime.set_value("compress", True, "repository")
+        self.addCleanup(ztpserver.config.runtime.set_value, "compress", False, "repository")
+
+        self.contents = random_string() * 1000
+        path = os.path.join(ztpserver.config.runtime.default.data_root, "actions", "test")
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w", encoding="utf8") as fd:
+            fd.write(self.contents)
+
+    def tearDown(self):
+        ztpserver.config.runtime.set_value("data_root", self.data_root, "default")
+        remove_all()
+
+    def get(self, url, **headers):
+        return Request.blank(url, headers=headers).get_response(ztpserver.controller.Router())
+
+    def test_gzip(self):
+        resp = self.get("/actions/test", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+        self.assertEqual(resp.content_encoding, "gzip")
+        self.assertEqual(resp.vary, ("Accept-Encoding",))
+        self.assertEqual(gzip.decompress(resp.body).decode("utf8"), self.contents)
+        self.assertLess(resp.content_length, len(self.contents))
+
+        folder = os.path.join(ztpserver.config.runtime.default.data_root, ".ztps", "compressed")
+        self.assertEqual(len(os.listdir(os.path.join(folder, "actions"))), 1)
+
+    def test_etag(self):
+        etag = self.get("/actions/test").etag
+        resp = self.get("/actions/test", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.etag, f"{etag}-gzip")
+
+        # either copy is current
+        for value in [etag, f"{etag}-gzip"]:
+            resp = self.get(
+                "/actions/test", **{"Accept-Encoding": "gzip", "If-None-Match": f'"{value}"'}
+            )
+            self.assertEqual(resp.status_code, constants.HTTP_STATUS_NOT_MODIFIED)
+            self.assertEqual(resp.etag, value)
+
+    def test_worker(self):
+        data_root = ztpserver.config.runtime.default.data_root
+        cache = ztpserver.repository.get_compression_cache(data_root)
+        self.addCleanup(cache.worker.stop)
+        deadline = time.time() + 5
+        while cache.worker.stats["files"] < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.worker.stats["files"], 1)
+
+        # the first request gets the sibling built by the worker
+        misses = cache.stats["misses"]
+        resp = self.get("/actions/test", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(gzip.decompress(resp.body).decode("utf8"), self.contents)
+        self.assertEqual(cache.stats["misses"], misses)
+
+    def test_not_accepted(self):
+        for headers in [{}, {"Accept-Encoding": "identity"}, {"Accept-Encoding": "gzip;q=0"}]:
+            resp = self.get("/actions/test", **headers)
+            self.assertEqual(resp.status_code, constants.HTTP_STATUS_OK)
+            self.assertIsNone(resp.content_encoding)
+            self.assertEqual(resp.text, self.contents)
+
+    def test_disabled(self):
+        ztpserver.config.runtime.set_value("compress", False, "repository")
+
+        resp = self.get("/actions/test", **{"Accept-Encoding": "gzip"})
+        self.assertIsNone(resp.content_encoding)
+        self.assertEqual(resp.text, self.contents)
+
+
 if __name__ == "__main__":
     enable_logging()
     unittest.main()
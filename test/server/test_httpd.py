@@ -0,0 +1,212 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# pylint: disable=R0904,C0103
+
+import http.client
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+from wsgiref.simple_server import WSGIServer
+
+from webob.static import FileApp
+
+from ztpserver.httpd import ThreadPoolWSGIServer, make_server
+
+CONTENTS = os.urandom(300 * 1024)
+
+
+def application(environ, start_response):
+    path = environ["PATH_INFO"]
+    if path == "/file":
+        return FileApp(environ["test.filename"])(environ, start_response)
+    if path == "/slow":
+        environ["test.release"].wait(10)
+        body = b"slow"
+    elif path == "/echo":
+        body = environ["wsgi.input"].read(int(environ.get("CONTENT_LENGTH") or 0))
+    elif path == "/stream":
+        # no Content-Length - the connection must be closed to delimit it
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"chunk"] * 3
+    else:
+        body = b"fast"
+
+    start_response(
+        "200 OK",
+        [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))],
+    )
+    return [body]
+
+
+class TestThreadPoolWSGIServer(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+
+        def app(environ, start_response):
+            environ["test.release"] = self.release
+            return application(environ, start_response)
+
+        self.server = make_server("127.0.0.1", 0, app, mode="threaded", threads=4)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def connect(self):
+        return http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+
+    def test_make_server(self):
+        self.assertIsInstance(self.server, ThreadPoolWSGIServer)
+        self.assertEqual(self.server.threads, 4)
+
+    def test_concurrent_requests(self):
+        slow = self.connect()
+        slow.request("GET", "/slow")
+
+        # a blocked request must not delay the others
+        fast = self.connect()
+        fast.request("GET", "/fast")
+        resp = fast.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.read(), b"fast")
+        fast.close()
+
+        self.release.set()
+        resp = slow.getresponse()
+        self.assertEqual(resp.read(), b"slow")
+        slow.close()
+
+    def test_keepalive(self):
+        conn = self.connect()
+        conn.request("GET", "/fast")
+        resp = conn.getresponse()
+        self.assertEqual(resp.version, 11)
+        self.assertEqual(resp.read(), b"fast")
+        sock = conn.sock
+
+        conn.request("POST", "/echo", body=b"payload")
+        resp = conn.getresponse()
+        self.assertEqual(resp.read(), b"payload")
+        self.assertIs(conn.sock, sock)
+        conn.close()
+
+    def test_close_undelimited_response(self):
+        conn = self.connect()
+        conn.request("GET", "/stream")
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader("Connection"), "close")
+        self.assertEqual(resp.read(), b"chunk" * 3)
+        conn.close()
+
+    def test_close_requested(self):
+        conn = self.connect()
+        conn.request("GET", "/fast", headers={"Connection": "close"})
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader("Connection"), "close")
+        self.assertEqual(resp.read(), b"fast")
+        conn.close()
+
+
+class TestSendfile(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.write(fd, CONTENTS)
+        os.close(fd)
+        self.addCleanup(os.remove, self.filename)
+
+        patcher = patch("os.sendfile", side_effect=os.sendfile)
+        self.m_sendfile = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def serve(self, mode, **kwargs):
+        def app(environ, start_response):
+            environ["test.filename"] = self.filename
+            return application(environ, start_response)
+
+        server = make_server("127.0.0.1", 0, app, mode=mode, **kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.addCleanup(stop)
+        return server.server_address[1]
+
+    def get(self, port, headers=None):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        conn.request("GET", "/file", headers=headers or {})
+        resp = conn.getresponse()
+        body = resp.read()
+        conn.close()
+        return resp.status, body
+
+    def test_sendfile(self):
+        for mode in ["single", "threaded"]:
+            self.m_sendfile.reset_mock()
+            port = self.serve(mode)
+            self.assertEqual(self.get(port), (200, CONTENTS))
+            self.assertEqual(
+                self.get(port, {"Range": "bytes=1000-70000"}), (206, CONTENTS[1000:70001])
+            )
+            self.assertTrue(self.m_sendfile.called)
+
+    def test_sendfile_disabled(self):
+        port = self.serve("threaded", sendfile=False)
+        self.assertEqual(self.get(port), (200, CONTENTS))
+        self.assertFalse(self.m_sendfile.called)
+
+
+class TestMakeServer(unittest.TestCase):
+    def test_single(self):
+        server = make_server("127.0.0.1", 0, application)
+        try:
+            self.assertIs(type(server), WSGIServer)
+        finally:
+            server.server_close()
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, make_server, "127.0.0.1", 0, application, mode="bogus")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -188,6 +188,42 @@ class NeighbordbTest(unittest.TestCase):
             print(traceback.format_exc())
             debug(exc)
 
+    def node_index(self):
+        # the patterns selected by the neighbordb index must match the
+        # same patterns as a brute-force search, for the node and for
+        # variations of it (missing interfaces/different neighbors)
+        tag = f"tag={self.tag}, fn={self.filename}"
+
+        node = load_node(self.node)
+        self.assertIsNotNone(node, tag)
+
+        neighbordb = self._load_neighbordb()
+        self.assertIsNotNone(neighbordb, tag)
+
+        nodes = [node]
+        for interface in node.neighbors:
+            variant = load_node(self.node)
+            del variant.neighbors[interface]
+            nodes.append(variant)
+
+            if node.neighbors[interface]:
+                variant = load_node(self.node)
+                neighbor = variant.neighbors[interface][0]
+                variant.neighbors[interface][0] = neighbor._replace(device=random_string())
+                nodes.append(variant)
+
+        variant = load_node(self.node)
+        variant.model = random_string()
+        nodes.append(variant)
+
+        for item in nodes:
+            patterns = neighbordb.patterns["nodes"].get(item.identifier())
+            patterns = [patterns] if patterns else neighbordb.patterns["globals"]
+            expected = [p.name for p in patterns if p.match_node(item)]
+
+            result = [p.name for p in neighbordb.match_node(item)]
+            self.assertEqual(result, expected, tag)
+
 
 def get_test_list(filepath):
     test_list = os.environ.get("TESTS", None)
@@ -249,6 +285,7 @@ def load_tests(loader, tests, pattern):  # pylint: disable=W0613
                             kwargs["tag"] = f"{harness.get('tag')}:{filename}"
                             log.info("Adding node %s", name)
                             suite.addTest(NeighbordbTest(f"node_{key}", ndb, **kwargs))
+                            suite.addTest(NeighbordbTest("node_index", ndb, **kwargs))
 
     except Exception as exc:  # pylint: disable=W0703
         log.exception("Unexpected error trying to execute load_tests: %s", exc)
@@ -32,19 +32,41 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 # pylint: disable=R0904,C0103
 #
+import errno
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from test.server.server_test_lib import enable_logging, random_string
 from unittest.mock import mock_open, patch
 
+from ztpserver import inotify
+from ztpserver.config import runtime
 from ztpserver.repository import (
+    DIGEST_ALGORITHMS,
+    CompressionCache,
+    DigestCache,
     FileObject,
     FileObjectError,
     FileObjectNotFound,
     Repository,
     RepositoryError,
+    RepositoryIndex,
+    create_repository,
+    get_digest_cache,
+    start_prehash,
 )
 from ztpserver.serializers import SerializerError
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class FileObjectUnitTests(unittest.TestCase):
     @patch("ztpserver.serializers.load")
@@ -152,6 +174,350 @@ class RepositoryUnitTests(unittest.TestCase):
         self.assertRaises(RepositoryError, store.delete_file, random_string())
 
 
+class RepositoryIndexUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        os.makedirs(os.path.join(self.path, "nodes", "node1"))
+        self.write("nodes/node1/.node")
+        os.symlink(tempfile.gettempdir(), os.path.join(self.path, "files"))
+
+    def write(self, filename):
+        with open(os.path.join(self.path, filename), "w", encoding="utf8") as fd:
+            fd.write(random_string())
+
+    def create_index(self, method):
+        index = RepositoryIndex(self.path, method, interval=3600)
+        index.start()
+        self.addCleanup(index.stop)
+        return index
+
+    def wait_for(self, store, filename, expected):
+        deadline = time.time() + 5
+        while store.exists(filename) != expected and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(store.exists(filename), expected)
+
+    def test_exists(self):
+        index = self.create_index("poll")
+        store = Repository(self.path, index=index)
+
+        self.assertTrue(store.exists("nodes/node1/.node"))
+        self.assertTrue(store.exists("nodes/node1"))
+        self.assertFalse(store.exists("nodes/node1/definition"))
+        self.assertFalse(store.exists("nodes/node2/definition"))
+        self.assertEqual(index.stats["misses"], 0)
+
+        # symbolic links are not indexed
+        self.assertTrue(store.exists("files"))
+        self.assertEqual(store.exists(f"files/{random_string()}"), False)
+        self.assertEqual(index.stats["misses"], 2)
+
+    def test_server_changes(self):
+        store = Repository(self.path, index=self.create_index("poll"))
+
+        store.add_folder("nodes/node2")
+        store.add_file("nodes/node2/.node", "{}")
+        self.assertTrue(store.exists("nodes/node2/.node"))
+        self.assertFalse(store.exists("nodes/node2/definition"))
+
+        store.delete_file("nodes/node2/.node")
+        self.assertFalse(store.exists("nodes/node2/.node"))
+
+    def test_rescan(self):
+        index = self.create_index("poll")
+        store = Repository(self.path, index=index)
+
+        self.write("nodes/node1/definition")
+        self.assertFalse(store.exists("nodes/node1/definition"))
+        index.rescan()
+        self.assertTrue(store.exists("nodes/node1/definition"))
+
+    def test_notify(self):
+        index = self.create_index("poll")
+        changes = []
+        index.subscribe(changes.append)
+
+        self.write("nodes/node1/definition")
+        index.rescan()
+        self.assertEqual(changes, [None])
+        self.assertEqual(
+            sorted(index.files(os.path.join(self.path, "nodes"))),
+            [
+                os.path.join(self.path, "nodes", "node1", ".node"),
+                os.path.join(self.path, "nodes", "node1", "definition"),
+            ],
+        )
+
+    @unittest.skipUnless(inotify.load_libc(), "inotify not available")
+    def test_inotify(self):
+        index = self.create_index("inotify")
+        self.assertEqual(index.method, "inotify")
+        store = Repository(self.path, index=index)
+
+        os.makedirs(os.path.join(self.path, "nodes", "node2"))
+        self.write("nodes/node2/.node")
+        self.wait_for(store, "nodes/node2/.node", True)
+
+        os.rename(os.path.join(self.path, "nodes", "node2"), os.path.join(self.path, "node3"))
+        self.wait_for(store, "nodes/node2/.node", False)
+        self.wait_for(store, "node3/.node", True)
+
+        shutil.rmtree(os.path.join(self.path, "nodes"))
+        self.wait_for(store, "nodes/node1/.node", False)
+        self.assertEqual(index.stats["misses"], 0)
+
+    @unittest.skipUnless(inotify.load_libc(), "inotify not available")
+    def test_inotify_failure(self):
+        index = self.create_index("inotify")
+        store = Repository(self.path, index=index)
+        changes = []
+        index.subscribe(changes.append)
+
+        # e.g. ENOSPC (out of watches) for a new folder
+        error = OSError(errno.ENOSPC, "No space left on device")
+        with patch.object(index.inotify, "add_watch", side_effect=error):
+            os.makedirs(os.path.join(self.path, "nodes", "node2"))
+            deadline = time.time() + 5
+            while None not in changes and time.time() < deadline:
+                time.sleep(0.01)
+
+        # the index rescanned the tree and is kept current by polling
+        self.assertIn(None, changes)
+        self.assertTrue(index.active)
+        self.assertEqual(index.method, "poll")
+        self.assertIsNone(index.inotify)
+        self.assertTrue(store.exists("nodes/node2"))
+        self.assertFalse(store.exists("nodes/node2/.node"))
+        self.assertEqual(index.stats["misses"], 0)
+
+    @unittest.skipUnless(inotify.load_libc(), "inotify not available")
+    def test_inotify_notify(self):
+        index = self.create_index("inotify")
+        changes = []
+        index.subscribe(changes.extend)
+
+        self.write("nodes/node1/definition")
+        filename = os.path.join(self.path, "nodes", "node1", "definition")
+        deadline = time.time() + 5
+        while filename not in changes and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIn(filename, changes)
+
+    def test_create_repository(self):
+        self.assertIsNone(create_repository(self.path).index)
+
+        runtime.set_value("index", "poll", "repository")
+        self.addCleanup(runtime.set_value, "index", "off", "repository")
+        store = create_repository(self.path)
+        self.addCleanup(store.index.stop)
+
+        self.assertIsInstance(store.index, RepositoryIndex)
+        self.assertIs(create_repository(self.path).index, store.index)
+
+
+class CompressionCacheUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.data = random_string().encode("utf8") * 100
+
+    def siblings(self):
+        return sorted(os.listdir(os.path.join(self.path, "actions")))
+
+    def test_hit(self):
+        cache = CompressionCache(self.path)
+        compressed = cache.get("actions/test", self.data, "gzip")
+        self.assertEqual(gzip.decompress(compressed), self.data)
+        self.assertEqual(cache.get("actions/test", self.data, "gzip"), compressed)
+        self.assertEqual(cache.stats, {"hits": 1, "misses": 1})
+
+        key = hashlib.sha1(self.data).hexdigest()
+        self.assertEqual(self.siblings(), [f"test.{key}.gz"])
+
+    def test_persistent(self):
+        compressed = CompressionCache(self.path).get("actions/test", self.data, "gzip")
+
+        cache = CompressionCache(self.path)
+        self.assertEqual(cache.get("actions/test", self.data, "gzip"), compressed)
+        self.assertEqual(cache.stats, {"hits": 1, "misses": 0})
+
+    def test_changed(self):
+        cache = CompressionCache(self.path)
+        cache.get("actions/test", self.data, "gzip")
+        cache.get("actions/test.old", self.data, "gzip")
+
+        data = random_string().encode("utf8") * 100
+        self.assertEqual(gzip.decompress(cache.get("actions/test", data, "gzip")), data)
+        self.assertEqual(cache.stats["misses"], 3)
+
+        # The sibling of the previous version is removed
+        key = hashlib.sha1(data).hexdigest()
+        old = hashlib.sha1(self.data).hexdigest()
+        self.assertEqual(self.siblings(), [f"test.{key}.gz", f"test.old.{old}.gz"])
+
+    @unittest.skipUnless(zstandard, "requires zstandard")
+    def test_zstd(self):
+        cache = CompressionCache(self.path)
+        compressed = cache.get("actions/test", self.data, "zstd")
+        self.assertEqual(zstandard.ZstdDecompressor().decompress(compressed), self.data)
+        self.assertEqual(len(self.siblings()), 1)
+
+
+class DigestCacheUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.sidecar = os.path.join(self.path, ".ztps", "digests.json")
+
+        self.filename = os.path.join(self.path, "image.swi")
+        self.write(random_string())
+
+    def write(self, contents):
+        with open(self.filename, "w", encoding="utf8") as fd:
+            fd.write(contents)
+        self.contents = contents.encode("utf8")
+
+    def test_hit(self):
+        cache = DigestCache(self.sidecar)
+        expected = hashlib.sha1(self.contents).hexdigest()
+        self.assertEqual(cache.get(self.filename), expected)
+        self.assertEqual(cache.get(self.filename), expected)
+        self.assertEqual(cache.get(self.filename, "md5"), hashlib.md5(self.contents).hexdigest())
+        self.assertEqual(cache.stats, {"hits": 1, "misses": 2, "waits": 0})
+
+    def test_file_changed(self):
+        cache = DigestCache(self.sidecar)
+        cache.get(self.filename)
+
+        # change the size too: the mtime may not change within a clock tick
+        self.write("x" * 100)
+        self.assertEqual(cache.get(self.filename), hashlib.sha1(self.contents).hexdigest())
+        self.assertEqual(cache.stats["misses"], 2)
+
+    def test_persistent(self):
+        expected = DigestCache(self.sidecar).get(self.filename)
+        self.assertTrue(os.path.exists(self.sidecar))
+
+        cache = DigestCache(self.sidecar)
+        self.assertEqual(cache.get(self.filename), expected)
+        self.assertEqual(cache.stats["hits"], 1)
+
+    @patch("ztpserver.repository.compute_digests")
+    def test_single_flight(self, m_compute):
+        started = threading.Event()
+        release = threading.Event()
+
+        def compute(*_):
+            started.set()
+            release.wait(5)
+            return {"sha1": "digest"}
+
+        m_compute.side_effect = compute
+        cache = DigestCache(self.sidecar)
+        results = []
+
+        def request():
+            results.append(cache.get(self.filename))
+
+        threads = [threading.Thread(target=request) for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while cache.stats["waits"] < 3:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(results, ["digest"] * 4)
+        self.assertEqual(m_compute.call_count, 1)
+
+    def test_digests(self):
+        cache = DigestCache(self.sidecar)
+        digests = cache.digests(self.filename, DIGEST_ALGORITHMS)
+        self.assertEqual(
+            digests, {x: hashlib.new(x, self.contents).hexdigest() for x in DIGEST_ALGORITHMS}
+        )
+        self.assertEqual(cache.get(self.filename, "sha256"), digests["sha256"])
+        self.assertEqual(cache.stats["misses"], len(DIGEST_ALGORITHMS))
+
+    def test_worker(self):
+        cache = DigestCache(self.sidecar)
+        self.assertEqual(
+            cache.get(self.filename, block=False), hashlib.sha1(self.contents).hexdigest()
+        )
+
+        os.makedirs(os.path.join(self.path, "files"))
+        self.filename = os.path.join(self.path, "files", "image.swi")
+        self.write(random_string())
+
+        index = RepositoryIndex(self.path, "poll", interval=3600)
+        index.start()
+        self.addCleanup(index.stop)
+
+        worker = cache.start_worker(index, ["files"], workers=2)
+        self.addCleanup(worker.stop)
+        deadline = time.time() + 5
+        while worker.stats["files"] < 1 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(
+            cache.get(self.filename, "md5", block=False), hashlib.md5(self.contents).hexdigest()
+        )
+        self.assertEqual(worker.stats["files"], 1)
+
+        # changed files are queued again
+        self.write("x" * 100)
+        self.assertIsNone(cache.get(self.filename, "sha256", block=False))
+        while cache.pending(self.filename) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(
+            cache.get(self.filename, "sha256", block=False),
+            hashlib.sha256(self.contents).hexdigest(),
+        )
+
+    def test_prehash_shared(self):
+        runtime.set_value("prehash", True, "repository")
+        self.addCleanup(runtime.set_value, "prehash", False, "repository")
+        os.makedirs(os.path.join(self.path, "files"))
+        self.filename = os.path.join(self.path, "files", "image.swi")
+        self.write(random_string())
+
+        worker = start_prehash(self.path)
+        self.addCleanup(worker.index.stop)
+        self.addCleanup(worker.stop)
+        self.assertIs(start_prehash(self.path), worker)
+
+        # processes forked from the owner of the worker do not hash the
+        # repository again, they read the digests from the sidecar file
+        with patch("os.getpid", return_value=os.getpid() + 1):
+            cache = get_digest_cache(self.path)
+        self.assertIsNone(cache.worker)
+        self.assertTrue(cache.background)
+
+        expected = hashlib.sha256(self.contents).hexdigest()
+        deadline = time.time() + 5
+        while cache.get(self.filename, "sha256", block=False) is None:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        self.assertEqual(cache.get(self.filename, "sha256", block=False), expected)
+        self.assertEqual(cache.stats["misses"], 0)
+
+    def test_missing_file(self):
+        cache = DigestCache(self.sidecar)
+        self.assertRaises(IOError, cache.get, os.path.join(self.path, random_string()))
+
+    def test_repository(self):
+        store = Repository(self.path, digests=DigestCache(self.sidecar))
+        expected = hashlib.sha1(self.contents).hexdigest()
+        self.assertEqual(store.get_file("image.swi").hash(), expected)
+        self.assertEqual(store.get_file("image.swi").hash(), expected)
+        self.assertEqual(store.digests.stats["hits"], 1)
+
+
 if __name__ == "__main__":
     enable_logging()
     unittest.main()
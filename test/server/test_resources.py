@@ -0,0 +1,583 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import importlib.machinery
+import importlib.util
+import multiprocessing
+import os
+import queue
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from ztpserver import resources
+from ztpserver.config import runtime
+from ztpserver.constants import CONTENT_TYPE_YAML
+from ztpserver.serializers import dump, load
+from ztpserver.topology import create_node, load_resources, resolve_resources
+
+PLUGINS_DIR = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "plugins")
+
+
+def load_plugin(name):
+    loader = importlib.machinery.SourceFileLoader(name, os.path.join(PLUGINS_DIR, name))
+    spec = importlib.util.spec_from_loader(name, loader)
+    plugin = importlib.util.module_from_spec(spec)
+    loader.exec_module(plugin)
+    return plugin
+
+
+def allocate(filename, node_ids, results):
+    pool = resources.ResourcePool(filename)
+    for node_id in node_ids:
+        results.put((node_id, pool.allocate(node_id)))
+
+
+class ResourcePoolUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.filename = os.path.join(self.folder, "pool")
+        self.journal = os.path.join(self.folder, ".pool.journal")
+
+    def create(self, count, allocated=None):
+        contents = {f"10.0.{i // 256}.{i % 256}": None for i in range(count)}
+        contents.update(allocated or {})
+        dump(contents, self.filename, CONTENT_TYPE_YAML)
+        return list(self.contents())
+
+    def contents(self):
+        return load(self.filename, CONTENT_TYPE_YAML)
+
+    def test_allocate(self):
+        keys = self.create(3, {"10.0.0.0": "node0"})
+        pool = resources.ResourcePool(self.filename)
+
+        self.assertEqual(pool.allocate("node0"), keys[0])
+        self.assertEqual(pool.allocate("node1"), keys[1])
+        self.assertEqual(pool.allocate("node2"), keys[2])
+        self.assertEqual(pool.allocate("node1"), keys[1])
+        self.assertEqual(pool.lookup("node2"), keys[2])
+        self.assertIsNone(pool.lookup("node3"))
+        self.assertRaises(resources.ResourcePoolExhausted, pool.allocate, "node3")
+
+        # allocations are journaled, the pool file is rewritten later on
+        self.assertEqual(self.contents()[keys[1]], None)
+        self.assertTrue(os.path.exists(self.journal))
+        pool.flush()
+        self.assertEqual(list(self.contents().values()), ["node0", "node1", "node2"])
+        self.assertEqual(pool.journaled, 0)
+
+    def test_compact_delay(self):
+        keys = self.create(10)
+        pool = resources.ResourcePool(self.filename)
+        with patch.object(resources, "JOURNAL_COMPACT_DELAY", 0.05):
+            pool.allocate("node0")
+            pool.allocate("node1")
+
+        deadline = time.time() + 5
+        while self.contents()[keys[1]] is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([self.contents()[k] for k in keys[:3]], ["node0", "node1", None])
+
+        # freeing a resource by editing the pool file
+        contents = self.contents()
+        contents[keys[0]] = None
+        dump(contents, self.filename, CONTENT_TYPE_YAML)
+        self.assertIsNone(pool.lookup("node0"))
+
+        # and compacted again after later allocations
+        with patch.object(resources, "JOURNAL_COMPACT_DELAY", 0.05):
+            self.assertEqual(pool.allocate("node2"), keys[0])
+        while self.contents()[keys[0]] is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([self.contents()[k] for k in keys[:3]], ["node2", "node1", None])
+
+    def test_journal_replay(self):
+        keys = self.create(10)
+        pool = resources.ResourcePool(self.filename)
+        self.assertEqual(pool.allocate("node0"), keys[0])
+
+        # another process
+        other = resources.ResourcePool(self.filename)
+        self.assertEqual(other.lookup("node0"), keys[0])
+        self.assertEqual(other.allocate("node1"), keys[1])
+
+        self.assertEqual(pool.lookup("node1"), keys[1])
+        self.assertEqual(pool.allocate("node2"), keys[2])
+        self.assertEqual(other.allocate("node2"), keys[2])
+
+    def test_compact(self):
+        keys = self.create(10)
+        pool = resources.ResourcePool(self.filename)
+        other = resources.ResourcePool(self.filename)
+        with patch.object(resources, "JOURNAL_COMPACT_ENTRIES", 3), patch.object(
+            resources, "JOURNAL_COMPACT_DELAY", 3600
+        ):
+            for index in range(4):
+                pool.allocate(f"node{index}")
+
+        contents = self.contents()
+        self.assertEqual([contents[k] for k in keys[:4]], ["node0", "node1", "node2", None])
+        self.assertEqual(pool.journaled, 1)
+
+        self.assertEqual(other.lookup("node3"), keys[3])
+        self.assertEqual(other.allocate("node4"), keys[4])
+        self.assertEqual(resources.ResourcePool(self.filename).lookup("node4"), keys[4])
+
+    def test_external_edit(self):
+        keys = self.create(4)
+        pool = resources.ResourcePool(self.filename)
+        pool.allocate("node0")
+        pool.allocate("node1")
+
+        # node0's entry was allocated (journal) then freed and allocated
+        # to another node by editing the pool file
+        contents = self.contents()
+        contents[keys[0]] = "node9"
+        contents[keys[3]] = "node10"
+        dump(contents, self.filename, CONTENT_TYPE_YAML)
+
+        self.assertEqual(pool.lookup("node9"), keys[0])
+        self.assertIsNone(pool.lookup("node0"))
+        self.assertEqual(pool.lookup("node1"), keys[1])
+        self.assertEqual(pool.allocate("node0"), keys[2])
+        self.assertRaises(resources.ResourcePoolExhausted, pool.allocate, "node2")
+
+        contents = self.contents()
+        self.assertEqual(list(contents.values()), ["node9", "node1", None, "node10"])
+
+    def test_partial_journal_entry(self):
+        keys = self.create(4)
+        resources.ResourcePool(self.filename).allocate("node0")
+        with open(self.journal, "a", encoding="utf8") as fd:
+            fd.write('{"key": "10.0.0.1", "no')
+
+        pool = resources.ResourcePool(self.filename)
+        self.assertEqual(pool.lookup("node0"), keys[0])
+        self.assertEqual(pool.allocate("node1"), keys[1])
+
+    def test_clear(self):
+        self.create(4, {"10.0.0.1": "node1"})
+        pool = resources.ResourcePool(self.filename)
+        pool.allocate("node0")
+        pool.clear()
+
+        self.assertEqual(list(self.contents().values()), [None] * 4)
+        self.assertIsNone(resources.ResourcePool(self.filename).lookup("node0"))
+        self.assertEqual(pool.allocate("node2"), "10.0.0.0")
+
+    def test_empty_pool(self):
+        dump({}, self.filename, CONTENT_TYPE_YAML)
+        pool = resources.ResourcePool(self.filename)
+        self.assertRaises(resources.ResourcePoolError, pool.allocate, "node0")
+
+    def test_get_resource_pool(self):
+        self.create(1)
+        pool = resources.get_resource_pool(self.filename)
+        self.assertIs(pool, resources.get_resource_pool(os.path.join(self.folder, ".", "pool")))
+
+    def test_large_pool(self):
+        keys = self.create(100000)
+        pool = resources.ResourcePool(self.filename)
+        patcher = patch.object(resources, "JOURNAL_COMPACT_DELAY", 3600)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for index in range(0, 1000):
+            self.assertEqual(pool.allocate(f"node{index}"), keys[index])
+        self.assertEqual(pool.stats["reloads"], 1)
+        self.assertEqual(pool.stats["compactions"], 2)
+        self.assertEqual(pool.lookup("node500"), keys[500])
+
+    def test_stress_processes(self):
+        # concurrent allocations from several processes never hand out the
+        # same entry twice (nor two entries to the same node)
+        keys = self.create(200)
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=allocate,
+                args=(self.filename, [f"node{i}" for i in range(n, 150, 2)], results),
+            )
+            for n in range(2)
+            for _ in range(3)
+        ]
+        with patch.object(resources, "JOURNAL_COMPACT_ENTRIES", 16):
+            for process in processes:
+                process.start()
+            allocated = {}
+            for _ in range(6 * 75):
+                node_id, key = results.get(timeout=60)
+                self.assertEqual(allocated.setdefault(node_id, key), key)
+            for process in processes:
+                process.join()
+
+        self.assertEqual(sorted(allocated.values()), sorted(keys[:150]))
+        pool = resources.ResourcePool(self.filename)
+        for node_id, key in allocated.items():
+            self.assertEqual(pool.lookup(node_id), key)
+
+
+class AllocatePluginUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.data_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_root)
+        os.mkdir(os.path.join(self.data_root, "resources"))
+        data_root = runtime.default.data_root
+        runtime.set_value("data_root", self.data_root, "default")
+        self.addCleanup(runtime.set_value, "data_root", data_root, "default")
+        self.plugin = load_plugin("allocate")
+
+    def test_allocate(self):
+        dump(
+            {"1.1.1.1": None, "1.1.1.2": None},
+            os.path.join(self.data_root, "resources", "pool"),
+            CONTENT_TYPE_YAML,
+        )
+        self.assertEqual(self.plugin.main("node0", "pool", None), "1.1.1.1")
+        self.assertEqual(self.plugin.main("node1", "pool", None), "1.1.1.2")
+        self.assertEqual(self.plugin.main("node0", "pool", None), "1.1.1.1")
+        self.assertRaisesRegex(
+            RuntimeError,
+            "node2: no resource free in 'pool'",
+            self.plugin.main,
+            "node2",
+            "pool",
+            None,
+        )
+
+    def test_missing_pool(self):
+        self.assertRaisesRegex(
+            RuntimeError,
+            "node0: failed to allocate resource from 'missing'",
+            self.plugin.main,
+            "node0",
+            "missing",
+            None,
+        )
+
+
+def assign(plugin, node_ids, results):
+    for node_id in node_ids:
+        results.put((node_id, plugin.main(node_id, "pool", None)))
+
+
+class SqlitePluginUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.plugin = load_plugin("sqlite")
+        self.plugin.DB_URL = os.path.join(self.folder, "resources.db")
+
+        with sqlite3.connect(self.plugin.DB_URL) as con:
+            con.execute("CREATE TABLE pool(key TEXT, node_id TEXT)")
+            con.executemany(
+                "INSERT INTO pool VALUES(?, ?)",
+                [("1.1.1.1", None), ("1.1.1.2", "node1"), ("1.1.1.3", None)],
+            )
+        con.close()
+
+    def test_assign(self):
+        self.assertEqual(self.plugin.main("node0", "pool", None), "1.1.1.1")
+        self.assertEqual(self.plugin.main("node1", "pool", None), "1.1.1.2")
+        self.assertEqual(self.plugin.main("node2", "pool", None), "1.1.1.3")
+        self.assertEqual(self.plugin.main("node0", "pool", None), "1.1.1.1")
+        self.assertRaisesRegex(
+            RuntimeError, "Resource not found", self.plugin.main, "node3", "pool", None
+        )
+
+        con = self.plugin.connection()
+        self.assertIs(con, self.plugin.connection())
+        self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertIn(
+            "pool_node_id",
+            [row[1] for row in con.execute('PRAGMA index_list("pool")').fetchall()],
+        )
+        self.assertFalse(con.in_transaction)
+
+    def test_quoted_node_id(self):
+        self.assertEqual(self.plugin.main("n'0", "pool", None), "1.1.1.1")
+        self.assertEqual(self.plugin.main("n'0", "pool", None), "1.1.1.1")
+
+    def test_missing_table(self):
+        self.assertRaisesRegex(
+            RuntimeError,
+            "node0: failed to allocate resource from 'missing'",
+            self.plugin.main,
+            "node0",
+            "missing",
+            None,
+        )
+
+    def test_missing_db(self):
+        self.plugin.DB_URL = os.path.join(self.folder, "missing.db")
+        self.assertRaisesRegex(RuntimeError, "does not exists", self.plugin.main, "n", "pool", None)
+
+    def test_threads(self):
+        with sqlite3.connect(self.plugin.DB_URL) as con:
+            con.executemany(
+                "INSERT INTO pool VALUES(?, NULL)", [(f"2.2.{i}.0",) for i in range(100)]
+            )
+        con.close()
+
+        results = queue.Queue()
+        threads = [
+            threading.Thread(
+                target=assign, args=(self.plugin, [f"node{i}" for i in range(n, 60, 2)], results)
+            )
+            for n in range(2)
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        allocated = {}
+        while not results.empty():
+            node_id, key = results.get()
+            self.assertEqual(allocated.setdefault(node_id, key), key)
+        self.assertEqual(len(allocated), 60)
+        self.assertEqual(len(set(allocated.values())), 60)
+
+
+class PluginCacheUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.data_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_root)
+        os.mkdir(os.path.join(self.data_root, "plugins"))
+        data_root = runtime.default.data_root
+        runtime.set_value("data_root", self.data_root, "default")
+        self.addCleanup(runtime.set_value, "data_root", data_root, "default")
+        resources.plugin_cache.invalidate()
+        self.addCleanup(resources.plugin_cache.invalidate)
+
+    def write_plugin(self, ttl):
+        name = f"counter{os.getpid()}_{ttl}"
+        with open(os.path.join(self.data_root, "plugins", name), "w", encoding="utf8") as fd:
+            fd.write(f"CACHE_TTL = {ttl}\nCALLS = []\n\n")
+            fd.write("def main(node_id, pool, node):\n")
+            fd.write("    CALLS.append(pool)\n")
+            fd.write("    return {'pool': pool, 'calls': len(CALLS)}\n")
+        self.addCleanup(sys.modules.pop, name, None)
+        return name
+
+    def test_get_set(self):
+        cache = resources.PluginCache(size=2)
+        self.assertIs(cache.get("a"), cache.MISSING)
+        cache.set("a", {"x": 1}, 60)
+        cache.set("b", None, 60)
+
+        value = cache.get("a")
+        self.assertEqual(value, {"x": 1})
+        value["x"] = 2
+        self.assertEqual(cache.get("a"), {"x": 1})
+        self.assertIsNone(cache.get("b"))
+
+        # LRU
+        cache.get("a")
+        cache.set("c", 3, 60)
+        self.assertIs(cache.get("b"), cache.MISSING)
+        self.assertEqual(cache.get("a"), {"x": 1})
+        self.assertEqual(cache.stats["evictions"], 1)
+
+    def test_expired(self):
+        cache = resources.PluginCache()
+        with patch("ztpserver.resources.time.monotonic", return_value=100):
+            cache.set("a", 1, 10)
+        with patch("ztpserver.resources.time.monotonic", return_value=109):
+            self.assertEqual(cache.get("a"), 1)
+        with patch("ztpserver.resources.time.monotonic", return_value=110):
+            self.assertIs(cache.get("a"), cache.MISSING)
+        self.assertEqual(cache.stats, {"hits": 1, "misses": 1, "evictions": 0, "memoized": 0})
+
+    def test_run_plugin_cached(self):
+        plugin = self.write_plugin(60)
+        self.assertEqual(resources.run_plugin(plugin, "node0", "url", None)["calls"], 1)
+        self.assertEqual(resources.run_plugin(plugin, "node0", "url", None)["calls"], 1)
+        self.assertEqual(resources.run_plugin(plugin, "node1", "url", None)["calls"], 2)
+        self.assertEqual(resources.run_plugin(plugin, "node0", "vars", None)["calls"], 3)
+        self.assertEqual(resources.plugin_cache.stats["hits"], 1)
+
+    def test_run_plugin_neighbors(self):
+        plugin = self.write_plugin(60)
+
+        def node(device):
+            neighbors = {"Ethernet1": [{"device": device, "port": "Ethernet1"}]}
+            return create_node({"serialnumber": "node0", "neighbors": neighbors})
+
+        self.assertEqual(resources.run_plugin(plugin, "node0", "url", node("spine1"))["calls"], 1)
+        self.assertEqual(resources.run_plugin(plugin, "node0", "url", node("spine1"))["calls"], 1)
+
+        # re-cabled
+        self.assertEqual(resources.run_plugin(plugin, "node0", "url", node("spine2"))["calls"], 2)
+
+    def test_run_plugin_not_cached(self):
+        plugin = self.write_plugin(0)
+        self.assertEqual(resources.run_plugin(plugin, "node0", "url", None)["calls"], 1)
+        self.assertEqual(resources.run_plugin(plugin, "node0", "url", None)["calls"], 2)
+        self.assertEqual(len(resources.plugin_cache.entries), 0)
+
+    @patch("ztpserver.topology.run_plugin")
+    def test_resolve_resources(self, m_run_plugin):
+        m_run_plugin.side_effect = lambda function, node_id, arg, node: f"{function}:{arg}"
+        memoized = resources.plugin_cache.stats["memoized"]
+
+        attributes = [
+            {"url": "db('url')", "vars": "db('variables')", "x": ["db('url')", "y"]},
+            {"url": "db('url')", "nested": {"ip": "allocate('pool')"}},
+        ]
+        memo = resolve_resources(attributes, None, "node0")
+        self.assertEqual(
+            memo,
+            {
+                ("db", "url"): "db:url",
+                ("db", "variables"): "db:variables",
+                ("allocate", "pool"): "allocate:pool",
+            },
+        )
+        self.assertEqual(m_run_plugin.call_count, 3)
+        self.assertEqual(resources.plugin_cache.stats["memoized"], memoized + 2)
+
+        self.assertEqual(
+            load_resources(attributes[0], None, "node0", memo),
+            {"url": "db:url", "vars": "db:variables", "x": ["db:url", "y"]},
+        )
+        self.assertEqual(m_run_plugin.call_count, 3)
+
+        # no memo: the plugins run
+        self.assertEqual(load_resources(attributes[1], None, "node0")["url"], "db:url")
+        self.assertEqual(m_run_plugin.call_count, 5)
+
+
+class RunPluginsUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.data_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_root)
+        os.mkdir(os.path.join(self.data_root, "plugins"))
+        data_root = runtime.default.data_root
+        runtime.set_value("data_root", self.data_root, "default")
+        self.addCleanup(runtime.set_value, "data_root", data_root, "default")
+        self.events = {}
+
+    def write_plugin(self, name, contents):
+        name = f"{name}{os.getpid()}"
+        with open(os.path.join(self.data_root, "plugins", name), "w", encoding="utf8") as fd:
+            fd.write(contents)
+        self.addCleanup(sys.modules.pop, name, None)
+        return name
+
+    def run_plugin(self, plugin, node_id, arg, node):
+        if arg == "fail":
+            raise RuntimeError("boom")
+        if arg.startswith("wait"):
+            self.events.setdefault(arg, threading.Event()).wait(10)
+        return f"{node_id}:{arg}"
+
+    def test_concurrent(self):
+        # each call waits for the next one: only completes if they run
+        # concurrently
+        def run(plugin, node_id, arg, node):
+            index = int(arg)
+            if index < 3:
+                barrier.wait(5)
+            return index
+
+        barrier = threading.Barrier(3)
+        calls = [("plugin", str(index)) for index in range(4)]
+        self.assertEqual(
+            resources.run_plugins(calls, "node0", None, run=run),
+            {("plugin", str(index)): index for index in range(4)},
+        )
+
+    def test_failure(self):
+        self.assertRaisesRegex(
+            RuntimeError,
+            r"node0: plugin\('fail'\) failed: boom",
+            resources.run_plugins,
+            [("plugin", "ok"), ("plugin", "fail")],
+            "node0",
+            None,
+            run=self.run_plugin,
+        )
+
+    def test_timeout(self):
+        plugin = self.write_plugin("slow", "TIMEOUT = 0.2\n")
+        self.addCleanup(lambda: self.events["wait"].set())
+        self.events["wait"] = threading.Event()
+
+        start = time.monotonic()
+        self.assertRaisesRegex(
+            RuntimeError,
+            rf"node0: {plugin}\('wait'\) timed out",
+            resources.run_plugins,
+            [("other", "ok"), (plugin, "wait")],
+            "node0",
+            None,
+            run=self.run_plugin,
+        )
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_default_timeout(self):
+        runtime.set_value("timeout", 1, "plugins")
+        self.addCleanup(runtime.set_value, "timeout", 60, "plugins")
+        self.assertEqual(resources.plugin_limits("missing"), (1, None))
+
+    def test_concurrency(self):
+        plugin = self.write_plugin("serial", "CONCURRENCY = 1\n")
+        timeout, semaphore = resources.plugin_limits(plugin)
+        self.assertEqual(timeout, runtime.plugins.timeout)
+        self.assertIs(semaphore, resources.plugin_limits(plugin)[1])
+
+        running = []
+        overlaps = []
+
+        def run(plugin, node_id, arg, node):
+            running.append(arg)
+            overlaps.append(len(running))
+            time.sleep(0.01)
+            running.remove(arg)
+            return arg
+
+        calls = [(plugin, str(index)) for index in range(4)]
+        self.assertEqual(len(resources.run_plugins(calls, "node0", None, run=run)), 4)
+        self.assertEqual(max(overlaps), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
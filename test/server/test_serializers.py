@@ -30,12 +30,22 @@
 # IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import gc
+import json
+import multiprocessing
 import os
 import random
+import shutil
+import stat
+import tempfile
+import threading
 import unittest
+from collections import OrderedDict
+from unittest.mock import patch
 
 from ztpserver import serializers
-from ztpserver.constants import CONTENT_TYPE_JSON
+from ztpserver.config import runtime
+from ztpserver.constants import CONTENT_TYPE_JSON, CONTENT_TYPE_YAML
 
 TMP_FILE = f"/tmp/test_serializers-{os.getpid()}"
 
@@ -75,6 +85,204 @@ class SerializersUnitTest(unittest.TestCase):
             serializers.dump(data, TMP_FILE, CONTENT_TYPE_JSON)
             assert serializers.load(TMP_FILE, CONTENT_TYPE_JSON) == data
 
+    def test_file_lock(self):
+        lock = serializers.file_lock(TMP_FILE)
+        self.assertIs(lock, serializers.file_lock(TMP_FILE))
+
+        # re-entrant: held across load and dump with lock=True
+        with lock:
+            serializers.dump({"count": 0}, TMP_FILE, CONTENT_TYPE_JSON, lock=True)
+            serializers.load(TMP_FILE, CONTENT_TYPE_JSON, lock=True)
+
+    def test_file_lock_read_modify_write(self):
+        serializers.dump({"count": 0}, TMP_FILE, CONTENT_TYPE_JSON)
+
+        def increment():
+            for _ in range(25):
+                with serializers.file_lock(TMP_FILE):
+                    data = serializers.load(TMP_FILE, CONTENT_TYPE_JSON, lock=True)
+                    data["count"] += 1
+                    serializers.dump(data, TMP_FILE, CONTENT_TYPE_JSON, lock=True)
+
+        threads = [threading.Thread(target=increment) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(serializers.load(TMP_FILE, CONTENT_TYPE_JSON)["count"], 200)
+
+    def test_file_lock_released(self):
+        lock = serializers.file_lock(TMP_FILE)
+        self.assertIn(os.path.realpath(TMP_FILE), serializers.FILE_LOCKS)
+        del lock
+        gc.collect()
+        self.assertNotIn(os.path.realpath(TMP_FILE), serializers.FILE_LOCKS)
+
+
+def increment(filename, count):
+    for _ in range(count):
+        with serializers.file_lock(filename):
+            data = serializers.load(filename, CONTENT_TYPE_JSON, lock=True)
+            data["count"] += 1
+            data["padding"] = "x" * random.randint(0, 65536)
+            serializers.dump(data, filename, CONTENT_TYPE_JSON, lock=True)
+
+
+def read(filename, stop, errors):
+    while not stop.is_set():
+        try:
+            serializers.load(filename, CONTENT_TYPE_JSON)["count"]  # pylint: disable=W0106
+        except Exception:  # pylint: disable=W0703
+            errors.value += 1
+
+
+class AtomicWriteUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.filename = os.path.join(self.folder, "test")
+
+    def test_dump(self):
+        serializers.dump({"count": 0}, self.filename, CONTENT_TYPE_JSON)
+        os.chmod(self.filename, 0o640)
+        serializers.dump({"count": 1}, self.filename, CONTENT_TYPE_JSON)
+
+        self.assertEqual(serializers.load(self.filename, CONTENT_TYPE_JSON), {"count": 1})
+        self.assertEqual(stat.S_IMODE(os.stat(self.filename).st_mode), 0o640)
+        self.assertEqual(os.listdir(self.folder), ["test"])
+
+    def test_dump_symlink(self):
+        serializers.dump({"count": 0}, self.filename, CONTENT_TYPE_JSON)
+        link = os.path.join(self.folder, "link")
+        os.symlink(self.filename, link)
+
+        serializers.dump({"count": 1}, link, CONTENT_TYPE_JSON)
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(serializers.load(self.filename, CONTENT_TYPE_JSON), {"count": 1})
+
+    def test_dump_error(self):
+        serializers.dump({"count": 0}, self.filename, CONTENT_TYPE_JSON)
+        self.assertRaises(
+            serializers.SerializerError,
+            serializers.dump,
+            {"count": object()},
+            self.filename,
+            CONTENT_TYPE_JSON,
+        )
+        self.assertEqual(serializers.load(self.filename, CONTENT_TYPE_JSON), {"count": 0})
+        self.assertEqual(os.listdir(self.folder), ["test"])
+
+    def test_lock_file(self):
+        with serializers.file_lock(self.filename):
+            self.assertTrue(os.path.exists(os.path.join(self.folder, ".test.lock")))
+
+    def test_stress_processes(self):
+        # Writers increment a counter (read-modify-write) while readers
+        # keep loading the file without the lock: readers must never see
+        # a partial file and no increment may be lost
+        serializers.dump({"count": 0}, self.filename, CONTENT_TYPE_JSON)
+
+        context = multiprocessing.get_context("fork")
+        stop = context.Event()
+        errors = context.Value("i", 0)
+        readers = [
+            context.Process(target=read, args=(self.filename, stop, errors)) for _ in range(4)
+        ]
+        writers = [context.Process(target=increment, args=(self.filename, 50)) for _ in range(6)]
+        for process in readers + writers:
+            process.start()
+        for process in writers:
+            process.join()
+        stop.set()
+        for process in readers:
+            process.join()
+
+        self.assertEqual(errors.value, 0)
+        self.assertEqual(serializers.load(self.filename, CONTENT_TYPE_JSON)["count"], 300)
+        self.assertEqual(sorted(os.listdir(self.folder)), [".test.lock", "test"])
+
+
+class SerializerBackendsUnitTest(unittest.TestCase):
+    def use(self, kind, name):
+        runtime.set_value(kind, name, "serializers")
+        self.addCleanup(runtime.set_value, kind, "auto", "serializers")
+
+    def test_auto(self):
+        self.assertEqual(
+            serializers.yaml_backend(),
+            serializers.YAML_BACKENDS[
+                "libyaml" if "libyaml" in serializers.YAML_BACKENDS else "python"
+            ],
+        )
+        self.assertEqual(
+            serializers.json_backend(), "orjson" if serializers.orjson is not None else "json"
+        )
+
+    def test_unavailable(self):
+        with patch.dict(serializers.YAML_BACKENDS):
+            serializers.YAML_BACKENDS.pop("libyaml", None)
+            serializers.select_backend.cache_clear()
+            self.addCleanup(serializers.select_backend.cache_clear)
+            self.use("yaml", "libyaml")
+            self.assertEqual(serializers.yaml_backend(), serializers.YAML_BACKENDS["python"])
+
+    def test_yaml(self):
+        data = OrderedDict([("b", [1, 2]), ("a", {"c": "d"})])
+        for name in serializers.YAML_BACKENDS:
+            self.use("yaml", name)
+            contents = serializers.dumps(data, CONTENT_TYPE_YAML, "N/A")
+            self.assertEqual(contents, "b:\n- 1\n- 2\na:\n  c: d\n")
+            self.assertEqual(serializers.loads(contents, CONTENT_TYPE_YAML, "N/A"), data)
+
+            self.assertRaises(
+                serializers.SerializerError, serializers.loads, "a: [", CONTENT_TYPE_YAML, "N/A"
+            )
+
+    def test_json(self):
+        for name in serializers.JSON_BACKENDS:
+            self.use("json", name)
+            data = {"a": [1, 2, {"b": None}]}
+            contents = serializers.dumps(data, CONTENT_TYPE_JSON, "N/A")
+            self.assertEqual(serializers.loads(contents, CONTENT_TYPE_JSON, "N/A"), data)
+
+            # Handled by the json module only
+            contents = serializers.dumps({1: "a"}, CONTENT_TYPE_JSON, "N/A")
+            self.assertEqual(serializers.loads(contents, CONTENT_TYPE_JSON, "N/A"), {"1": "a"})
+            self.assertNotEqual(serializers.loads("NaN", CONTENT_TYPE_JSON, "N/A"), 0)
+
+            self.assertRaises(
+                serializers.SerializerError, serializers.loads, "{", CONTENT_TYPE_JSON, "N/A"
+            )
+
+    def test_json_output(self):
+        data = {"a": [1, 2.5, {"b": None}], "c": "caf\u00e9"}
+        self.use("json", "json")
+        self.assertEqual(serializers.dumps(data, CONTENT_TYPE_JSON, "N/A"), json.dumps(data))
+
+        data = {"a": [float("nan"), None], "b": {"c": float("inf")}}
+        self.assertEqual(
+            serializers.dumps(data, CONTENT_TYPE_JSON, "N/A"),
+            '{"a": [NaN, null], "b": {"c": Infinity}}',
+        )
+
+    @unittest.skipUnless(serializers.orjson, "requires orjson")
+    def test_orjson_output(self):
+        self.use("json", "orjson")
+        data = {"a": [1, 2.5, {"b": None}], "c": "caf\u00e9"}
+        self.assertEqual(
+            serializers.dumps(data, CONTENT_TYPE_JSON, "N/A"),
+            '{"a":[1,2.5,{"b":null}],"c":"caf\u00e9"}',
+        )
+
+        # NaN is kept (by the json module, in the format of orjson)
+        data = {"a": [float("nan"), None], "b": {"c": float("inf")}}
+        self.assertEqual(
+            serializers.dumps(data, CONTENT_TYPE_JSON, "N/A"),
+            '{"a":[NaN,null],"b":{"c":Infinity}}',
+        )
+        self.assertEqual(serializers.dumps({1: "a"}, CONTENT_TYPE_JSON, "N/A"), '{"1":"a"}')
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -30,6 +30,9 @@
 # IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import os
+import shutil
+import tempfile
 import unittest
 from test.server.server_test_lib import enable_logging, random_string
 from unittest.mock import Mock, patch
@@ -38,16 +41,22 @@ import yaml
 
 import ztpserver.serializers
 import ztpserver.topology
+from ztpserver.config import runtime
 from ztpserver.topology import (
     Neighbordb,
+    NeighbordbCache,
     Pattern,
     create_node,
     load_file,
     load_neighbordb,
     load_pattern,
     neighbordb_path,
+    regex_prefix,
     replace_config_action,
+    snapshot_path,
+    write_snapshot,
 )
+from ztpserver.utils import file_signature
 
 
 class NeighbordbUnitTests(unittest.TestCase):
@@ -102,6 +111,16 @@ class NeighbordbUnitTests(unittest.TestCase):
         result = load_neighbordb(random_string())
         self.assertIsInstance(result, Neighbordb)
 
+    def test_regex_prefix(self):
+        self.assertEqual(regex_prefix("vEOS"), "vEOS")
+        self.assertEqual(regex_prefix("^DCS-7050.*"), "DCS-7050")
+        self.assertEqual(regex_prefix("DCS-7050S?X"), "DCS-7050")
+        self.assertEqual(regex_prefix("DCS-7(050|280)"), "")
+        self.assertEqual(regex_prefix("vEOS|DCS"), "")
+        self.assertEqual(regex_prefix("(?i)veos"), "")
+        self.assertEqual(regex_prefix(r"DCS\-7"), "DCS")
+        self.assertEqual(regex_prefix(".*"), "")
+
     def test_load_pattern_minimal(self):
         pattern = load_pattern(
             {"name": random_string(), "definition": random_string(), "interfaces": []}
@@ -139,6 +158,100 @@ class NeighbordbUnitTests(unittest.TestCase):
         self.assertTrue("." not in result.systemmac)
 
 
+class NeighbordbCacheUnitTests(unittest.TestCase):
+    CONTENTS = """
+        patterns:
+            - name: %s
+              definition: dummy_definition
+              interfaces:
+                - any: any
+    """
+
+    def setUp(self):
+        self.data_root = runtime.default.data_root
+        self.tmpdir = tempfile.mkdtemp()
+        runtime.set_value("data_root", self.tmpdir, "default")
+        self.cache = NeighbordbCache()
+
+    def tearDown(self):
+        runtime.set_value("data_root", self.data_root, "default")
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, contents):
+        with open(neighbordb_path(), "w", encoding="utf8") as fd:
+            fd.write(contents)
+        # make sure the signature changes, even on coarse timestamps
+        stat = os.stat(neighbordb_path())
+        os.utime(neighbordb_path(), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+    def test_hit(self):
+        self.write(self.CONTENTS % "pattern1")
+        neighbordb = self.cache.get(random_string())
+        self.assertIsInstance(neighbordb, Neighbordb)
+        self.assertIs(self.cache.get(random_string()), neighbordb)
+        self.assertEqual(self.cache.stats, {"hits": 1, "rebuilds": 1, "errors": 0})
+
+    def test_file_changed(self):
+        self.write(self.CONTENTS % "pattern1")
+        self.cache.get(random_string())
+        self.write(self.CONTENTS % "pattern2")
+        neighbordb = self.cache.get(random_string())
+        self.assertEqual(neighbordb.get_patterns()[0].name, "pattern2")
+        self.assertEqual(self.cache.stats["rebuilds"], 2)
+
+    def test_invalidate(self):
+        self.write(self.CONTENTS % "pattern1")
+        neighbordb = self.cache.get(random_string())
+        self.cache.invalidate()
+        self.assertIsNot(self.cache.get(random_string()), neighbordb)
+        self.assertEqual(self.cache.stats["rebuilds"], 2)
+
+    def test_failed_reload(self):
+        self.write(self.CONTENTS % "pattern1")
+        neighbordb = self.cache.get(random_string())
+        self.write("patterns: [")
+        self.assertIs(self.cache.get(random_string()), neighbordb)
+        self.assertIs(self.cache.get(random_string()), neighbordb)
+        self.assertEqual(self.cache.stats, {"hits": 1, "rebuilds": 1, "errors": 1})
+
+    def test_snapshot(self):
+        self.write(self.CONTENTS % "pattern1")
+        neighbordb = ztpserver.topology.compile_neighbordb(random_string())
+        write_snapshot(neighbordb, file_signature(neighbordb_path()))
+        self.assertTrue(os.path.exists(snapshot_path()))
+
+        with patch("ztpserver.topology.compile_neighbordb") as m_compile:
+            neighbordb = self.cache.get(random_string())
+            self.assertFalse(m_compile.called)
+        self.assertEqual(neighbordb.get_patterns()[0].name, "pattern1")
+        self.assertEqual(self.cache.stats["rebuilds"], 1)
+
+    def test_snapshot_outdated(self):
+        self.write(self.CONTENTS % "pattern1")
+        neighbordb = ztpserver.topology.compile_neighbordb(random_string())
+        write_snapshot(neighbordb, file_signature(neighbordb_path()))
+
+        self.write(self.CONTENTS % "pattern2")
+        neighbordb = self.cache.get(random_string())
+        self.assertEqual(neighbordb.get_patterns()[0].name, "pattern2")
+
+    def test_snapshot_corrupt(self):
+        self.write(self.CONTENTS % "pattern1")
+        os.makedirs(os.path.dirname(snapshot_path()))
+        with open(snapshot_path(), "wb") as fd:
+            fd.write(b"bogus")
+
+        neighbordb = self.cache.get(random_string())
+        self.assertEqual(neighbordb.get_patterns()[0].name, "pattern1")
+
+    @patch("ztpserver.topology.compile_neighbordb")
+    def test_missing_file(self, m_compile):
+        self.cache.get(random_string())
+        self.cache.get(random_string())
+        self.assertEqual(m_compile.call_count, 2)
+        self.assertEqual(self.cache.stats["rebuilds"], 0)
+
+
 if __name__ == "__main__":
     enable_logging()
     unittest.main()
@@ -32,6 +32,8 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 #
 
+import itertools
+import re
 import unittest
 from test.server.server_test_lib import create_node, enable_logging, random_string
 from unittest.mock import Mock
@@ -44,6 +46,7 @@ from ztpserver.topology import (
     InterfacePattern,
     InterfacePatternError,
     Neighbor,
+    Neighbordb,
     Node,
     NodeError,
     Pattern,
@@ -213,6 +216,10 @@ class FunctionsUnitTests(unittest.TestCase):
         func = RegexFunction(value)
         self.assertFalse(func.match(random_string()))
 
+    def test_regexfunction_invalid(self):
+        func = RegexFunction("[")
+        self.assertRaises(re.error, func.match, random_string())
+
 
 class TestPattern(unittest.TestCase):
     def test_create_pattern_with_defaults(self):
@@ -238,6 +245,46 @@ class TestPattern(unittest.TestCase):
         self.assertEqual(len(obj.interfaces), 1)
 
 
+class NeighbordbMatchUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.neighbordb = Neighbordb(random_string())
+        for index in range(4):
+            self.neighbordb.add_pattern(
+                f"pattern{index}",
+                definition=random_string(),
+                interfaces=[{"any": "any:any"}],
+            )
+        self.patterns = self.neighbordb.patterns["globals"]
+        self.node = Mock(model=random_string(), neighbors={})
+
+    def mock_patterns(self, results):
+        for pattern, result in zip(self.patterns, results):
+            pattern.match_node = Mock(return_value=result)
+
+    def test_first_match(self):
+        self.mock_patterns([False, True, True, False])
+        self.assertIs(self.neighbordb.first_match(self.node), self.patterns[1])
+
+        # stops at the first match
+        self.assertFalse(self.patterns[2].match_node.called)
+        self.assertFalse(self.patterns[3].match_node.called)
+
+    def test_first_match_none(self):
+        self.mock_patterns([False, False, False, False])
+        self.assertIsNone(self.neighbordb.first_match(self.node))
+
+    def test_match_node(self):
+        self.mock_patterns([False, True, True, False])
+        self.assertEqual(self.neighbordb.match_node(self.node), self.patterns[1:3])
+
+    def test_iter_matches(self):
+        self.mock_patterns([True, False, True, True])
+        matches = self.neighbordb.iter_matches(self.node)
+        self.assertIs(next(matches), self.patterns[0])
+        self.assertFalse(self.patterns[1].match_node.called)
+        self.assertEqual(list(matches), [self.patterns[2], self.patterns[3]])
+
+
 class PatternUnitTests(unittest.TestCase):
     def test_create_pattern(self):
         pattern = Pattern(random_string())
@@ -267,6 +314,46 @@ class PatternUnitTests(unittest.TestCase):
         pattern = Pattern(**kwargs)
         self.assertRaises(PatternError, pattern.add_interface, random_string())
 
+    def test_interface_dispatch(self):
+        pattern = Pattern(
+            random_string(),
+            interfaces=[
+                {"Ethernet1": "spine1:Ethernet1"},
+                {"any": "spine2:any"},
+                {"Ethernet2": "spine3:any"},
+                {"Ethernet1": "spine3:any"},
+                {"none": "none"},
+            ],
+        )
+
+        self.assertEqual(pattern.wildcard_patterns, [1, 4])
+        self.assertEqual(
+            pattern.interface_dispatch,
+            {"Ethernet1": [0, 1, 3, 4], "Ethernet2": [1, 2, 4]},
+        )
+
+    def test_match_node_interface_dispatch(self):
+        pattern = Pattern(
+            random_string(),
+            interfaces=[{"Ethernet2": "spine1:Ethernet1"}, {"any": "spine2:any"}],
+        )
+
+        node = Node(
+            neighbors={
+                "Ethernet1": [{"device": "spine2", "port": "Ethernet1"}],
+                "Ethernet2": [{"device": "spine1", "port": "Ethernet1"}],
+            }
+        )
+        self.assertTrue(pattern.match_node(node))
+
+        node = Node(
+            neighbors={
+                "Ethernet1": [{"device": "spine1", "port": "Ethernet1"}],
+                "Ethernet2": [{"device": "spine2", "port": "Ethernet1"}],
+            }
+        )
+        self.assertFalse(pattern.match_node(node))
+
 
 class TestInterfacePattern(unittest.TestCase):
     def test_create_interface_pattern(self):
@@ -346,6 +433,21 @@ class TestInterfacePattern(unittest.TestCase):
                     result = pattern.match(interface, [neighbor])
                     self.assertFalse(result)
 
+    def test_match_rules(self):
+        kinds = ["any", "none", "value"]
+        self.assertEqual(
+            set(InterfacePattern.MATCH_RULES), set(itertools.product(kinds, kinds, kinds))
+        )
+
+    def test_refresh_updates_rule(self):
+        pattern = InterfacePattern("any", "$device", "any", random_string())
+        self.assertEqual(pattern.rule, InterfacePattern.MATCH_RULES[("any", "value", "any")])
+
+        pattern.remote_device = "any"
+        pattern.refresh()
+        self.assertEqual(pattern.rule, InterfacePattern.MATCH_RULES[("any", "any", "any")])
+        self.assertTrue(pattern.match(random_string(), [Neighbor("spine", "Ethernet1")]))
+
     def compile_known_function(self, interface, cls):
         pattern = InterfacePattern(random_string(), interface, random_string(), random_string())
         self.assertIsInstance(pattern.remote_device_re, cls)
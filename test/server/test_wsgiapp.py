@@ -38,7 +38,8 @@ import unittest
 import routes
 import webob
 
-from ztpserver.wsgiapp import WSGIController, WSGIRouter
+from ztpserver.controller import Router
+from ztpserver.wsgiapp import RouteDispatcher, WSGIController, WSGIRouter
 
 
 class TestWsgiApp(unittest.TestCase):
@@ -108,6 +109,48 @@ class TestWsgiApp(unittest.TestCase):
     def test_delete_url_missing(self):
         self.delete_url("/missing", 404)
 
+    def test_controller_reused(self):
+        self.get_url("/tests", 204)
+        controller = self.router.controllers[WSGIController]
+        self.post_url("/tests", 204)
+        self.assertIs(self.router.controllers[WSGIController], controller)
+
+
+class TestRouteDispatcher(unittest.TestCase):
+    URLS = [
+        "/",
+        "/bootstrap",
+        "/bootstrap/",
+        "/bootstrap/config",
+        "/bootstrapx",
+        "/meta/files/images/vEOS.swi",
+        "/meta/nodes/abc/pattern",
+        "/meta/other/file",
+        "/nodes",
+        "/nodes.json",
+        "/nodes/abc",
+        "/nodes/abc.json",
+        "/nodes/abc/startup-config",
+        "/nodes/abc/other",
+        "/actions/install_image",
+        "/actions/a/b",
+        "/files/images/vEOS.swi",
+        "/files/a.b/c.d",
+        "/files",
+        "/missing/path",
+    ]
+
+    def test_match(self):
+        mapper = Router().map
+        dispatcher = RouteDispatcher(mapper)
+
+        for url in self.URLS:
+            for method in ["GET", "HEAD", "POST", "PUT", "DELETE"]:
+                environ = {"PATH_INFO": url, "REQUEST_METHOD": method}
+                expected = mapper.routematch(environ=environ)
+                expected = tuple(expected) if expected else (None, None)
+                self.assertEqual(dispatcher.match(environ), expected, f"{method} {url}")
+
 
 if __name__ == "__main__":
     unittest.main()
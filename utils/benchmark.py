@@ -0,0 +1,1017 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Micro-benchmarks for ztpserver.
+
+Usage:
+    python utils/benchmark.py <benchmark> [options]
+
+Run 'python utils/benchmark.py -h' for the list of available benchmarks.
+"""
+
+import argparse
+import collections.abc
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import webob
+import webob.dec
+import webob.exc
+from routes.middleware import RoutesMiddleware
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=C0413
+from ztpserver import config  # noqa: E402
+
+BOOTSTRAP = "#!/usr/bin/env python\nSERVER = '$SERVER'\n"
+
+
+def create_data_root(big_file_size=0):
+    """Creates a minimal data_root in a temporary folder"""
+
+    data_root = tempfile.mkdtemp(prefix="ztps-benchmark-")
+    for folder in ("bootstrap", "files", "actions", "nodes", "resources"):
+        os.makedirs(os.path.join(data_root, folder))
+
+    with open(os.path.join(data_root, "bootstrap", "bootstrap"), "w") as fhandler:
+        fhandler.write(BOOTSTRAP)
+
+    if big_file_size:
+        chunk = os.urandom(1024 * 1024)
+        with open(os.path.join(data_root, "files", "big"), "wb") as fhandler:
+            for _ in range(big_file_size):
+                fhandler.write(chunk)
+
+    config.runtime.set_value("data_root", data_root, "default")
+    return data_root
+
+
+def report(title, rows):
+    print(f"\n{title}")
+    width = max(len(row[0]) for row in rows)
+    for name, value in rows:
+        print(f"  {name:<{width}}  {value}")
+
+
+# -- server -----------------------------------------------------------------
+
+
+def serve(mode, port, threads, workers, sendfile=True):
+    from ztpserver import asgi, httpd  # pylint: disable=C0415
+    from ztpserver.controller import Router  # pylint: disable=C0415
+
+    # discard the access log
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+
+    if mode == "asyncio":
+        server = asgi.make_server(
+            "127.0.0.1",
+            port,
+            asgi.ASGIApplication(Router(), threads=threads),
+            backlog=1024,
+            sendfile=sendfile,
+        )
+    else:
+        server = httpd.make_server(
+            "127.0.0.1",
+            port,
+            Router(),
+            mode=mode,
+            threads=threads,
+            workers=workers,
+            backlog=1024,
+            sendfile=sendfile,
+        )
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def slow_download(port, stop, rate):
+    """Downloads /files/big at roughly ``rate`` bytes per second"""
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    try:
+        conn.request("GET", "/files/big")
+        resp = conn.getresponse()
+        while not stop.is_set():
+            if not resp.read(65536):
+                break
+            time.sleep(65536.0 / rate)
+    except (OSError, http.client.HTTPException):
+        pass
+    finally:
+        conn.close()
+
+
+def idle_connection(port, stop):
+    """Opens a persistent connection and leaves it idle"""
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    try:
+        while not stop.is_set():
+            conn.request("GET", "/bootstrap")
+            conn.getresponse().read()
+            stop.wait(4)
+    except (OSError, http.client.HTTPException):
+        pass
+    finally:
+        conn.close()
+
+
+def fast_requests(port, stop, latencies, keepalive):
+    conn = None
+    while not stop.is_set():
+        start = time.time()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            conn.request("GET", "/bootstrap")
+            resp = conn.getresponse()
+            resp.read()
+            if not keepalive or resp.will_close:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            if conn is not None:
+                conn.close()
+            conn = None
+            continue
+        if not stop.is_set():
+            latencies.append(time.time() - start)
+    if conn is not None:
+        conn.close()
+
+
+def bench_server(args):
+    data_root = create_data_root(big_file_size=args.file_size)
+    rows = []
+    try:
+        for mode in args.modes:
+            port = free_port()
+            server = multiprocessing.Process(
+                target=serve, args=(mode, port, args.threads, args.workers)
+            )
+            server.start()
+            wait_for_port(port)
+
+            stop = threading.Event()
+            latencies = []
+            clients = [
+                threading.Thread(target=slow_download, args=(port, stop, args.rate))
+                for _ in range(args.slow_clients)
+            ]
+            clients.extend(
+                threading.Thread(target=idle_connection, args=(port, stop))
+                for _ in range(args.idle_clients)
+            )
+            clients.extend(
+                threading.Thread(
+                    target=fast_requests, args=(port, stop, latencies, mode != "single")
+                )
+                for _ in range(args.clients)
+            )
+            for client in clients:
+                client.daemon = True
+                client.start()
+
+            time.sleep(args.duration)
+            stop.set()
+
+            os.kill(server.pid, signal.SIGTERM)
+            server.join()
+            for client in clients:
+                client.join(5)
+
+            latencies.sort()
+            if latencies:
+                p50 = latencies[len(latencies) // 2] * 1000
+                p99 = latencies[int(len(latencies) * 0.99)] * 1000
+                rows.append(
+                    (
+                        mode,
+                        f"{len(latencies) / args.duration:8.1f} req/s  "
+                        f"p50={p50:.1f}ms  p99={p99:.1f}ms",
+                    )
+                )
+            else:
+                rows.append((mode, "       0 req/s  (no request completed)"))
+    finally:
+        shutil.rmtree(data_root)
+
+    report(
+        f"GET /bootstrap with {args.clients} clients while {args.slow_clients} slow clients "
+        f"stream a {args.file_size}MB file and {args.idle_clients} connections are idle "
+        f"({args.duration}s)",
+        rows,
+    )
+
+
+# -- sendfile ---------------------------------------------------------------
+
+
+def download(port, count, totals):
+    """Downloads /files/big ``count`` times over a single connection"""
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    try:
+        for _ in range(count):
+            conn.request("GET", "/files/big")
+            resp = conn.getresponse()
+            while True:
+                data = resp.read(1024 * 1024)
+                if not data:
+                    break
+                totals.append(len(data))
+            if resp.will_close:
+                conn.close()
+    finally:
+        conn.close()
+
+
+def bench_sendfile(args):
+    data_root = create_data_root(big_file_size=args.file_size)
+    rows = []
+    try:
+        for mode in args.modes:
+            for sendfile in (False, True):
+                port = free_port()
+                server = multiprocessing.Process(
+                    target=serve, args=(mode, port, args.threads, args.workers, sendfile)
+                )
+                server.start()
+                wait_for_port(port)
+
+                totals = []
+                clients = [
+                    threading.Thread(target=download, args=(port, args.downloads, totals))
+                    for _ in range(args.clients)
+                ]
+                start = time.time()
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                elapsed = time.time() - start
+
+                os.kill(server.pid, signal.SIGTERM)
+                server.join()
+
+                rows.append(
+                    (
+                        f"{mode} sendfile={'on' if sendfile else 'off'}",
+                        f"{sum(totals) / elapsed / 1024 / 1024:8.1f} MB/s",
+                    )
+                )
+    finally:
+        shutil.rmtree(data_root)
+
+    report(
+        f"GET /files/big ({args.file_size}MB) downloaded {args.downloads} times by each of "
+        f"{args.clients} clients",
+        rows,
+    )
+
+
+# -- dispatch ---------------------------------------------------------------
+
+
+class LegacyRouter:
+    """Request dispatch as done by WSGIRouter prior to RouteDispatcher"""
+
+    def __init__(self, mapper):
+        self.router = RoutesMiddleware(self.route, mapper)
+
+    @webob.dec.wsgify
+    def __call__(self, request):
+        return self.router
+
+    @webob.dec.wsgify
+    def route(self, request):
+        if "controller" not in request.urlvars:
+            return webob.exc.HTTPNotFound()
+        return request.urlvars["controller"]()
+
+
+def time_requests(app, url, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        webob.Request.blank(url).get_response(app)
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_dispatch(args):
+    from ztpserver.controller import Router  # pylint: disable=C0415
+
+    data_root = create_data_root()
+    with open(os.path.join(data_root, "actions", "test"), "w") as fhandler:
+        fhandler.write("#!/usr/bin/env python\n")
+
+    try:
+        rows = []
+        for url in ["/bootstrap", "/actions/test", "/meta/actions/test", "/missing"]:
+            legacy = time_requests(LegacyRouter(Router().map), url, args.iterations)
+            current = time_requests(Router(), url, args.iterations)
+            rows.append(
+                (
+                    url,
+                    f"legacy={legacy * 1e6:7.1f}us  current={current * 1e6:7.1f}us  "
+                    f"(saved {(legacy - current) * 1e6:.1f}us)",
+                )
+            )
+    finally:
+        shutil.rmtree(data_root)
+
+    report(f"Per-request time, including the controller ({args.iterations} requests)", rows)
+
+
+# -- neighbordb -------------------------------------------------------------
+
+
+def generate_neighbordb(patterns):
+    """Returns the contents of a neighbordb with the given number of
+    global patterns, one per (leaf) switch and a catch-all pattern"""
+
+    result = {"variables": {"oob": "regex('oob\\d*')"}, "patterns": []}
+    for index in range(patterns):
+        result["patterns"].append(
+            {
+                "name": f"leaf{index}",
+                "definition": "leaf",
+                "model": "DCS-7050" if index % 2 else "vEOS",
+                "interfaces": [
+                    {"Ethernet1": f"spine{index % 8}:Ethernet{index}"},
+                    {"Ethernet2": f"spine{index % 8 + 8}:Ethernet{index}"},
+                    {"Management1": "$oob:any"},
+                ],
+            }
+        )
+    result["patterns"].append(
+        {"name": "default", "definition": "default", "interfaces": [{"any": "any:any"}]}
+    )
+    return result
+
+
+def write_neighbordb(data_root, patterns):
+    from ztpserver.constants import CONTENT_TYPE_YAML  # pylint: disable=C0415
+    from ztpserver.serializers import dump  # pylint: disable=C0415
+
+    filename = os.path.join(data_root, "neighbordb")
+    dump(generate_neighbordb(patterns), filename, CONTENT_TYPE_YAML)
+    return filename
+
+
+def bench_neighbordb(args):
+    from ztpserver import topology  # pylint: disable=C0415
+    from ztpserver.utils import file_signature  # pylint: disable=C0415
+
+    data_root = create_data_root()
+    try:
+        filename = write_neighbordb(data_root, args.patterns)
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            topology.compile_neighbordb("benchmark")
+        uncached = (time.perf_counter() - start) / args.iterations
+
+        cache = topology.NeighbordbCache()
+        cache.get("benchmark")
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            cache.get("benchmark")
+        cached = (time.perf_counter() - start) / args.iterations
+
+        # ztps --compile-neighbordb, then a restart (new cache)
+        signature = file_signature(filename)
+        topology.write_snapshot(topology.compile_neighbordb("benchmark"), signature)
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            topology.NeighbordbCache().get("benchmark")
+        snapshot = (time.perf_counter() - start) / args.iterations
+    finally:
+        shutil.rmtree(data_root)
+
+    report(
+        f"load_neighbordb with {args.patterns} patterns ({args.iterations} iterations)",
+        [
+            ("uncached", f"{uncached * 1e3:10.3f}ms"),
+            ("cached", f"{cached * 1e3:10.3f}ms"),
+            ("snapshot", f"{snapshot * 1e3:10.3f}ms"),
+        ],
+    )
+
+
+# -- match ------------------------------------------------------------------
+
+
+def generate_node_attributes(index):
+    """Returns the attributes (as sent by the bootstrap client) of a node
+    matching pattern leaf<index> of generate_neighbordb"""
+
+    return {
+        "model": "DCS-7050" if index % 2 else "vEOS",
+        "serialnumber": f"SN{index:08d}",
+        "systemmac": f"00:1c:73:{index // 65536 % 256:02x}:{index // 256 % 256:02x}:"
+        f"{index % 256:02x}",
+        "neighbors": {
+            "Ethernet1": [{"device": f"spine{index % 8}", "port": f"Ethernet{index}"}],
+            "Ethernet2": [{"device": f"spine{index % 8 + 8}", "port": f"Ethernet{index}"}],
+            "Management1": [{"device": "oob", "port": f"Ethernet{index}"}],
+        },
+    }
+
+
+def generate_node(index):
+    """Returns a node matching pattern leaf<index> of generate_neighbordb"""
+
+    from ztpserver.topology import create_node  # pylint: disable=C0415
+
+    return create_node(generate_node_attributes(index))
+
+
+def bench_match(args):
+    from ztpserver import topology  # pylint: disable=C0415
+
+    neighbordb = topology.compile_neighbordb("benchmark", generate_neighbordb(args.patterns))
+    nodes = [generate_node(index) for index in range(0, args.patterns, args.patterns // 10)]
+
+    start = time.perf_counter()
+    expected = [
+        [p.name for p in neighbordb.patterns["globals"] if p.match_node(node)] for node in nodes
+    ]
+    brute_force = (time.perf_counter() - start) / len(nodes)
+
+    start = time.perf_counter()
+    first = [
+        next((p.name for p in neighbordb.patterns["globals"] if p.match_node(node)), None)
+        for node in nodes
+    ]
+    brute_force_first = (time.perf_counter() - start) / len(nodes)
+    assert first == [names[0] for names in expected]
+
+    start = time.perf_counter()
+    result = [[p.name for p in neighbordb.match_node(node)] for node in nodes]
+    indexed = (time.perf_counter() - start) / len(nodes)
+    assert result == expected
+
+    start = time.perf_counter()
+    result = [neighbordb.first_match(node).name for node in nodes]
+    indexed_first = (time.perf_counter() - start) / len(nodes)
+    assert result == first
+
+    report(
+        f"Neighbordb matching with {args.patterns} patterns (per node)",
+        [
+            ("brute force, all matches", f"{brute_force * 1e3:10.3f}ms"),
+            ("brute force, first match", f"{brute_force_first * 1e3:10.3f}ms"),
+            ("indexed, all matches", f"{indexed * 1e3:10.3f}ms"),
+            ("indexed, first match", f"{indexed_first * 1e3:10.3f}ms"),
+        ],
+    )
+
+
+def bench_match_nodes(args):
+    data_root = create_data_root()
+    try:
+        write_neighbordb(data_root, args.patterns)
+        filename = os.path.join(data_root, "nodes.jsonl")
+        with open(filename, "w", encoding="utf8") as fd:
+            for index in range(args.nodes):
+                fd.write(json.dumps(generate_node_attributes(index % args.patterns)) + "\n")
+
+        env = dict(
+            os.environ,
+            ZTPS_CONFIG=os.path.join(data_root, "missing.conf"),
+            ZTPS_DEFAULT_DATAROOT=data_root,
+        )
+        rows = []
+        for processes in args.processes:
+            start = time.perf_counter()
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "from ztpserver.app import main; main()",
+                    "--match-nodes",
+                    filename,
+                    "--processes",
+                    str(processes),
+                ],
+                cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."),
+                env=env,
+                stdout=subprocess.DEVNULL,
+                check=False,
+            )
+            rows.append((f"{processes} process(es)", f"{time.perf_counter() - start:10.3f}s"))
+    finally:
+        shutil.rmtree(data_root)
+
+    report(f"ztps --match-nodes: {args.nodes} nodes, {args.patterns} patterns", rows)
+
+
+# -- definitions ------------------------------------------------------------
+
+
+def write_node(data_root, node_id, actions):
+    """Writes a provisioned node with a definition of the given number of
+    actions (with variables substituted from the node's attributes)"""
+
+    from ztpserver.constants import (  # pylint: disable=C0415
+        CONTENT_TYPE_JSON,
+        CONTENT_TYPE_YAML,
+    )
+    from ztpserver.serializers import dump  # pylint: disable=C0415
+
+    folder = os.path.join(data_root, "nodes", node_id)
+    os.makedirs(folder)
+
+    node = generate_node_attributes(1)
+    node["serialnumber"] = node_id
+    dump(node, os.path.join(folder, ".node"), CONTENT_TYPE_JSON)
+    dump(
+        {"interfaces": [{"Ethernet1": "spine1:Ethernet1"}, {"Management1": "any"}]},
+        os.path.join(folder, "pattern"),
+        CONTENT_TYPE_YAML,
+    )
+    dump(
+        {
+            "name": "benchmark",
+            "attributes": {"ntp": "10.0.0.1"},
+            "actions": [
+                {
+                    "name": f"action {index}",
+                    "action": "add_config",
+                    "attributes": {
+                        "url": f"files/templates/template{index}",
+                        "variables": {"hostname": "$hostname", "ntp": "$ntp", "index": index},
+                    },
+                }
+                for index in range(actions)
+            ],
+        },
+        os.path.join(folder, "definition"),
+        CONTENT_TYPE_YAML,
+    )
+    dump({"hostname": node_id}, os.path.join(folder, "attributes"), CONTENT_TYPE_YAML)
+
+
+def bench_definition(args):
+    from ztpserver import controller  # pylint: disable=C0415
+
+    data_root = create_data_root()
+    try:
+        write_node(data_root, "SN00000001", args.actions)
+        app = controller.Router()
+        url = "/nodes/SN00000001"
+        response = webob.Request.blank(url).get_response(app)
+        assert response.status_int == 200, response
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            controller.definition_cache.invalidate()
+            webob.Request.blank(url).get_response(app)
+        uncached = (time.perf_counter() - start) / args.iterations
+
+        cached = time_requests(app, url, args.iterations)
+    finally:
+        shutil.rmtree(data_root)
+
+    report(
+        f"GET /nodes/{{id}} with {args.actions} actions ({args.iterations} requests)",
+        [("uncached", f"{uncached * 1e6:10.1f}us"), ("cached", f"{cached * 1e6:10.1f}us")],
+    )
+
+
+def bench_meta(args):
+    from ztpserver import controller, repository  # pylint: disable=C0415
+
+    data_root = create_data_root(big_file_size=args.file_size)
+    try:
+        app = controller.Router()
+        url = "/meta/files/big"
+
+        start = time.perf_counter()
+        response = webob.Request.blank(url).get_response(app)
+        uncached = time.perf_counter() - start
+        assert response.status_int == 200, response
+
+        cached = time_requests(app, url, args.iterations)
+
+        # A restarted server only has the sidecar file
+        repository.DIGEST_CACHES.clear()
+        app = controller.Router()
+        start = time.perf_counter()
+        webob.Request.blank(url).get_response(app)
+        restarted = time.perf_counter() - start
+
+        # With prehash, a new file is hashed in the background
+        os.remove(os.path.join(data_root, ".ztps", "digests.json"))
+        repository.DIGEST_CACHES.clear()
+        config.runtime.set_value("prehash", True, "repository")
+        app = controller.Router()
+        start = time.perf_counter()
+        response = webob.Request.blank(url).get_response(app)
+        pending = time.perf_counter() - start
+        assert response.json["pending"], response.json
+        while "pending" in webob.Request.blank(url).get_response(app).json:
+            time.sleep(0.01)
+        ready = time.perf_counter() - start
+    finally:
+        config.runtime.set_value("prehash", False, "repository")
+        for cache in repository.DIGEST_CACHES.values():
+            if cache.worker:
+                cache.worker.stop()
+        shutil.rmtree(data_root)
+
+    report(
+        f"GET /meta/files/{{file}} for a {args.file_size}MB file",
+        [
+            ("uncached", f"{uncached * 1e3:10.1f}ms"),
+            ("cached", f"{cached * 1e3:10.3f}ms"),
+            ("after restart", f"{restarted * 1e3:10.3f}ms"),
+            ("prehash (pending)", f"{pending * 1e3:10.3f}ms"),
+            ("prehash (sha1/sha256/md5 ready)", f"{ready * 1e3:10.1f}ms"),
+        ],
+    )
+
+
+def bench_patterns(args):
+    import yaml  # pylint: disable=C0415
+
+    from ztpserver import topology  # pylint: disable=C0415
+
+    filename = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "test", "neighbordb", args.fixture
+    )
+    with open(filename, encoding="utf8") as fd:
+        contents = yaml.safe_load(fd)
+
+    neighbordb = topology.compile_neighbordb("benchmark", contents["neighbordb"])
+    patterns = neighbordb.patterns["globals"] + list(neighbordb.patterns["nodes"].values())
+    nodes = [
+        topology.create_node(contents[entry["name"]]) for entry in contents["nodes"].get("pass", [])
+    ]
+
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        for node in nodes:
+            for pattern in patterns:
+                pattern.match_node(node)
+    elapsed = (time.perf_counter() - start) / (args.iterations * len(nodes) * len(patterns))
+
+    report(
+        f"Pattern matching on {args.fixture} ({len(patterns)} patterns, {len(nodes)} nodes)",
+        [("per pattern", f"{elapsed * 1e6:10.3f}us")],
+    )
+
+
+# -- serializers ------------------------------------------------------------
+
+
+def convert_from_unicode(data):
+    """Deep copy done by Serializer.deserialize on every load prior to the
+    selectable backends"""
+
+    if isinstance(data, str):
+        return str(data)
+    if isinstance(data, collections.abc.Mapping):
+        return dict([convert_from_unicode(x) for x in data.items()])
+    if isinstance(data, collections.abc.Iterable):
+        return type(data)([convert_from_unicode(x) for x in data])
+    return data
+
+
+def bench_serializers(args):
+    import glob  # pylint: disable=C0415
+
+    import yaml  # pylint: disable=C0415
+
+    from ztpserver import serializers  # pylint: disable=C0415
+    from ztpserver.constants import (  # pylint: disable=C0415
+        CONTENT_TYPE_JSON,
+        CONTENT_TYPE_YAML,
+    )
+
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test", "neighbordb")
+    documents = []
+    for filename in sorted(glob.glob(os.path.join(folder, "*.yml"))):
+        with open(filename, encoding="utf8") as fd:
+            documents.append(fd.read())
+    generated = yaml.safe_dump(generate_neighbordb(args.patterns), default_flow_style=False)
+
+    def timed(func, contents, iterations):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for data in contents:
+                func(data)
+        return (time.perf_counter() - start) / iterations * 1000
+
+    def loads(content_type):
+        return lambda data: serializers.loads(data, content_type, "benchmark")
+
+    rows = []
+    for name, fixtures, iterations in [
+        (f"test/neighbordb ({len(documents)} files)", documents, args.iterations),
+        (f"neighbordb ({args.patterns} patterns)", [generated], 3),
+    ]:
+        legacy = timed(
+            lambda data: convert_from_unicode(yaml.safe_load(data)), fixtures, iterations
+        )
+        rows.append((f"{name}: safe_load + copy", f"{legacy:10.2f}ms"))
+        for backend in serializers.YAML_BACKENDS:
+            config.runtime.set_value("yaml", backend, "serializers")
+            elapsed = timed(loads(CONTENT_TYPE_YAML), fixtures, iterations)
+            rows.append((f"{name}: {backend}", f"{elapsed:10.2f}ms  x{legacy / elapsed:.1f}"))
+
+    contents = [json.dumps(yaml.safe_load(generated))]
+    legacy = timed(lambda data: convert_from_unicode(json.loads(data)), contents, args.iterations)
+    name = f"neighbordb as JSON ({args.patterns} patterns)"
+    rows.append((f"{name}: json + copy", f"{legacy:10.2f}ms"))
+    for backend in serializers.JSON_BACKENDS:
+        config.runtime.set_value("json", backend, "serializers")
+        elapsed = timed(loads(CONTENT_TYPE_JSON), contents, args.iterations)
+        rows.append((f"{name}: {backend}", f"{elapsed:10.2f}ms  x{legacy / elapsed:.1f}"))
+
+    report("Deserialization time (per load of all the documents)", rows)
+
+
+def legacy_allocate(filename, node_id):
+    """Allocation as done by the allocate plugin prior to ResourcePool: the
+    pool file is loaded, scanned and written for every allocation"""
+
+    from ztpserver.constants import CONTENT_TYPE_YAML  # pylint: disable=C0415
+    from ztpserver.serializers import dump, file_lock, load  # pylint: disable=C0415
+
+    with file_lock(filename):
+        data = load(filename, CONTENT_TYPE_YAML, node_id, lock=True)
+        match = next((k for k, v in data.items() if v == node_id), None)
+        if match:
+            return match
+        entry = next(k for k, v in data.items() if v is None)
+        data[entry] = node_id
+        dump(data, filename, CONTENT_TYPE_YAML, node_id, lock=True)
+    return entry
+
+
+def bench_allocate(args):
+    from ztpserver import resources  # pylint: disable=C0415
+    from ztpserver.constants import CONTENT_TYPE_YAML  # pylint: disable=C0415
+    from ztpserver.serializers import dump  # pylint: disable=C0415
+
+    folder = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(folder, "pool")
+        pool = {f"10.{i // 65536}.{i // 256 % 256}.{i % 256}/32": None for i in range(args.size)}
+
+        def timed(func, count):
+            dump(pool, filename, CONTENT_TYPE_YAML)
+            start = time.perf_counter()
+            for index in range(count):
+                func(f"node{index}")
+            return (time.perf_counter() - start) / count * 1000
+
+        legacy = timed(lambda node_id: legacy_allocate(filename, node_id), args.legacy_iterations)
+        rows = [("load + scan + dump", f"{legacy:10.3f}ms")]
+
+        engine = resources.ResourcePool(filename)
+        elapsed = timed(engine.allocate, args.iterations)
+        rows.append(
+            ("ResourcePool (first load included)", f"{elapsed:10.3f}ms  x{legacy / elapsed:.0f}")
+        )
+        start = time.perf_counter()
+        for index in range(args.iterations):
+            engine.lookup(f"node{index}")
+        elapsed = (time.perf_counter() - start) / args.iterations * 1000
+        rows.append(("ResourcePool lookup", f"{elapsed:10.3f}ms  x{legacy / elapsed:.0f}"))
+        report(f"Allocation time ({args.size} entries pool, per allocation)", rows)
+    finally:
+        shutil.rmtree(folder)
+
+
+def legacy_assign_resource(db_url, node_id, table):
+    """Allocation as done by the sqlite plugin prior to connection pooling:
+    a new connection, an unindexed lookup and SELECT-then-UPDATE"""
+
+    import sqlite3  # pylint: disable=C0415
+
+    con = sqlite3.connect(db_url)
+    with con:
+        cur = con.cursor()
+        match = cur.execute(f"SELECT * FROM `{table}` WHERE node_id='{node_id}'").fetchone()
+        if match:
+            return match[0]
+        cur.execute(
+            f"UPDATE `{table}` SET node_id = '{node_id}' WHERE key IN "
+            f"(SELECT key FROM `{table}` WHERE node_id IS NULL ORDER BY rowid ASC LIMIT 1)"
+        )
+        if cur.rowcount == 1:
+            query = f"SELECT * FROM `{table}` WHERE node_id='{node_id}'"
+            return cur.execute(query).fetchone()[0]
+    raise RuntimeError("Resource not found")
+
+
+def bench_sqlite(args):
+    import importlib.machinery  # pylint: disable=C0415
+    import importlib.util  # pylint: disable=C0415
+    import sqlite3  # pylint: disable=C0415
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins", "sqlite")
+    loader = importlib.machinery.SourceFileLoader("sqlite_plugin", path)
+    plugin = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(plugin)
+
+    folder = tempfile.mkdtemp()
+    try:
+        plugin.DB_URL = os.path.join(folder, "resources.db")
+
+        def timed(func, count):
+            # utils/create_db.py tables, scaled to args.rows entries
+            if os.path.exists(plugin.DB_URL):
+                os.remove(plugin.DB_URL)
+            con = sqlite3.connect(plugin.DB_URL)
+            with con:
+                con.execute("CREATE TABLE `mgmt_subnet`(key TEXT, node_id TEXT)")
+                con.executemany(
+                    "INSERT INTO `mgmt_subnet` VALUES(?, NULL)",
+                    [
+                        (f"172.{i // 65536}.{i // 256 % 256}.{i % 256}/24",)
+                        for i in range(args.rows)
+                    ],
+                )
+            con.close()
+
+            start = time.perf_counter()
+            for index in range(count):
+                func(f"node{index}")
+            return (time.perf_counter() - start) / count * 1000
+
+        legacy = timed(
+            lambda node_id: legacy_assign_resource(plugin.DB_URL, node_id, "mgmt_subnet"),
+            args.iterations,
+        )
+        rows = [("connect + unindexed SELECT/UPDATE", f"{legacy:10.3f}ms")]
+        elapsed = timed(lambda node_id: plugin.main(node_id, "mgmt_subnet", None), args.iterations)
+        rows.append(
+            ("pooled + indexed + BEGIN IMMEDIATE", f"{elapsed:10.3f}ms  x{legacy / elapsed:.0f}")
+        )
+        report(f"sqlite allocation time ({args.rows} rows, per allocation)", rows)
+    finally:
+        shutil.rmtree(folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    server = subparsers.add_parser("server", help="standalone server throughput")
+    server.add_argument(
+        "--modes",
+        nargs="+",
+        default=["single", "threaded", "prefork", "asyncio"],
+        choices=["single", "threaded", "prefork", "asyncio"],
+    )
+    server.add_argument("--duration", type=float, default=5)
+    server.add_argument("--clients", type=int, default=8)
+    server.add_argument("--slow-clients", type=int, default=2)
+    server.add_argument("--idle-clients", type=int, default=0)
+    server.add_argument("--file-size", type=int, default=64, help="MB")
+    server.add_argument("--rate", type=int, default=4 * 1024 * 1024, help="bytes/s per client")
+    server.add_argument("--threads", type=int, default=16)
+    server.add_argument("--workers", type=int, default=2)
+    server.set_defaults(func=bench_server)
+
+    sendfile = subparsers.add_parser("sendfile", help="file download throughput")
+    sendfile.add_argument(
+        "--modes",
+        nargs="+",
+        default=["single", "threaded", "asyncio"],
+        choices=["single", "threaded", "prefork", "asyncio"],
+    )
+    sendfile.add_argument("--clients", type=int, default=4)
+    sendfile.add_argument("--downloads", type=int, default=4)
+    sendfile.add_argument("--file-size", type=int, default=256, help="MB")
+    sendfile.add_argument("--threads", type=int, default=16)
+    sendfile.add_argument("--workers", type=int, default=2)
+    sendfile.set_defaults(func=bench_sendfile)
+
+    dispatch = subparsers.add_parser("dispatch", help="request dispatch overhead")
+    dispatch.add_argument("--iterations", type=int, default=5000)
+    dispatch.set_defaults(func=bench_dispatch)
+
+    neighbordb = subparsers.add_parser("neighbordb", help="neighbordb loading")
+    neighbordb.add_argument("--patterns", type=int, default=5000)
+    neighbordb.add_argument("--iterations", type=int, default=3)
+    neighbordb.set_defaults(func=bench_neighbordb)
+
+    match = subparsers.add_parser("match", help="matching nodes against neighbordb")
+    match.add_argument("--patterns", type=int, default=5000)
+    match.set_defaults(func=bench_match)
+
+    match_nodes = subparsers.add_parser("match-nodes", help="offline batch matching")
+    match_nodes.add_argument("--patterns", type=int, default=5000)
+    match_nodes.add_argument("--nodes", type=int, default=8000)
+    match_nodes.add_argument("--processes", type=int, nargs="+", default=[1, 4])
+    match_nodes.set_defaults(func=bench_match_nodes)
+
+    definition = subparsers.add_parser("definition", help="GET /nodes/{id}")
+    definition.add_argument("--actions", type=int, default=20)
+    definition.add_argument("--iterations", type=int, default=500)
+    definition.set_defaults(func=bench_definition)
+
+    meta = subparsers.add_parser("meta", help="GET /meta/files/{file}")
+    meta.add_argument("--file-size", type=int, default=1024, help="MB")
+    meta.add_argument("--iterations", type=int, default=1000)
+    meta.set_defaults(func=bench_meta)
+
+    patterns = subparsers.add_parser("patterns", help="matching a node against single patterns")
+    patterns.add_argument("--fixture", default="large_pattern_test.yml")
+    patterns.add_argument("--iterations", type=int, default=20000)
+    patterns.set_defaults(func=bench_patterns)
+
+    serializers = subparsers.add_parser("serializers", help="YAML/JSON deserialization")
+    serializers.add_argument("--patterns", type=int, default=5000)
+    serializers.add_argument("--iterations", type=int, default=20)
+    serializers.set_defaults(func=bench_serializers)
+
+    allocate = subparsers.add_parser("allocate", help="allocate() resource pools")
+    allocate.add_argument("--size", type=int, default=100000)
+    allocate.add_argument("--iterations", type=int, default=5000)
+    allocate.add_argument("--legacy-iterations", type=int, default=5)
+    allocate.set_defaults(func=bench_allocate)
+
+    sqlite = subparsers.add_parser("sqlite", help="sqlite() resource allocation")
+    sqlite.add_argument("--rows", type=int, default=100000)
+    sqlite.add_argument("--iterations", type=int, default=200)
+    sqlite.set_defaults(func=bench_sqlite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -33,20 +33,44 @@
 #
 
 import argparse
+import concurrent.futures
+import json
 import logging
+import multiprocessing
 import os
 import re
+import signal
 import sys
-from wsgiref.simple_server import make_server
 
-from ztpserver import config, controller
+from ztpserver import asgi, config, controller
 from ztpserver.constants import CONTENT_TYPE_YAML
-from ztpserver.resources import resource_plugins
-from ztpserver.serializers import dump, load
-from ztpserver.topology import FUNC_RE, neighbordb_path
-from ztpserver.utils import all_files
+from ztpserver.httpd import make_server
+from ztpserver.repository import start_prehash
+from ztpserver.resources import (
+    flush_resource_pools,
+    get_resource_pool,
+    plugin_cache,
+    resource_plugins,
+)
+from ztpserver.serializers import load
+from ztpserver.topology import (
+    FUNC_RE,
+    compile_neighbordb,
+    create_node,
+    load_neighbordb,
+    neighbordb_cache,
+    neighbordb_path,
+    write_snapshot,
+)
+from ztpserver.utils import all_files, file_signature
 from ztpserver.validators import NeighbordbValidator
 
+# Number of nodes handed to a --match-nodes worker process at a time
+MATCH_NODES_CHUNK_SIZE = 64
+
+# Default number of nodes whose resources are preallocated in parallel
+PREALLOCATE_THREADS = 8
+
 log = logging.getLogger("ztpserver")
 log.setLevel(logging.DEBUG)
 log.addHandler(logging.NullHandler())
@@ -133,9 +157,31 @@ def start_wsgiapp(config_file=None, debug=False):
     if not python_supported():
         raise SystemExit("ERROR: ZTPServer requires Python >= 3.6")
 
+    data_root = config.runtime.default.data_root
+    if config.runtime.repository.prehash and os.path.isdir(data_root):
+        # Before the server forks its workers, which share the digests
+        log.info("Hashing repository %s in the background", data_root)
+        start_prehash(data_root)
+
     return controller.Router()
 
 
+def start_asgiapp(config_file=None, debug=False):
+    """Provides the entry point into the application for asgi compliant
+    servers.   Accepts the same arguments as :py:func:`start_wsgiapp`.
+    Requests are run by the wsgi application in a pool of
+    ``[server] threads`` threads, while file downloads are streamed
+    without holding a thread.
+
+    :param config_file: string path pointing to configuration file
+    :param debug: boolean set debug level logging? (Default: False)
+    :return: an asgi application object
+
+    """
+    app = start_wsgiapp(config_file, debug)
+    return asgi.ASGIApplication(app, threads=config.runtime.server.threads)
+
+
 def run_server(version, config_file, debug):
     """The :py:func:`run_server` is called by the main command line routine to
     run the server as standalone.   This function accepts a single argument
@@ -145,21 +191,56 @@ def run_server(version, config_file, debug):
 
     :param config_file: string path pointing to configuration file
     """
-    app = start_wsgiapp(config_file, debug)
+    load_config(config_file)
 
     host = config.runtime.server.interface
     port = config.runtime.server.port
+    mode = config.runtime.server.mode
+
+    if mode == "asyncio":
+        httpd = asgi.make_server(
+            host,
+            port,
+            start_asgiapp(config_file, debug),
+            backlog=config.runtime.server.backlog,
+            keepalive_timeout=config.runtime.server.keepalive_timeout,
+            sendfile=config.runtime.server.sendfile,
+        )
+    else:
+        httpd = make_server(
+            host,
+            port,
+            start_wsgiapp(config_file, debug),
+            mode=mode,
+            workers=config.runtime.server.workers,
+            threads=config.runtime.server.threads,
+            backlog=config.runtime.server.backlog,
+            keepalive_timeout=config.runtime.server.keepalive_timeout,
+            sendfile=config.runtime.server.sendfile,
+        )
 
     log.info("URL: http://%s:%s", host, port)
 
-    httpd = make_server(host, port, app)
+    log.info("Starting ZTPServer v%s on http://%s:%s (mode: %s)", version, host, port, mode)
 
-    log.info("Starting ZTPServer v%s on http://%s:%s", version, host, port)
+    signal.signal(signal.SIGHUP, reload_neighbordb)
 
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         log.info("Shutdown...")
+    finally:
+        httpd.server_close()
+
+
+def reload_neighbordb(signum=None, frame=None):  # pylint: disable=W0613
+    """Forces neighbordb to be reloaded, and the resource plugins to be
+    run again, on the next request"""
+
+    log.info("Reloading neighbordb (%s)", neighbordb_cache)
+    neighbordb_cache.invalidate()
+    log.info("Dropping the cached resource plugin results (%s)", plugin_cache)
+    plugin_cache.invalidate()
 
 
 def validate_neighbordb():
@@ -276,15 +357,170 @@ def clear_resources(debug):
     for resource in all_files(os.path.join(data_root, "resources")):
         print(f"Clearing {resource}...")
         try:
-            contents = load(resource, CONTENT_TYPE_YAML, "clear_resource")
-            for key in contents:
-                contents[key] = "None"
-            dump(contents, resource, CONTENT_TYPE_YAML, "clear_resource")
+            get_resource_pool(resource).clear()
             print("Ok!")
         except Exception as exc:  # pylint: disable=W0703
             print(f"\nERROR: Failed to clear {resource}\n{exc}")
 
 
+def compile_neighbordb_snapshot(debug):
+    """Compiles neighbordb and saves the result to a snapshot, which the
+    server loads at startup instead of parsing neighbordb (for as long as
+    neighbordb does not change).  Returns the path of the snapshot."""
+
+    start_logging(debug)
+
+    path = neighbordb_path()
+    print(f"Compiling {path}...")
+
+    # Taken before reading the file: if neighbordb changes meanwhile, the
+    # snapshot is outdated and will not be used
+    signature = file_signature(path)
+    if signature is None:
+        sys.exit(f"ERROR: Unable to compile neighbordb ('{path}' not found)")
+
+    neighbordb = compile_neighbordb("compiler")
+    if neighbordb is None:
+        sys.exit(f"ERROR: Unable to compile neighbordb ('{path}')")
+
+    try:
+        filename = write_snapshot(neighbordb, signature)
+    except Exception as exc:  # pylint: disable=W0703
+        sys.exit(f"ERROR: Unable to save neighbordb snapshot: {exc}")
+
+    print(f"Ok! ({len(neighbordb.get_patterns())} pattern(s) saved to {filename})")
+    return filename
+
+
+def match_node_entry(entry):
+    """Matches a (line number, node JSON) entry from a --match-nodes file
+    against neighbordb and returns the result"""
+
+    lineno, line = entry
+    result = {"line": lineno}
+    try:
+        node = create_node(json.loads(line))
+        if not node:
+            raise ValueError("invalid node attributes")
+
+        node_id = node.identifier()
+        if not node_id:
+            raise ValueError(f"missing node identifier ({config.runtime.default.identifier})")
+        result["node"] = node_id
+
+        neighbordb = load_neighbordb(node_id)
+        if not neighbordb:
+            raise ValueError(f"unable to load neighbordb ({neighbordb_path()})")
+
+        matches = [pattern.name for pattern in neighbordb.match_node(node)]
+    except Exception as exc:  # pylint: disable=W0703
+        result.update(status="error", error=str(exc))
+        return result
+
+    if not matches:
+        status = "unmatched"
+    elif len(matches) > 1:
+        status = "conflict"
+    else:
+        status = "matched"
+
+    # In case of conflicts, the server uses the first match
+    result.update(status=status, pattern=matches[0] if matches else None, matches=matches)
+    return result
+
+
+def match_nodes(filename, processes=None, debug=False):
+    """Matches the nodes in filename (one JSON node definition, as sent
+    by the bootstrap client, per line) against neighbordb and prints the
+    results as JSON lines.  Returns the number of unmatched nodes plus
+    the number of errors."""
+
+    # Per-node logging would drown the results
+    if debug:
+        start_logging(debug)
+
+    # Warm up the neighbordb cache - forked workers inherit it
+    if not load_neighbordb("N/A"):
+        sys.exit(f"ERROR: Unable to load neighbordb ('{neighbordb_path()}')")
+
+    counts = {"matched": 0, "conflict": 0, "unmatched": 0, "error": 0}
+    with open(filename, encoding="utf8") if filename != "-" else sys.stdin as fd:
+        entries = ((lineno, line) for lineno, line in enumerate(fd, 1) if line.strip())
+
+        processes = processes or os.cpu_count() or 1
+        if processes > 1:
+            # The workers rely on inheriting the configuration and the
+            # neighbordb cache, which fork is the only start method to do
+            # (it is not the default on macOS or since Python 3.14)
+            pool = multiprocessing.get_context("fork").Pool(processes)
+            results = pool.imap(match_node_entry, entries, MATCH_NODES_CHUNK_SIZE)
+        else:
+            pool = None
+            results = map(match_node_entry, entries)
+
+        try:
+            for result in results:
+                counts[result["status"]] += 1
+                print(json.dumps(result, sort_keys=True))
+        finally:
+            if pool:
+                pool.terminate()
+
+    print(
+        f"{sum(counts.values())} node(s): {counts['matched']} matched, "
+        f"{counts['conflict']} conflict(s), {counts['unmatched']} unmatched, "
+        f"{counts['error']} error(s)",
+        file=sys.stderr,
+    )
+    return counts["unmatched"] + counts["error"]
+
+
+def preallocate(node_ids, threads=PREALLOCATE_THREADS):
+    """Resolves ahead of time, in parallel, the resources of the given
+    nodes and pins them in the nodes' attributes files (see
+    NodesController.preallocate).  Yields a result per node (in order)."""
+
+    nodes = controller.NodesController()
+
+    def preallocate_node(node_id):
+        result = {"node": node_id}
+        try:
+            result.update(status="ok", resources=nodes.preallocate(node_id))
+        except controller.FileObjectNotFound as exc:
+            result.update(status="error", error=f"missing definition ({exc})")
+        except Exception as exc:  # pylint: disable=W0703
+            result.update(status="error", error=str(exc))
+        return result
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            yield from executor.map(preallocate_node, node_ids)
+    finally:
+        # the process exits before the pools would be compacted
+        flush_resource_pools()
+
+
+def preallocate_nodes(filename, threads=None, debug=False):
+    """Preallocates the resources of the nodes in filename (one node id
+    per line) and prints the results as JSON lines.  Returns the number
+    of errors."""
+
+    if debug:
+        start_logging(debug)
+
+    with open(filename, encoding="utf8") if filename != "-" else sys.stdin as fd:
+        node_ids = [line.strip() for line in fd if line.strip() and not line.startswith("#")]
+
+    errors = 0
+    for result in preallocate(node_ids, threads or PREALLOCATE_THREADS):
+        errors += result["status"] == "error"
+        print(json.dumps(result, sort_keys=True))
+
+    print(f"{len(node_ids)} node(s): {errors} error(s)", file=sys.stderr)
+    log.info("Resource plugins: %s", plugin_cache)
+    return errors
+
+
 def run_validator(debug):
     start_logging(debug)
 
@@ -327,6 +563,41 @@ def main():
         "--clear-resources", "-r", action="store_true", help="Clears all resource files"
     )
 
+    parser.add_argument(
+        "--compile-neighbordb",
+        action="store_true",
+        help="Saves a compiled snapshot of neighbordb, which is loaded at startup",
+    )
+
+    parser.add_argument(
+        "--match-nodes",
+        metavar="FILE",
+        type=str,
+        help="Matches the nodes in FILE (JSON lines, '-' for STDIN) against neighbordb",
+    )
+
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of processes used by --match-nodes (default: number of CPUs)",
+    )
+
+    parser.add_argument(
+        "--preallocate",
+        metavar="FILE",
+        type=str,
+        help="Allocates, ahead of time, the resources of the nodes in FILE "
+        "(one node ID per line, '-' for STDIN)",
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help=f"Number of nodes preallocated in parallel (default: {PREALLOCATE_THREADS})",
+    )
+
     args = parser.parse_args()
 
     version = "N/A"
@@ -345,6 +616,19 @@ def main():
     if args.clear_resources:
         clear_resources(args.debug)
 
+    if args.compile_neighbordb:
+        load_config(args.conf)
+        compile_neighbordb_snapshot(args.debug)
+        sys.exit()
+
+    if args.match_nodes:
+        load_config(args.conf)
+        sys.exit(1 if match_nodes(args.match_nodes, args.processes, args.debug) else 0)
+
+    if args.preallocate:
+        load_config(args.conf)
+        sys.exit(1 if preallocate_nodes(args.preallocate, args.threads, args.debug) else 0)
+
     if args.version or args.validate_config or args.clear_resources:
         sys.exit()
 
@@ -0,0 +1,601 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+"""
+    MODULE:
+        ztpserver.asgi
+
+    AUTHOR:
+        Arista Networks
+
+    DESCRIPTION:
+        The asgi module provides an asyncio front end for ztpserver.  The
+        WSGI application is wrapped in an ASGI application which runs
+        requests in a bounded pool of threads, while file downloads are
+        streamed from the event loop, one block at a time, with
+        back-pressure from the client connection.  A minimal HTTP/1.1
+        server is also provided in order to run the ASGI application in
+        standalone mode.
+
+    :copyright: Copyright (c) 2015, Arista Networks
+    :license: BSD, see LICENSE for more details
+
+"""
+
+import asyncio
+import io
+import itertools
+import logging
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import unquote
+
+BLOCK_SIZE = 1 << 16
+
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+MAX_HEADERS = 100
+
+# ASGI extension for sending (part of) a file with sendfile
+ZEROCOPY_SEND = "http.response.zerocopysend"
+
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+
+class FileWrapper:
+    """Implementation of ``wsgi.file_wrapper`` which allows the ASGI
+    application to recognise file responses and to stream them without
+    holding a thread for the duration of the download.
+
+    Range requests are supported via :py:meth:`app_iter_range`, which is
+    used by webob when building partial responses.
+    """
+
+    def __init__(self, filelike, block_size=BLOCK_SIZE, offset=0, length=None):
+        self.filelike = filelike
+        self.block_size = block_size
+        self.offset = offset
+        self.length = length
+
+    def app_iter_range(self, seek=None, limit=None, block_size=None):
+        offset = seek or 0
+        length = None if limit is None else max(limit - offset, 0)
+        return FileWrapper(self.filelike, block_size or self.block_size, offset, length)
+
+    def read(self, offset, size):
+        """Returns up to size bytes starting at offset"""
+
+        try:
+            return os.pread(self.filelike.fileno(), size, offset)
+        except (AttributeError, io.UnsupportedOperation):
+            self.filelike.seek(offset)
+            return self.filelike.read(size)
+
+    def blocks(self):
+        """Yields (offset, size) tuples covering the wrapped range"""
+
+        offset = self.offset
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.block_size if remaining is None else min(self.block_size, remaining)
+            yield offset, size
+            offset += size
+            if remaining is not None:
+                remaining -= size
+
+    def __iter__(self):
+        for offset, size in self.blocks():
+            data = self.read(offset, size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self.filelike.close()
+
+
+class ASGIApplication:
+    """ASGI application wrapping a WSGI application (typically an
+    instance of :py:class:`ztpserver.controller.Router`)
+
+    :param app: the wsgi application
+    :param threads: size of the thread pool which runs the wsgi
+                    application (and any file I/O)
+    :param max_body_size: largest accepted request body
+    """
+
+    def __init__(self, app, threads=16, max_body_size=MAX_BODY_SIZE):
+        self.app = app
+        self.threads = threads
+        self.max_body_size = max_body_size
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def __repr__(self):
+        return f"ASGIApplication(app={self.app!r}, threads={self.threads})"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported scope type: {scope['type']}")
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def read_body(self, receive):
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            body.extend(message.get("body", b""))
+            more_body = message.get("more_body", False)
+            if len(body) > self.max_body_size:
+                raise ValueError("request body too large")
+        return bytes(body)
+
+    @staticmethod
+    def environ(scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": FileWrapper,
+        }
+
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin1").upper().replace("-", "_")
+            value = value.decode("latin1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+                continue
+            if name == "CONTENT_LENGTH":
+                continue
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+        return environ
+
+    def run_wsgi(self, environ):
+        """Runs the wsgi application (in a worker thread) and returns the
+        status, headers, response iterable and the iterable to be sent
+
+        If the application delays calling start_response until the
+        response is iterated, the first block is read here.
+        """
+
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+
+        result = body = self.app(environ, start_response)
+        if not response:
+            iterator = iter(result)
+            first = next(iterator, b"")
+            body = itertools.chain([first], iterator)
+
+        status, headers = response
+        return int(status.split(" ", 1)[0]), headers, result, body
+
+    async def http(self, scope, receive, send):
+        loop = asyncio.get_event_loop()
+
+        try:
+            body = await self.read_body(receive)
+        except ValueError:
+            await self.send_status(send, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            return
+        if body is None:
+            return
+
+        environ = self.environ(scope, body)
+        status, headers, result, body = await loop.run_in_executor(
+            self.executor, self.run_wsgi, environ
+        )
+
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [
+                        (name.lower().encode("latin1"), value.encode("latin1"))
+                        for name, value in headers
+                    ],
+                }
+            )
+
+            if scope["method"] == "HEAD":
+                pass
+            elif isinstance(body, FileWrapper):
+                if ZEROCOPY_SEND in (scope.get("extensions") or {}):
+                    await send(
+                        {
+                            "type": ZEROCOPY_SEND,
+                            "file": body.filelike,
+                            "offset": body.offset,
+                            "count": body.length,
+                            "more_body": True,
+                        }
+                    )
+                else:
+                    await self.send_file(body, send)
+            elif isinstance(body, (list, tuple)):
+                for data in body:
+                    await send({"type": "http.response.body", "body": data, "more_body": True})
+            else:
+                await self.send_iterable(body, send)
+
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            close = getattr(result, "close", None)
+            if close:
+                await loop.run_in_executor(self.executor, close)
+
+    async def send_file(self, wrapper, send):
+        loop = asyncio.get_event_loop()
+        for offset, size in wrapper.blocks():
+            data = await loop.run_in_executor(self.executor, wrapper.read, offset, size)
+            if not data:
+                return
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+
+    async def send_iterable(self, result, send):
+        loop = asyncio.get_event_loop()
+        iterator = iter(result)
+        sentinel = object()
+        while True:
+            data = await loop.run_in_executor(self.executor, next, iterator, sentinel)
+            if data is sentinel:
+                return
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+
+    @staticmethod
+    async def send_status(send, status):
+        body = f"{status.value} {status.phrase}".encode("latin1")
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status.value,
+                "headers": [
+                    (b"content-type", b"text/plain"),
+                    (b"content-length", str(len(body)).encode("latin1")),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+class HTTPError(Exception):
+    """raised when a request cannot be parsed"""
+
+    def __init__(self, status):
+        self.status = status
+        super().__init__(f"{status.value} {status.phrase}")
+
+
+class HTTPConnection:
+    """Serves the requests received over a single client connection"""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.keep_alive = True
+        self.headers_sent = False
+        self.content_length = None
+        self.method = None
+        self.version = "1.1"
+
+    async def serve(self):
+        try:
+            while self.keep_alive:
+                try:
+                    request = await self.read_request()
+                except HTTPError as err:
+                    self.keep_alive = False
+                    await self.send_error(err.status)
+                    break
+
+                if request is None:
+                    break
+                await self.handle(*request)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.writer.close()
+
+    async def read_request(self):
+        timeout = self.server.keepalive_timeout or None
+        try:
+            line = await asyncio.wait_for(self.reader.readline(), timeout)
+        except (asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError):
+            return None
+        if not line:
+            return None
+
+        try:
+            method, target, version = line.decode("latin1").rstrip("\r\n").split(" ")
+        except ValueError as err:
+            raise HTTPError(HTTPStatus.BAD_REQUEST) from err
+        if version not in ("HTTP/1.0", "HTTP/1.1"):
+            raise HTTPError(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED)
+
+        headers = []
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n"):
+                break
+            if not line:
+                return None
+            if len(headers) >= MAX_HEADERS:
+                raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            name, _, value = line.decode("latin1").partition(":")
+            headers.append((name.strip().lower().encode("latin1"), value.strip().encode("latin1")))
+
+        fields = {name: value.decode("latin1").lower() for name, value in headers}
+        connection = fields.get(b"connection", "")
+        if version == "HTTP/1.0":
+            self.keep_alive = "keep-alive" in connection
+        else:
+            self.keep_alive = "close" not in connection
+        if not self.server.keepalive_timeout:
+            self.keep_alive = False
+
+        if b"transfer-encoding" in fields:
+            raise HTTPError(HTTPStatus.LENGTH_REQUIRED)
+        try:
+            length = int(fields.get(b"content-length", 0))
+        except ValueError as err:
+            raise HTTPError(HTTPStatus.BAD_REQUEST) from err
+        if length > self.server.app.max_body_size:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await self.reader.readexactly(length) if length > 0 else b""
+
+        path, _, query = target.partition("?")
+        return method, path, query, version[5:], headers, body
+
+    async def handle(self, method, path, query, version, headers, body):
+        sockname = self.writer.get_extra_info("sockname") or ("", 0)
+        peername = self.writer.get_extra_info("peername") or ("", 0)
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0", "spec_version": "2.1"},
+            "http_version": version,
+            "method": method,
+            "scheme": "http",
+            "path": unquote(path),
+            "raw_path": path.encode("latin1"),
+            "query_string": query.encode("latin1"),
+            "root_path": "",
+            "headers": headers,
+            "client": tuple(peername[:2]),
+            "server": tuple(sockname[:2]),
+        }
+        if self.server.sendfile:
+            scope["extensions"] = {ZEROCOPY_SEND: {}}
+
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            return {"type": "http.disconnect"}
+
+        self.headers_sent = False
+        self.content_length = None
+        self.method = method
+        self.version = version
+        try:
+            await self.server.app(scope, receive, self.send)
+        except Exception as exc:  # pylint: disable=W0703
+            log.error("Failed to serve %s %s: %s", method, path, exc)
+            self.keep_alive = False
+        if not self.headers_sent:
+            self.keep_alive = False
+            await self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            await self.start_response(message["status"], message.get("headers", []))
+        elif message["type"] == "http.response.body":
+            body = message.get("body", b"")
+            if body and self.method != "HEAD":
+                self.writer.write(body)
+            await self.writer.drain()
+        elif message["type"] == ZEROCOPY_SEND:
+            if self.method != "HEAD" and message.get("count") != 0:
+                await self.sendfile(message["file"], message.get("offset"), message.get("count"))
+
+    async def sendfile(self, file, offset, count):
+        await self.writer.drain()
+        loop = asyncio.get_event_loop()
+        sent = await loop.sendfile(self.writer.transport, file, offset or 0, count)
+
+        # The file was truncated: the response is shorter than announced
+        if self.content_length is not None and sent < (count or self.content_length):
+            self.keep_alive = False
+
+    async def start_response(self, status, headers):
+        names = {name.lower() for name, _ in headers}
+        for name, value in headers:
+            if name.lower() == b"content-length":
+                self.content_length = int(value)
+        if not (
+            b"content-length" in names
+            or status in (204, 304)
+            or status < 200
+            or self.method == "HEAD"
+        ):
+            self.keep_alive = False
+
+        lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+        lines.extend(
+            f"{name.decode('latin1')}: {value.decode('latin1')}" for name, value in headers
+        )
+        if b"server" not in names:
+            lines.append("Server: ztpserver")
+        if not self.keep_alive:
+            lines.append("Connection: close")
+        elif self.version == "1.0":
+            lines.append("Connection: keep-alive")
+
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin1"))
+        self.headers_sent = True
+
+    async def send_error(self, status):
+        body = f"{status.value} {status.phrase}".encode("latin1")
+        self.method = None
+        await self.start_response(
+            status.value,
+            [
+                (b"Content-Type", b"text/plain"),
+                (b"Content-Length", str(len(body)).encode("latin1")),
+            ],
+        )
+        self.writer.write(body)
+        await self.writer.drain()
+
+
+class HTTPServer:
+    """Minimal asyncio HTTP/1.1 server for ASGI applications
+
+    Each client connection is served by a coroutine, so idle and
+    streaming connections do not hold a thread.  The server supports the
+    ``http.response.zerocopysend`` extension, so file responses are sent
+    with loop.sendfile.
+    """
+
+    def __init__(self, app, host, port, backlog=128, keepalive_timeout=5, sendfile=True):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.keepalive_timeout = keepalive_timeout
+        # loop.sendfile requires Python 3.7
+        self.sendfile = sendfile and hasattr(asyncio.AbstractEventLoop, "sendfile")
+        self.server = None
+        self.connections = set()
+        self.loop = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.connected, self.host, self.port, backlog=self.backlog
+        )
+        return self.server
+
+    @property
+    def server_address(self):
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def connected(self, reader, writer):
+        connection = HTTPConnection(self, reader, writer)
+        self.connections.add(connection)
+        try:
+            await connection.serve()
+        finally:
+            self.connections.discard(connection)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            for connection in list(self.connections):
+                connection.writer.close()
+            await self.server.wait_closed()
+
+    def serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start())
+
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+        self.loop.run_forever()
+
+    def server_close(self):
+        if self.loop is None:
+            return
+
+        self.loop.run_until_complete(self.close())
+        self.app.executor.shutdown(wait=False)
+        self.loop.close()
+        self.loop = None
+
+
+def make_server(host, port, app, backlog=128, keepalive_timeout=5, sendfile=True):
+    """Returns an asyncio server for the ASGI application ``app``"""
+
+    return HTTPServer(
+        app,
+        host,
+        port,
+        backlog=backlog,
+        keepalive_timeout=keepalive_timeout,
+        sendfile=sendfile,
+    )
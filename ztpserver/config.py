@@ -313,6 +313,25 @@ runtime.add_attribute(
     IntAttr(name="port", group="server", min_value=1, max_value=65534, default=8080)
 )
 
+runtime.add_attribute(
+    StrAttr(
+        name="mode",
+        group="server",
+        choices=["single", "threaded", "prefork", "asyncio"],
+        default="single",
+    )
+)
+
+runtime.add_attribute(IntAttr(name="workers", group="server", min_value=1, default=4))
+
+runtime.add_attribute(IntAttr(name="threads", group="server", min_value=1, default=16))
+
+runtime.add_attribute(IntAttr(name="backlog", group="server", min_value=1, default=128))
+
+runtime.add_attribute(IntAttr(name="keepalive_timeout", group="server", min_value=0, default=5))
+
+runtime.add_attribute(BoolAttr(name="sendfile", group="server", default=True))
+
 # Group: bootstrap
 runtime.add_attribute(
     StrAttr(
@@ -332,3 +351,49 @@ runtime.add_attribute(
         environ="ZTPS_NEIGHBORDB_FILENAME",
     )
 )
+
+runtime.add_attribute(BoolAttr(name="report_all_matches", group="neighbordb", default=False))
+
+# Group: repository
+runtime.add_attribute(
+    StrAttr(
+        name="index",
+        group="repository",
+        choices=["off", "auto", "inotify", "poll"],
+        default="off",
+    )
+)
+
+runtime.add_attribute(IntAttr(name="poll_interval", group="repository", min_value=1, default=5))
+
+runtime.add_attribute(BoolAttr(name="prehash", group="repository", default=False))
+
+runtime.add_attribute(IntAttr(name="prehash_workers", group="repository", min_value=1, default=2))
+
+runtime.add_attribute(BoolAttr(name="compress", group="repository", default=False))
+
+# Group: serializers
+runtime.add_attribute(
+    StrAttr(name="yaml", group="serializers", choices=["auto", "libyaml", "python"], default="auto")
+)
+
+runtime.add_attribute(
+    StrAttr(name="json", group="serializers", choices=["auto", "orjson", "json"], default="auto")
+)
+
+# Group: files
+runtime.add_attribute(
+    StrAttr(
+        name="offload",
+        group="files",
+        choices=["off", "x-sendfile", "x-accel-redirect"],
+        default="off",
+    )
+)
+
+runtime.add_attribute(StrAttr(name="offload_prefix", group="files", default="/ztps-data"))
+
+# Group: plugins
+runtime.add_attribute(IntAttr(name="threads", group="plugins", min_value=1, default=8))
+
+runtime.add_attribute(IntAttr(name="timeout", group="plugins", min_value=1, default=60))
@@ -32,13 +32,18 @@
 # pylint: disable=W0622,W0402,W0613,E1103,W0150
 #
 
+import copy
+import hashlib
 import logging
 import os
 import subprocess
+import threading
 from string import Template
 from subprocess import PIPE
+from urllib.parse import quote
 
 import routes
+from webob.etag import AnyETag
 from webob.static import FileApp
 
 from ztpserver.config import runtime
@@ -52,16 +57,33 @@ from ztpserver.constants import (
     HTTP_STATUS_CREATED,
     HTTP_STATUS_INTERNAL_SERVER_ERROR,
     HTTP_STATUS_NOT_FOUND,
+    HTTP_STATUS_NOT_MODIFIED,
+    HTTP_STATUS_OK,
 )
-from ztpserver.repository import FileObjectError, FileObjectNotFound, create_repository
-from ztpserver.serializers import SerializerError
+from ztpserver.repository import (
+    COMPRESS_MIN_SIZE,
+    DIGEST_ALGORITHMS,
+    FileObjectError,
+    FileObjectNotFound,
+    content_encodings,
+    create_repository,
+    get_compression_cache,
+)
+from ztpserver.resources import plugin_cache, run_plugin
+from ztpserver.serializers import SerializerError, file_lock
 from ztpserver.topology import (
+    PINNED_RESOURCES,
     create_node,
     load_neighbordb,
     load_pattern,
     load_resources,
+    map_resources,
+    pin_resources,
     replace_config_action,
+    resolve_resources,
+    resource_key,
 )
+from ztpserver.utils import file_etag, file_signature
 from ztpserver.wsgiapp import WSGIController, WSGIRouter
 
 DEFINITION_FN = "definition"
@@ -79,12 +101,64 @@ class ValidationError(Exception):
     """Base exception class for :py:class:`Pattern`"""
 
 
+class DefinitionCache:
+    """Caches, per node, the definition served by GET /nodes/{id} after
+    validation and variable substitution.  Entries are keyed on the
+    signatures of the node's files, so any change to those files forces
+    the definition to be rendered again.  Resources are not cached:
+    plugins run on every request."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+    def __repr__(self):
+        return (
+            f"DefinitionCache(entries={len(self.entries)}, hits={self.stats['hits']}, "
+            f"misses={self.stats['misses']})"
+        )
+
+    def invalidate(self):
+        """Drops all cached definitions"""
+
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, resource, key):
+        """Returns a copy of the definition cached for resource or None
+        if the cached copy is missing or stale"""
+
+        if key is None:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(resource)
+            if entry is None or entry[0] != key:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+        return copy.deepcopy(entry[1])
+
+    def set(self, resource, key, definition):
+        if key is None:
+            return
+
+        definition = copy.deepcopy(definition)
+        with self.lock:
+            self.entries[resource] = (key, definition)
+
+
+definition_cache = DefinitionCache()  # pylint: disable=C0103
+
+
 class BaseController(WSGIController):
     FOLDER = None
 
     def __init__(self, **kwargs):
         self.data_root = runtime.default.data_root
         self.repository = create_repository(self.data_root)
+        self.compression = get_compression_cache(self.data_root)
         super().__init__()
 
     def expand(self, *args, **kwargs):
@@ -94,6 +168,90 @@ class BaseController(WSGIController):
         folder = kwargs.get("folder", self.FOLDER)
         return os.path.join(folder, file_path)
 
+    def encode(self, request, response):
+        """Compresses the response if the client accepts one of the
+        supported encodings (Accept-Encoding).  Clients which do not send
+        the header get the response as is.
+
+        The ETag of a compressed response is the one of the response
+        followed by the encoding (e.g. <etag>-gzip), as its body differs.
+        """
+
+        if response.status_code == HTTP_STATUS_NOT_MODIFIED:
+            # Echo the ETag of the (compressed) copy cached by the client
+            if not response.etag or response.etag in request.if_none_match:
+                return response
+            for encoding in content_encodings():
+                if f"{response.etag}-{encoding}" in request.if_none_match:
+                    response.etag = f"{response.etag}-{encoding}"
+                    break
+            return response
+
+        if (
+            not runtime.repository.compress
+            or "Accept-Encoding" not in request.headers
+            or response.status_code != HTTP_STATUS_OK
+            or response.content_length is None
+            or response.content_length < COMPRESS_MIN_SIZE
+        ):
+            return response
+
+        response.vary = ("Accept-Encoding",)
+        offers = request.accept_encoding.acceptable_offers(content_encodings())
+        if not offers:
+            return response
+
+        encoding = offers[0][0]
+        name = os.path.normpath(request.path_info).lstrip("/")
+        response.body = self.compression.get(name, response.body, encoding)
+        response.content_encoding = encoding
+        if response.etag:
+            response.etag = f"{response.etag}-{encoding}"
+        return response
+
+    def validators(self, file_obj, *values):
+        """Returns the (etag, last_modified) validators of the response
+        built from file_obj (and values, e.g. substituted variables)
+
+        The ETag is the digest of the contents of the file, which is only
+        computed once per version of the file (see
+        :py:class:`ztpserver.repository.DigestCache`).  Returns (None, None)
+        if the file cannot be accessed.
+        """
+
+        signature = file_signature(file_obj.name)
+        if signature is None:
+            return None, None
+
+        etag = file_obj.hash()
+        if values:
+            etag = hashlib.sha1("\0".join((etag,) + values).encode("utf8")).hexdigest()
+        return etag, signature[2] // 10**9
+
+    def not_modified(self, request, etag, last_modified):
+        """Returns True if the copy cached by the client (If-None-Match or
+        If-Modified-Since) is current, compressed (see encode) or not"""
+
+        if etag is None:
+            return False
+        # AnyETag (If-None-Match: *) is false
+        if request.if_none_match is AnyETag or request.if_none_match:
+            etags = [etag] + [f"{etag}-{x}" for x in content_encodings()]
+            return any(x in request.if_none_match for x in etags)
+        if request.if_modified_since:
+            return last_modified <= request.if_modified_since.timestamp()
+        return False
+
+    def http_not_modified(self, etag, last_modified):
+        """Returns HTTP 304 Not Modified"""
+
+        return {
+            "content_type": None,
+            "status": HTTP_STATUS_NOT_MODIFIED,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+
     def http_bad_request(self, *args, **kwargs):
         """Returns HTTP 400 Bad Request"""
         return {
@@ -137,11 +295,29 @@ class FilesController(BaseController):
                 resource += f'.{urlvars.get("format")}'
             file_path = self.expand(resource)
             filename = self.repository.get_file(file_path).name
-            return FileApp(filename, content_type=CONTENT_TYPE_OTHER)
+            if runtime.files.offload != "off":
+                return self.offload(filename)
+            # The ETag validates Range requests (If-Range), so that clients
+            # can resume interrupted downloads
+            return FileApp(filename, content_type=CONTENT_TYPE_OTHER, etag=file_etag(filename))
         except FileObjectNotFound:
             log.error("File %s not found", resource)
             return self.http_not_found()
 
+    def offload(self, filename):
+        """Returns an empty response whose X-Sendfile (Apache) or
+        X-Accel-Redirect (nginx) header tells the front-end web server to
+        send the file itself"""
+
+        response = self.response(content_type=CONTENT_TYPE_OTHER, etag=file_etag(filename))
+        if runtime.files.offload == "x-sendfile":
+            response.headers["X-Sendfile"] = filename
+        else:
+            path = os.path.relpath(filename, self.data_root)
+            location = f"{runtime.files.offload_prefix.rstrip('/')}/{quote(path)}"
+            response.headers["X-Accel-Redirect"] = location
+        return response
+
 
 class ActionsController(BaseController):
     FOLDER = "actions"
@@ -155,8 +331,17 @@ class ActionsController(BaseController):
 
         try:
             file_path = self.expand(resource)
-            body = self.repository.get_file(file_path).read(CONTENT_TYPE_PYTHON)
-            return {"body": body, "content_type": CONTENT_TYPE_PYTHON}
+            file_obj = self.repository.get_file(file_path)
+            etag, last_modified = self.validators(file_obj)
+            if self.not_modified(request, etag, last_modified):
+                return self.http_not_modified(etag, last_modified)
+
+            return {
+                "body": file_obj.read(CONTENT_TYPE_PYTHON),
+                "content_type": CONTENT_TYPE_PYTHON,
+                "etag": etag,
+                "last_modified": last_modified,
+            }
         except FileObjectNotFound:
             log.error("Action %s not found", resource)
             return self.http_not_found()
@@ -168,10 +353,10 @@ class NodesController(BaseController):
     def __repr__(self):
         return f"NodesController(folder={self.FOLDER})"
 
-    def fsm(self, state, **kwargs):
+    def fsm(self, state, response=None, **kwargs):
         """Execute the FSM for the request"""
 
-        response = {}
+        response = response or {}
         prev_state = None
         try:
             while state is not None:
@@ -198,8 +383,15 @@ class NodesController(BaseController):
         filename = self.expand(resource, STARTUP_CONFIG_FN)
 
         try:
-            response["body"] = self.repository.get_file(filename).read()
+            file_obj = self.repository.get_file(filename)
+            etag, last_modified = self.validators(file_obj)
+            if self.not_modified(request, etag, last_modified):
+                return self.http_not_modified(etag, last_modified)
+
+            response["body"] = file_obj.read()
             response["content_type"] = CONTENT_TYPE_OTHER
+            response["etag"] = etag
+            response["last_modified"] = last_modified
         except FileObjectNotFound:
             log.error("%s: missing startup-config file %s", resource, filename)
             response = self.http_bad_request()
@@ -408,14 +600,22 @@ class NodesController(BaseController):
             return self.http_bad_request(), None
 
         # pylint: disable=E1103
-        matches = neighbordb.match_node(node)
-        if not matches:
+        if runtime.neighbordb.report_all_matches:
+            matches = neighbordb.match_node(node)
+            log.info(
+                "%s: %d pattern(s) in neighbordb are a good match: %s",
+                node_id,
+                len(matches),
+                ", ".join(str(x.name) for x in matches),
+            )
+            match = matches[0] if matches else None
+        else:
+            match = neighbordb.first_match(node)
+
+        if not match:
             log.info("%s: node matched no patterns in neighbordb", node_id)
             return self.http_bad_request(), None
 
-        log.debug("%s: %d pattern(s) in neihgbordb are a good match", node_id, len(matches))
-        match = matches[0]
-
         log.info("%s: node matched '%s' pattern in neighbordb", node_id, match.name)
 
         # Load definition
@@ -569,6 +769,11 @@ class NodesController(BaseController):
         log.debug("%s\nResource: %s\n", request, resource)
 
         node_id = resource.split("/")[0]
+
+        # Computed before reading any of the files, so that changes made
+        # while the definition is rendered invalidate the cached copy
+        cache_key = self.definition_key(resource)
+
         try:
             fobj = self.repository.get_file(self.expand(resource, NODE_FN))
             node = create_node(fobj.read(CONTENT_TYPE_JSON))
@@ -577,12 +782,42 @@ class NodesController(BaseController):
             response = self.http_bad_request()
             return self.response(**response)
 
+        definition = definition_cache.get(resource, cache_key)
+        if definition is not None:
+            log.info("%s: using cached definition (%s)", resource, definition_cache)
+            return self.fsm(
+                "do_resources",
+                response={"definition": definition},
+                resource=resource,
+                request=request,
+                node=node,
+                node_id=node_id,
+            )
+
         return self.fsm(
             "do_validation",
             resource=resource,
             request=request,
             node=node,
             node_id=node_id,
+            cache_key=cache_key,
+        )
+
+    def definition_key(self, resource):
+        """Returns the key identifying the current version of the
+        definition for resource or None if it cannot be cached"""
+
+        signatures = tuple(
+            file_signature(os.path.join(self.data_root, self.expand(resource, filename)))
+            for filename in [NODE_FN, PATTERN_FN, STARTUP_CONFIG_FN, DEFINITION_FN, ATTRIBUTES_FN]
+        )
+        if signatures[0] is None:
+            return None
+
+        return (
+            signatures,
+            runtime.default.disable_topology_validation,
+            runtime.default.server_url,
         )
 
     def do_validation(self, response, *args, **kwargs):
@@ -747,8 +982,16 @@ class NodesController(BaseController):
                         _attributes[key] = update
             action["attributes"] = _attributes
             _actions.append(action)
+
+        # resources resolved ahead of time (ztps --preallocate)
+        pinned = nodeattrs.get(PINNED_RESOURCES)
+        if pinned:
+            for action in _actions:
+                action["attributes"] = pin_resources(action["attributes"], pinned)
+
         definition["actions"] = _actions
         response["definition"] = definition
+        definition_cache.set(kwargs["resource"], kwargs.get("cache_key"), definition)
         return response, "do_resources"
 
     def do_resources(self, response, *args, **kwargs):
@@ -757,15 +1000,23 @@ class NodesController(BaseController):
         _actions = []
 
         try:
+            # plugins run concurrently, once per (plugin, argument)
+            memo = resolve_resources(
+                [action.get("attributes", {}) for action in definition.get("actions")],
+                node,
+                kwargs["resource"],
+            )
             for action in definition.get("actions"):
                 attrs = action.get("attributes", {})
 
-                action["attributes"] = load_resources(attrs, node, kwargs["resource"])
+                action["attributes"] = load_resources(attrs, node, kwargs["resource"], memo)
                 _actions.append(action)
         except Exception as exc:
             log.error(exc)
             raise RuntimeError("failed to allocate resources") from exc
 
+        log.debug("%s: resources loaded (%s)", kwargs["resource"], plugin_cache)
+
         definition["actions"] = _actions
         response["definition"] = definition
         return response, "finalize_response"
@@ -777,6 +1028,60 @@ class NodesController(BaseController):
         _response["content_type"] = response.get("content_type", CONTENT_TYPE_JSON)
         return _response, None
 
+    def preallocate(self, node_id):
+        """Resolves the resource functions in the definition of node_id
+        ahead of time and pins their values in the node's attributes file
+        (under PINNED_RESOURCES), so GET /nodes/{id} does not run the
+        plugins.  Resources which are already pinned are kept.
+
+        Returns:
+            dict of the resources pinned by this call
+
+        Raises:
+            FileObjectNotFound: if the node has no definition
+        """
+
+        response, _ = self.get_definition({}, resource=node_id)
+        if "definition" not in response:
+            raise FileObjectNotFound(self.expand(node_id, DEFINITION_FN))
+        response, _ = self.get_attributes(response, resource=node_id)
+        response, _ = self.do_substitution(response, resource=node_id)
+
+        functions = []
+        for action in response["definition"].get("actions") or []:
+            map_resources(
+                action.get("attributes", {}),
+                lambda function, arg: functions.append((function, arg)),
+            )
+        if not functions:
+            return {}
+
+        try:
+            fobj = self.repository.get_file(self.expand(node_id, NODE_FN))
+            node = create_node(fobj.read(CONTENT_TYPE_JSON))
+        except FileObjectNotFound:
+            node = create_node({"serialnumber": node_id})
+
+        resolved = {}
+        for function, arg in functions:
+            key = resource_key(function, arg)
+            if key not in resolved:
+                resolved[key] = run_plugin(function, node_id, arg, node)
+                log.info("%s: pinned resource %s: %s", node_id, key, resolved[key])
+
+        filename = self.expand(node_id, ATTRIBUTES_FN)
+        with file_lock(os.path.join(self.data_root, filename)):
+            try:
+                fobj = self.repository.get_file(filename)
+                attributes = fobj.read(CONTENT_TYPE_YAML) or {}
+            except FileObjectNotFound:
+                fobj = self.repository.add_file(filename)
+                attributes = {}
+            attributes.setdefault(PINNED_RESOURCES, {}).update(resolved)
+            fobj.write(attributes, CONTENT_TYPE_YAML)
+
+        return resolved
+
 
 class BootstrapController(BaseController):
     DEFAULT_CONFIG = {"logging": [], "xmpp": {}}
@@ -834,12 +1139,23 @@ class BootstrapController(BaseController):
 
         filename = self.expand(runtime.bootstrap.filename)
         try:
-            fobj = self.repository.get_file(filename).read(CONTENT_TYPE_PYTHON)
-
+            file_obj = self.repository.get_file(filename)
             default_server = runtime.default.server_url
+
+            etag, last_modified = self.validators(file_obj, default_server)
+            if self.not_modified(request, etag, last_modified):
+                log.info("%s: node beginning provisioning (cached)", request.remote_addr)
+                return self.http_not_modified(etag, last_modified)
+
+            fobj = file_obj.read(CONTENT_TYPE_PYTHON)
             body = Template(fobj).safe_substitute(SERVER=default_server)
 
-            resp = {"body": body, "content_type": CONTENT_TYPE_PYTHON}
+            resp = {
+                "body": body,
+                "content_type": CONTENT_TYPE_PYTHON,
+                "etag": etag,
+                "last_modified": last_modified,
+            }
             log.info("%s: node beginning provisioning", request.remote_addr)
         except KeyError as err:
             log.debug("Missing variable: %s", err)
@@ -856,8 +1172,6 @@ class BootstrapController(BaseController):
 class MetaController(BaseController):
     FOLDER = "meta"
 
-    BODY = {"size": None, "sha1": None}
-
     def __repr__(self):
         return f"MetaController(folder={self.FOLDER})"
 
@@ -866,6 +1180,11 @@ class MetaController(BaseController):
 
         file_path = f"{kwargs['type']}/{kwargs['path_info']}"
 
+        algorithm = request.GET.get("algorithm", "sha1")
+        if algorithm not in DIGEST_ALGORITHMS:
+            log.error("Unsupported digest algorithm %s for %s", algorithm, file_path)
+            return self.http_bad_request()
+
         try:
             try:
                 file_resource = self.repository.get_file(file_path)
@@ -874,9 +1193,15 @@ class MetaController(BaseController):
                 log.error("%s is a folder, not a file: %s", file_path, str(exc))
                 resp = self.http_not_found()
             else:
-                self.BODY["size"] = file_resource.size()
-                self.BODY["sha1"] = file_resource.hash()
-                resp = {"body": self.BODY, "content_type": CONTENT_TYPE_JSON}
+                body = {"size": file_resource.size()}
+                # Do not wait for a digest which is being computed in the
+                # background (prehash)
+                digest = file_resource.hash(algorithm, block=False)
+                if digest is None:
+                    body["pending"] = True
+                else:
+                    body[algorithm] = digest
+                resp = {"body": body, "content_type": CONTENT_TYPE_JSON}
         except Exception as exc:
             log.error("Failed to collect meta information for %s: %s", file_path, exc)
             resp = self.http_internal_server_error()
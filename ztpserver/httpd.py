@@ -0,0 +1,437 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+"""
+    MODULE:
+        ztpserver.httpd
+
+    AUTHOR:
+        Arista Networks
+
+    DESCRIPTION:
+        The httpd module provides the HTTP servers used when ztpserver is
+        run in standalone mode.  In addition to the single-threaded
+        wsgiref server, requests can be served from a pool of threads
+        (optionally replicated across a number of pre-forked worker
+        processes) using persistent HTTP/1.1 connections.
+
+    :copyright: Copyright (c) 2015, Arista Networks
+    :license: BSD, see LICENSE for more details
+
+"""
+
+import io
+import logging
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+from wsgiref.simple_server import make_server as make_simple_server
+
+from ztpserver.asgi import FileWrapper
+
+SERVER_MODES = ["single", "threaded", "prefork"]
+
+MAX_REQUEST_LINE = 65536
+
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+
+class SendfileServerHandler(ServerHandler):
+    """WSGI handler which sends file responses (``wsgi.file_wrapper``)
+    straight from the file to the client socket using os.sendfile,
+    without copying the contents through userspace buffers.
+    """
+
+    wsgi_file_wrapper = FileWrapper
+
+    def sendfile(self):
+        wrapper = self.result
+        if not getattr(self.request_handler.server, "sendfile", True):
+            return False
+        if self.environ["REQUEST_METHOD"] == "HEAD":
+            return False
+
+        try:
+            wrapper.filelike.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+
+        # socket.sendfile uses os.sendfile and waits for the socket to
+        # become writable when the connection has a timeout
+        if wrapper.length != 0:
+            self.bytes_sent += self.request_handler.connection.sendfile(
+                wrapper.filelike, wrapper.offset, wrapper.length
+            )
+        return True
+
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    """wsgiref request handler (one request per connection) which serves
+    file responses using os.sendfile"""
+
+    def handle(self):
+        self.raw_requestline = self.rfile.readline(MAX_REQUEST_LINE + 1)
+        if len(self.raw_requestline) > MAX_REQUEST_LINE:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            # An error code has been sent
+            return
+
+        handler = SendfileServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ(), multithread=False
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+class KeepAliveServerHandler(SendfileServerHandler):
+    """WSGI handler which replies using HTTP/1.1 and determines, once the
+    response headers are known, whether the client connection can be
+    reused for a subsequent request.
+    """
+
+    http_version = "1.1"
+
+    def delimited(self):
+        """Returns True if the client can find the end of the response
+        without the connection being closed"""
+
+        status = int(str(self.status).split(" ", 1)[0])
+        if status < 200 or status in (204, 304):
+            return True
+        if self.environ["REQUEST_METHOD"] == "HEAD":
+            return True
+        return "Content-Length" in self.headers
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+
+        request_handler = self.request_handler
+        if not self.delimited():
+            request_handler.close_connection = True
+
+        if request_handler.close_connection:
+            self.headers["Connection"] = "close"
+
+    def close(self):
+        # A body which was not sent in full leaves the connection in an
+        # unknown state
+        if self.headers is not None and self.environ["REQUEST_METHOD"] != "HEAD":
+            length = self.headers.get("Content-Length")
+            if length is not None and int(length) != self.bytes_sent:
+                self.request_handler.close_connection = True
+        super().close()
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Request handler which serves multiple requests per connection
+
+    The connection is kept open for as long as the client asks for it
+    (HTTP/1.1) and the next request starts within the server's
+    keepalive_timeout.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    # status line/headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def read_body(self, environ):
+        """Returns the request body stream to be handed to the application
+
+        The body is read up front so that the connection stays in sync
+        for the next request, regardless of how much of it is consumed
+        by the application.
+        """
+
+        if "HTTP_TRANSFER_ENCODING" in environ:
+            self.close_connection = True
+            return self.rfile
+
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            self.close_connection = True
+            return self.rfile
+
+        return io.BytesIO(self.rfile.read(length) if length > 0 else b"")
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        keepalive_timeout = self.server.keepalive_timeout
+
+        try:
+            if keepalive_timeout > 0:
+                self.connection.settimeout(keepalive_timeout)
+            self.raw_requestline = self.rfile.readline(MAX_REQUEST_LINE + 1)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > MAX_REQUEST_LINE:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            # An error code has been sent
+            return
+
+        self.connection.settimeout(None)
+        if keepalive_timeout <= 0:
+            self.close_connection = True
+
+        environ = self.get_environ()
+        handler = KeepAliveServerHandler(
+            self.read_body(environ), self.wfile, self.get_stderr(), environ, multithread=True
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """WSGI server which hands accepted connections to a fixed pool of
+    worker threads
+
+    Once all the workers are busy and the hand-off queue is full, new
+    connections are left in the listen backlog of the socket.
+    """
+
+    def __init__(
+        self,
+        server_address,
+        handler_class=KeepAliveRequestHandler,
+        threads=16,
+        backlog=128,
+        keepalive_timeout=5,
+    ):
+        self.threads = threads
+        self.request_queue_size = backlog
+        self.keepalive_timeout = keepalive_timeout
+
+        self.requests = queue.Queue(maxsize=threads)
+        self.workers = []
+
+        super().__init__(server_address, handler_class)
+
+    def start_workers(self):
+        # Workers are started on demand so that they are created in the
+        # process which serves the requests (see PreforkServer)
+        while len(self.workers) < self.threads:
+            worker = threading.Thread(
+                target=self.process_requests,
+                name=f"ztps-worker-{len(self.workers)}",
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.start_workers()
+        super().serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:  # pylint: disable=W0703
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.requests.put(None)
+        self.workers = []
+
+
+class PreforkServer:
+    """Runs a server in a number of forked worker processes which share
+    the listening socket.  Workers which exit unexpectedly are restarted.
+    """
+
+    RESPAWN_DELAY = 1
+
+    def __init__(self, server, workers=4):
+        self.server = server
+        self.workers = workers
+        self.children = {}
+        self.running = False
+        self.hup_handler = signal.SIG_DFL
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, self.hup_handler)
+            code = 0
+            try:
+                self.server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except Exception as exc:  # pylint: disable=W0703
+                log.error("Worker %s failed: %s", os.getpid(), exc)
+                code = 1
+            finally:
+                os._exit(code)  # pylint: disable=W0212
+
+        log.debug("Started worker %s", pid)
+        self.children[pid] = time.time()
+
+    def terminate(self, signum, frame):  # pylint: disable=W0613
+        self.running = False
+        raise SystemExit(0)
+
+    def forward(self, signum, frame):  # pylint: disable=W0613
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def serve_forever(self):
+        self.running = True
+        previous = signal.signal(signal.SIGTERM, self.terminate)
+        # workers keep the SIGHUP handler installed before the server
+        # is started
+        self.hup_handler = signal.getsignal(signal.SIGHUP)
+        try:
+            for _ in range(self.workers):
+                self.spawn()
+            signal.signal(signal.SIGHUP, self.forward)
+
+            while self.running:
+                pid, status = os.wait()
+                started = self.children.pop(pid, None)
+                if started is None or not self.running:
+                    continue
+
+                log.warning("Worker %s exited (status=%s) - restarting", pid, status)
+                if time.time() - started < self.RESPAWN_DELAY:
+                    time.sleep(self.RESPAWN_DELAY)
+                self.spawn()
+        finally:
+            self.running = False
+            self.shutdown()
+            signal.signal(signal.SIGTERM, previous)
+            signal.signal(signal.SIGHUP, self.hup_handler)
+
+    def shutdown(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            del self.children[pid]
+
+        self.server.server_close()
+
+    def server_close(self):
+        self.shutdown()
+
+
+def make_server(host, port, app, mode="single", **kwargs):
+    """Returns a server for the wsgi application ``app``
+
+    :param host: the address to bind to
+    :param port: the TCP port to listen on
+    :param app: the wsgi application to serve
+    :param mode: one of 'single' (single-threaded wsgiref server),
+                 'threaded' (pool of threads) or 'prefork' (pool of
+                 threads in each of a number of worker processes)
+    :param threads: number of threads per process (threaded and prefork)
+    :param workers: number of worker processes (prefork)
+    :param backlog: listen backlog (threaded and prefork)
+    :param keepalive_timeout: number of seconds an idle client connection
+                              is kept open; 0 disables persistent
+                              connections (threaded and prefork)
+    :param sendfile: send file responses using os.sendfile (if available)
+    """
+
+    if mode not in SERVER_MODES:
+        raise ValueError(f"Invalid server mode: {mode} is not one of {SERVER_MODES}")
+
+    if mode == "single":
+        server = make_simple_server(host, port, app, handler_class=SendfileRequestHandler)
+    else:
+        server = ThreadPoolWSGIServer(
+            (host, port),
+            threads=kwargs.get("threads", 16),
+            backlog=kwargs.get("backlog", 128),
+            keepalive_timeout=kwargs.get("keepalive_timeout", 5),
+        )
+        server.set_app(app)
+    server.sendfile = kwargs.get("sendfile", True) and hasattr(os, "sendfile")
+
+    if mode == "prefork":
+        return PreforkServer(server, workers=kwargs.get("workers", 4))
+    return server
@@ -49,13 +49,96 @@
 
 """
 
+import concurrent.futures
+import fnmatch
+import functools
+import glob
+import gzip
 import hashlib
+import json
 import logging
 import mimetypes
 import os
+import queue
+import select
+import tempfile
+import threading
+import time
 
 import ztpserver.serializers
+from ztpserver import inotify
+from ztpserver.config import runtime
 from ztpserver.serializers import SerializerError
+from ztpserver.utils import file_signature
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Changes made on other hosts are not reported by inotify
+NETWORK_FILESYSTEMS = [
+    "9p",
+    "afs",
+    "ceph",
+    "cifs",
+    "fuse.sshfs",
+    "glusterfs",
+    "gpfs",
+    "lustre",
+    "nfs",
+    "nfs4",
+    "smb3",
+    "smbfs",
+]
+
+# Index entry kinds
+FOLDER = "folder"
+FILE = "file"
+LINK = "link"
+
+WATCH_MASK = (
+    inotify.IN_CREATE
+    | inotify.IN_CLOSE_WRITE
+    | inotify.IN_DELETE
+    | inotify.IN_MOVED_FROM
+    | inotify.IN_MOVED_TO
+    | inotify.IN_DELETE_SELF
+    | inotify.IN_MOVE_SELF
+    | inotify.IN_ONLYDIR
+    | inotify.IN_DONT_FOLLOW
+)
+
+INDEXES = {}
+INDEXES_LOCK = threading.Lock()
+
+# Server-private state, relative to data_root
+STATE_FOLDER = ".ztps"
+DIGESTS_FN = "digests.json"
+
+DIGEST_CACHES = {}
+DIGEST_CACHES_LOCK = threading.Lock()
+
+# Repository path -> pid of the process running its prehash worker
+PREHASH_OWNERS = {}
+
+DIGEST_ALGORITHMS = ("sha1", "sha256", "md5")
+DIGEST_FOLDERS = ("actions", "files", "nodes")
+
+COMPRESSED_FOLDER = "compressed"
+
+COMPRESSION_CACHES = {}
+COMPRESSION_CACHES_LOCK = threading.Lock()
+
+# Content-Encoding -> extension of the compressed siblings
+COMPRESSED_EXTENSIONS = {"zstd": "zst", "gzip": "gz"}
+
+# Responses smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+
+# Files served as is (relative to the repository), whose siblings are
+# built as soon as they are added or written
+COMPRESSED_RESOURCES = ("actions/*", "nodes/*/startup-config")
 
 log = logging.getLogger(__name__)  # pylint: disable=C0103
 
@@ -63,7 +146,146 @@ log = logging.getLogger(__name__)  # pylint: disable=C0103
 def create_repository(path):
     if not os.path.exists(path):
         raise RepositoryError(f"{path} not found")
-    return Repository(path)
+
+    method = runtime.repository.index
+    index = None
+    if method != "off":
+        index = get_index(path, method, runtime.repository.poll_interval)
+    return Repository(path, index=index, digests=get_digest_cache(path))
+
+
+def get_index(path, method, interval):
+    """Returns the (per process) index of the repository at path"""
+
+    key = (os.path.normpath(path), method, interval, os.getpid())
+    with INDEXES_LOCK:
+        index = INDEXES.get(key)
+        if index is None or not index.active:
+            index = RepositoryIndex(path, method, interval)
+            index.start()
+            INDEXES[key] = index
+        return index
+
+
+def get_digest_cache(path):
+    """Returns the (per process) digest cache of the repository at path
+
+    With prehash, the first process to get the cache runs the worker (see
+    start_prehash), the processes forked from it share its digests
+    through the sidecar file.
+    """
+
+    key = (os.path.normpath(path), os.getpid())
+    with DIGEST_CACHES_LOCK:
+        cache = DIGEST_CACHES.get(key)
+        if cache is None:
+            cache = DigestCache(os.path.join(path, STATE_FOLDER, DIGESTS_FN))
+            DIGEST_CACHES[key] = cache
+            owner = PREHASH_OWNERS.setdefault(key[0], key[1])
+            if runtime.repository.prehash and owner != key[1]:
+                # hashed by the worker of the process which owns it
+                cache.background = True
+            elif runtime.repository.prehash:
+                # the worker follows the changes through the index, which is
+                # started for it even if the repository does not use it
+                method = runtime.repository.index
+                index = get_index(
+                    path,
+                    "auto" if method == "off" else method,
+                    runtime.repository.poll_interval,
+                )
+                cache.start_worker(index, DIGEST_FOLDERS, runtime.repository.prehash_workers)
+        return cache
+
+
+def start_prehash(path):
+    """Starts hashing the repository at path in this process, e.g. before
+    the server forks its workers, so that the files are hashed once, as
+    soon as they are added (rather than by each worker, once requested)"""
+
+    return get_digest_cache(path).worker
+
+
+def get_compression_cache(path):
+    """Returns the (per process) cache of compressed responses of the
+    repository at path"""
+
+    key = (os.path.normpath(path), os.getpid())
+    with COMPRESSION_CACHES_LOCK:
+        cache = COMPRESSION_CACHES.get(key)
+        if cache is None:
+            cache = CompressionCache(os.path.join(path, STATE_FOLDER, COMPRESSED_FOLDER))
+            COMPRESSION_CACHES[key] = cache
+            if runtime.repository.compress:
+                # as for prehash, the index is started even if the
+                # repository does not use it
+                method = runtime.repository.index
+                index = get_index(
+                    path,
+                    "auto" if method == "off" else method,
+                    runtime.repository.poll_interval,
+                )
+                cache.start_worker(index, COMPRESSED_RESOURCES)
+        return cache
+
+
+def content_encodings():
+    """Returns the supported content encodings, in order of preference
+    (zstd requires the zstandard package)"""
+
+    if zstandard is None:
+        return ["gzip"]
+    return ["zstd", "gzip"]
+
+
+def compress(data, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=19).compress(data)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def compute_digests(path, algorithms):
+    """Returns the hex digests of the contents of the file at path, for
+    each of the algorithms (reading the file once)
+
+    :raises: IOError
+    """
+
+    digests = {x: hashlib.new(x) for x in algorithms}
+    with open(path, mode="rb") as fd:
+        while True:
+            data = fd.read(FileObject.BUF_SIZE)
+            if not data:
+                break
+            for digest in digests.values():
+                digest.update(data)
+    return {x: digest.hexdigest() for x, digest in digests.items()}
+
+
+@functools.lru_cache(maxsize=4096)
+def guess_type(name):
+    return mimetypes.guess_type(name)
+
+
+def filesystem_type(path):
+    """Returns the type of the file system path is stored on, or None
+    if it cannot be determined"""
+
+    path = os.path.realpath(path)
+    result = (None, None)
+    try:
+        with open("/proc/self/mounts", encoding="utf8") as fd:
+            for line in fd:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mountpoint = fields[1].replace("\\040", " ")
+                if path == mountpoint or path.startswith(mountpoint.rstrip("/") + "/"):
+                    if result[0] is None or len(mountpoint) >= len(result[0]):
+                        result = (mountpoint, fields[2])
+    except OSError:
+        pass
+    return result[1]
 
 
 class RepositoryError(Exception):
@@ -103,8 +325,10 @@ class FileObject:
         if path is not None:
             self.name = os.path.join(path, name)
 
-        self.type, self.encoding = mimetypes.guess_type(self.name)
+        self.type, self.encoding = guess_type(self.name)
         self.content_type = kwargs.get("content_type")
+        self.index = kwargs.get("index")
+        self.digests = kwargs.get("digests")
 
     def __repr__(self):
         return (
@@ -158,6 +382,11 @@ class FileObject:
         except SerializerError as err:
             raise FileObjectError(str(err)) from err
 
+        if self.index:
+            self.index.add(self.name)
+        if self.digests is not None and self.digests.worker is not None:
+            self.digests.worker.submit(self.name)
+
     def size(self):
         """Returns the size of the object in bytes.
 
@@ -165,20 +394,18 @@ class FileObject:
         """
         return os.path.getsize(self.name)
 
-    def hash(self):
-        """Returns the SHA1 hash of the object.
+    def hash(self, algorithm="sha1", block=True):
+        """Returns the hash of the object (SHA1 by default).
+
+        If block is False, returns None if the hash is still being computed
+        in the background (see :py:meth:`DigestCache.get`).
 
         :raises: IOError
         """
 
-        sha1 = hashlib.sha1()
-        with open(self.name, mode="rb") as fd:
-            while True:
-                data = fd.read(self.BUF_SIZE)
-                if not data:
-                    break
-                sha1.update(data)
-        return sha1.hexdigest()
+        if self.digests is not None:
+            return self.digests.get(self.name, algorithm, block)
+        return compute_digests(self.name, [algorithm])[algorithm]
 
 
 class Repository:
@@ -187,15 +414,21 @@ class Repository:
     with persistently stored files.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, index=None, digests=None):
         """The initialize method for :py:class:`Repository`
 
         :param path: the base path of the repository
         :type path: str
+        :param index: index of the files in the repository (optional)
+        :type index: :py:class:`RepositoryIndex`
+        :param digests: cache of the digests of the files (optional)
+        :type digests: :py:class:`DigestCache`
         :returns: object
 
         """
         self.path = path
+        self.index = index
+        self.digests = digests
 
     def __repr__(self):
         return f"Repository(path={self.path})"
@@ -230,6 +463,8 @@ class Repository:
         try:
             folder_path = self.expand(folder_path)
             os.makedirs(folder_path, 0o774)
+            if self.index:
+                self.index.add(folder_path, FOLDER)
             return folder_path
         except OSError as err:
             log.error("Failed to add folder %s (%s)", folder_path, err)
@@ -256,7 +491,7 @@ class Repository:
 
         """
         file_path = self.expand(file_path)
-        obj = FileObject(file_path)
+        obj = FileObject(file_path, index=self.index, digests=self.digests)
         if contents:
             obj.write(contents, content_type)
         return obj
@@ -270,6 +505,8 @@ class Repository:
 
         """
         file_path = self.expand(file_path)
+        if self.index:
+            return self.index.exists(file_path)
         return os.path.exists(file_path)
 
     def get_file(self, file_path):
@@ -287,7 +524,7 @@ class Repository:
         file_path = self.expand(file_path)
         if not self.exists(file_path):
             raise FileObjectNotFound(f"file not found ({file_path})")
-        return FileObject(file_path)
+        return FileObject(file_path, index=self.index, digests=self.digests)
 
     def delete_file(self, file_path):
         """Deletes an existing file in the respository
@@ -301,6 +538,848 @@ class Repository:
         try:
             file_path = self.expand(file_path)
             os.remove(file_path)
+            if self.index:
+                self.index.remove(file_path)
         except OSError as err:
             log.error("Failed to delete file %s (%s)", file_path, err)
             raise RepositoryError(f"Failed to delete file {file_path} ({err})") from err
+
+
+class RepositoryIndex:
+    """The :py:class:`RepositoryIndex` keeps an in-memory copy of the tree
+    of files and folders in a repository, so that checking whether a file
+    exists does not hit the file system.  The index is kept current using
+    inotify or, if inotify is not available (or cannot see all changes,
+    e.g. for NFS, or fails, e.g. out of watches), by rescanning the tree
+    periodically.
+
+    Listeners (see subscribe) are notified of the files which were added
+    or written, or of each rescan (after which any file may have changed).
+
+    Symbolic links (and anything below them) are not indexed: lookups for
+    those fall back to the file system.
+    """
+
+    def __init__(self, path, method="auto", interval=5):
+        """The initialize method for :py:class:`RepositoryIndex`
+
+        :param path: the base path of the repository
+        :type path: str
+        :param method: one of 'auto', 'inotify' or 'poll'
+        :type method: str
+        :param interval: number of seconds between rescans ('poll')
+        :type interval: int
+        :returns: object
+
+        """
+        self.path = os.path.normpath(path)
+        self.method = method
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changes = None
+        self.watches = {}
+        self.inotify = None
+        self.thread = None
+        self.active = False
+        self.listeners = []
+        self.stats = {"hits": 0, "misses": 0, "scans": 0}
+
+    def __repr__(self):
+        return (
+            f"RepositoryIndex(path={self.path}, method={self.method}, "
+            f"entries={len(self.entries)}, hits={self.stats['hits']}, "
+            f"misses={self.stats['misses']}, scans={self.stats['scans']})"
+        )
+
+    def start(self):
+        """Builds the index and starts keeping it current"""
+
+        method = self.method
+        if method == "auto":
+            fstype = filesystem_type(self.path)
+            method = "poll" if fstype in NETWORK_FILESYSTEMS else "inotify"
+
+        if method == "inotify":
+            try:
+                self.inotify = inotify.Inotify()
+                self.rescan()
+            except OSError as err:
+                log.warning("Unable to use inotify for %s (%s) - polling instead", self.path, err)
+                self.stop()
+                method = "poll"
+
+        if method == "poll":
+            self.rescan()
+
+        self.method = method
+        self.active = True
+        self.thread = threading.Thread(
+            target=self.watch if method == "inotify" else self.poll,
+            name=f"index-{self.path}",
+            daemon=True,
+        )
+        self.thread.start()
+        log.info("Indexed repository %s: %s", self.path, self)
+
+    def stop(self):
+        self.active = False
+        if self.thread is None:
+            self.close()
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+        self.watches = {}
+
+    def subscribe(self, listener):
+        """Registers listener(paths), called (from the index thread) with
+        the list of files added or written, or with None after a rescan"""
+
+        with self.lock:
+            self.listeners.append(listener)
+
+    def notify(self, paths):
+        if paths is not None and not paths:
+            return
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener(paths)
+            except Exception as err:  # pylint: disable=W0703
+                log.error("Failed to notify %s of changes in %s: %s", listener, self.path, err)
+
+    def files(self, folder=None):
+        """Returns the files indexed below folder (default: all files)"""
+
+        prefix = os.path.normpath(folder or self.path) + os.sep
+        return [
+            path
+            for path, kind in list(self.entries.items())
+            if kind == FILE and path.startswith(prefix)
+        ]
+
+    def lookup(self, path):
+        """Returns True/False if path is known to exist/not to exist,
+        or None if the index does not know"""
+
+        entries = self.entries
+        kind = entries.get(path)
+        if kind is None:
+            path = os.path.normpath(path)
+            kind = entries.get(path)
+        if kind is None:
+            # Missing if the closest indexed ancestor is a folder
+            parent = os.path.dirname(path)
+            while parent not in entries:
+                if not parent.startswith(self.path + os.sep):
+                    return None
+                parent = os.path.dirname(parent)
+            return False if entries[parent] == FOLDER else None
+        if kind == LINK:
+            return None
+        return True
+
+    def exists(self, path):
+        result = self.lookup(path) if self.active else None
+        if result is None:
+            self.stats["misses"] += 1
+            return os.path.exists(path)
+
+        self.stats["hits"] += 1
+        return result
+
+    def add(self, path, kind=FILE):
+        """Records a file or folder (and its parents) created by the server"""
+
+        path = os.path.normpath(path)
+        with self.lock:
+            if self.changes is not None:
+                self.changes.append((path, kind))
+            self.add_entry(self.entries, path, kind)
+
+    def remove(self, path):
+        """Records the removal of a file by the server"""
+
+        path = os.path.normpath(path)
+        with self.lock:
+            if self.changes is not None:
+                self.changes.append((path, None))
+            self.entries.pop(path, None)
+
+    def add_entry(self, entries, path, kind):
+        # Only paths below indexed folders (e.g. not below symbolic links)
+        folders = []
+        parent = os.path.dirname(path)
+        while parent not in entries:
+            if not parent.startswith(self.path + os.sep):
+                return
+            folders.append(parent)
+            parent = os.path.dirname(parent)
+        if entries[parent] != FOLDER:
+            return
+
+        for folder in folders:
+            entries[folder] = FOLDER
+        entries[path] = kind
+
+    def scan(self, folder, entries, watches):
+        """Adds folder, and everything below it, to entries"""
+
+        if self.inotify:
+            # Watch first, so that nothing created while scanning is lost
+            watches[self.inotify.add_watch(folder, WATCH_MASK)] = folder
+
+        try:
+            items = list(os.scandir(folder))
+        except OSError as err:
+            log.debug("Unable to index %s (%s)", folder, err)
+            entries[folder] = LINK
+            return
+
+        entries[folder] = FOLDER
+        for item in items:
+            try:
+                if item.is_symlink():
+                    entries[item.path] = LINK
+                elif item.is_dir(follow_symlinks=False):
+                    self.scan(item.path, entries, watches)
+                else:
+                    entries[item.path] = FILE
+            except OSError:
+                entries[item.path] = LINK
+
+    def rescan(self):
+        """Rebuilds the whole index"""
+
+        with self.lock:
+            self.changes = []
+
+        entries = {}
+        watches = {}
+        try:
+            self.scan(self.path, entries, watches)
+        finally:
+            with self.lock:
+                changes, self.changes = self.changes, None
+
+        with self.lock:
+            # Apply the changes made by the server while scanning
+            for path, kind in changes:
+                if kind is None:
+                    entries.pop(path, None)
+                else:
+                    self.add_entry(entries, path, kind)
+
+            if self.inotify:
+                for wd in set(self.watches) - set(watches):
+                    self.inotify.rm_watch(wd)
+            self.entries = entries
+            self.watches = watches
+            self.stats["scans"] += 1
+
+        self.notify(None)
+
+    def poll(self, delay=True):
+        """Rescans the tree every interval seconds (the first time right
+        away, unless delay)"""
+
+        while self.active:
+            if delay:
+                time.sleep(self.interval)
+            delay = True
+            try:
+                self.rescan()
+            except Exception as err:  # pylint: disable=W0703
+                log.error("Failed to rescan repository %s: %s", self.path, err)
+
+    def watch(self):
+        try:
+            while self.active:
+                readable, _, _ = select.select([self.inotify.fd], [], [], 1)
+                if readable:
+                    self.process(self.inotify.read())
+        except Exception as err:  # pylint: disable=W0703
+            # e.g. out of inotify watches (ENOSPC) for a new folder: the
+            # index is kept current by rescanning instead, starting with
+            # the changes missed meanwhile
+            log.error("Unable to watch repository %s (%s) - polling instead", self.path, err)
+            with self.lock:
+                self.close()
+                self.method = "poll"
+            self.poll(delay=False)
+        finally:
+            self.close()
+
+    def process(self, events):
+        rescan = False
+        changes = []
+        with self.lock:
+            for wd, mask, _, name in events:
+                if mask & inotify.IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+
+                folder = self.watches.get(wd)
+                if folder is None:
+                    continue
+
+                if mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                    if folder == self.path:
+                        log.warning("Repository %s was removed or moved", self.path)
+                        self.active = False
+                        return
+                    continue
+
+                if mask & inotify.IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+
+                path = os.path.join(folder, name)
+                if mask & inotify.IN_ISDIR and mask & (inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO):
+                    # watches below a moved folder refer to the old paths
+                    rescan = True
+                elif mask & inotify.IN_ISDIR and mask & inotify.IN_CREATE:
+                    entries = {}
+                    self.scan(path, entries, self.watches)
+                    self.entries.update(entries)
+                    changes.extend(x for x, kind in entries.items() if kind == FILE)
+                elif mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    self.entries[path] = LINK if os.path.islink(path) else FILE
+                    if mask & inotify.IN_MOVED_TO:
+                        changes.append(path)
+                elif mask & inotify.IN_CLOSE_WRITE:
+                    # files being created are notified once written
+                    changes.append(path)
+                elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    self.entries.pop(path, None)
+                    if mask & inotify.IN_ISDIR:
+                        prefix = path + os.sep
+                        for entry in [x for x in self.entries if x.startswith(prefix)]:
+                            del self.entries[entry]
+
+        if rescan:
+            self.rescan()
+        else:
+            self.notify(changes)
+
+
+class DigestComputation:
+    """A digest being computed - other requests for it wait for the result"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DigestCache:
+    """The :py:class:`DigestCache` keeps the digests of files, keyed on the
+    (inode, size, mtime) signature of each file, so that a file is only
+    hashed again after it changes.  The digests are persisted in a sidecar
+    file (shared by all server processes) in order to survive restarts.
+    """
+
+    SAVE_INTERVAL = 1
+
+    def __init__(self, filename):
+        """The initialize method for :py:class:`DigestCache`
+
+        :param filename: path of the sidecar file
+        :type filename: str
+        :returns: object
+
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.signature = None
+        self.computations = {}
+        self.worker = None
+        # the digests are computed in the background (by the worker of
+        # this process, or of the process which owns it)
+        self.background = False
+        self.dirty = False
+        self.saved = 0
+        self.stats = {"hits": 0, "misses": 0, "waits": 0}
+
+    def __repr__(self):
+        return (
+            f"DigestCache(filename={self.filename}, entries={len(self.entries)}, "
+            f"hits={self.stats['hits']}, misses={self.stats['misses']}, "
+            f"waits={self.stats['waits']})"
+        )
+
+    def lookup(self, path, signature, algorithm):
+        entry = self.entries.get(path)
+        if entry and tuple(entry["signature"]) == signature:
+            return entry["digests"].get(algorithm)
+        return None
+
+    def refresh(self):
+        """Merges the entries saved (e.g. by other processes) since the
+        sidecar file was last read"""
+
+        signature = file_signature(self.filename)
+        if signature is None or signature == self.signature:
+            return
+
+        try:
+            with open(self.filename, encoding="utf8") as fd:
+                entries = json.load(fd)
+        except (OSError, ValueError) as err:
+            log.warning("Ignoring digest cache %s: %s", self.filename, err)
+            return
+
+        for path, entry in entries.items():
+            current = self.entries.get(path)
+            if current is None or current["signature"] != entry["signature"]:
+                self.entries[path] = entry
+            else:
+                entry["digests"].update(current["digests"])
+                current["digests"] = entry["digests"]
+        self.signature = signature
+
+    def save(self):
+        folder = os.path.dirname(self.filename)
+        self.dirty = False
+        self.saved = time.time()
+        try:
+            os.makedirs(folder, exist_ok=True)
+
+            # Drop the entries of files which changed or no longer exist
+            entries = {
+                path: entry
+                for path, entry in self.entries.items()
+                if list(file_signature(path) or []) == list(entry["signature"])
+            }
+
+            with tempfile.NamedTemporaryFile(
+                "w", dir=folder, prefix=f".{DIGESTS_FN}.", delete=False
+            ) as fd:
+                json.dump(entries, fd)
+            os.replace(fd.name, self.filename)
+
+            self.entries = entries
+            self.signature = file_signature(self.filename)
+        except OSError as err:
+            log.warning("Unable to save digest cache %s: %s", self.filename, err)
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    def pending(self, path, algorithms=DIGEST_ALGORITHMS):
+        """Returns True if any of the digests of path is not cached"""
+
+        signature = file_signature(path)
+        if signature is None:
+            return False
+
+        with self.lock:
+            if any(self.lookup(path, signature, x) is None for x in algorithms):
+                self.refresh()
+                return any(self.lookup(path, signature, x) is None for x in algorithms)
+        return False
+
+    def get(self, path, algorithm="sha1", block=True):
+        """Returns the digest of the file at path
+
+        If block is False and the digests are computed in the background,
+        returns None instead of waiting for a digest which is not cached
+        yet (the file is queued for the worker of this process, if any).
+
+        :raises: IOError
+        """
+
+        if not block and self.background and self.pending(path, [algorithm]):
+            if self.worker is not None:
+                self.worker.submit(path)
+            return None
+        return self.digests(path, [algorithm])[algorithm]
+
+    def digests(self, path, algorithms):
+        """Returns the digests of the file at path, reading it at most once
+
+        :raises: IOError
+        """
+
+        signature = file_signature(path)
+        if signature is None:
+            return compute_digests(path, algorithms)
+
+        results = {}
+        waiting = {}
+        owned = {}
+        with self.lock:
+            missing = [x for x in algorithms if self.lookup(path, signature, x) is None]
+            if missing:
+                self.refresh()
+
+            for algorithm in algorithms:
+                digest = self.lookup(path, signature, algorithm)
+                key = (path, signature, algorithm)
+                if digest is not None:
+                    self.stats["hits"] += 1
+                    results[algorithm] = digest
+                elif key in self.computations:
+                    self.stats["waits"] += 1
+                    waiting[algorithm] = self.computations[key]
+                else:
+                    self.stats["misses"] += 1
+                    owned[algorithm] = self.computations[key] = DigestComputation()
+
+        if owned:
+            self.compute(path, signature, owned)
+
+        for algorithm, computation in list(owned.items()) + list(waiting.items()):
+            results[algorithm] = computation.wait()
+        return results
+
+    def compute(self, path, signature, computations):
+        try:
+            digests = compute_digests(path, list(computations))
+        except Exception as err:  # pylint: disable=W0703
+            digests = {}
+            for computation in computations.values():
+                computation.error = err
+
+        with self.lock:
+            # Only keep the digests if the file did not change meanwhile
+            if digests and file_signature(path) == signature:
+                self.refresh()
+                entry = self.entries.get(path)
+                if entry is None or tuple(entry["signature"]) != signature:
+                    entry = {"signature": list(signature), "digests": {}}
+                    self.entries[path] = entry
+                entry["digests"].update(digests)
+
+                # The worker saves the entries it computes in batches
+                if self.worker is None or time.time() - self.saved >= self.SAVE_INTERVAL:
+                    self.save()
+                else:
+                    self.dirty = True
+
+            for algorithm, computation in computations.items():
+                del self.computations[(path, signature, algorithm)]
+                computation.result = digests.get(algorithm)
+                computation.done.set()
+
+        if digests:
+            log.debug("Computed %s digests of %s (%s)", "/".join(digests), path, self)
+
+    def start_worker(self, index, folders, workers):
+        """Starts computing the digests of all the files in folders (of
+        the repository of index) in the background"""
+
+        if self.worker is None:
+            self.worker = DigestWorker(self, index, folders, workers)
+            self.worker.start()
+            self.background = True
+        return self.worker
+
+
+class CompressionCache:
+    """The :py:class:`CompressionCache` keeps the compressed copies of
+    responses (e.g. actions, definitions) as siblings in the state folder
+    of the repository, named after the response (one per encoding) and
+    the digest of its contents.  A response is only compressed again
+    after its contents change and the siblings survive restarts.
+
+    The siblings of the files served as is (see
+    :py:class:`CompressionWorker`) are built as soon as the files change,
+    the others when they are first requested.
+    """
+
+    def __init__(self, folder):
+        """The initialize method for :py:class:`CompressionCache`
+
+        :param folder: path of the folder holding the siblings
+        :type folder: str
+        :returns: object
+
+        """
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.stats = {"hits": 0, "misses": 0}
+        self.worker = None
+
+    def __repr__(self):
+        return (
+            f"CompressionCache(folder={self.folder}, entries={len(self.entries)}, "
+            f"hits={self.stats['hits']}, misses={self.stats['misses']})"
+        )
+
+    def get(self, name, data, encoding):
+        """Returns data compressed with encoding
+
+        :param name: name of the response (relative path of its sibling)
+        :type name: str
+        :param data: the uncompressed contents
+        :type data: bytes
+        :param encoding: one of :py:func:`content_encodings`
+        :type encoding: str
+        """
+
+        key = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            entry = self.entries.get((name, encoding))
+            if entry is not None and entry[0] == key:
+                self.stats["hits"] += 1
+                return entry[1]
+
+        extension = COMPRESSED_EXTENSIONS[encoding]
+        base = os.path.join(self.folder, name)
+        filename = f"{base}.{key}.{extension}"
+        try:
+            with open(filename, "rb") as fd:
+                compressed = fd.read()
+            with self.lock:
+                self.stats["hits"] += 1
+        except OSError:
+            with self.lock:
+                self.stats["misses"] += 1
+            compressed = compress(data, encoding)
+            self.save(filename, compressed)
+
+            # Remove the siblings of previous versions of the response
+            pattern = f"{glob.escape(base)}.{'[0-9a-f]' * len(key)}.{extension}"
+            for sibling in glob.glob(pattern):
+                if sibling != filename:
+                    try:
+                        os.remove(sibling)
+                    except OSError:
+                        pass
+
+        with self.lock:
+            self.entries[(name, encoding)] = (key, compressed)
+        return compressed
+
+    def start_worker(self, index, patterns):
+        """Starts building the siblings of the files matching patterns
+        (relative to the repository of index) in the background"""
+
+        if self.worker is None:
+            self.worker = CompressionWorker(self, index, patterns)
+            self.worker.start()
+        return self.worker
+
+    def save(self, filename, data):
+        folder = os.path.dirname(filename)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "wb", dir=folder, prefix=f".{os.path.basename(filename)}.", delete=False
+            ) as fd:
+                fd.write(data)
+            os.replace(fd.name, filename)
+        except OSError as err:
+            log.warning("Unable to save compressed response %s: %s", filename, err)
+
+
+class DigestWorker:
+    """The :py:class:`DigestWorker` computes the (missing) digests of the
+    files in folders of the repository in a pool of threads, so that
+    requests for the digests do not have to wait for them.  The files to
+    hash are picked up through the notifications of the repository index
+    (files added or written, or all the files after a rescan).
+    """
+
+    def __init__(self, cache, index, folders, workers=2):
+        """The initialize method for :py:class:`DigestWorker`
+
+        :param cache: the digest cache to fill
+        :type cache: :py:class:`DigestCache`
+        :param index: the index of the repository
+        :type index: :py:class:`RepositoryIndex`
+        :param folders: the folders to hash, relative to the repository
+        :type folders: list
+        :param workers: number of files hashed in parallel
+        :type workers: int
+        :returns: object
+
+        """
+        self.cache = cache
+        self.index = index
+        self.path = index.path
+        self.folders = [os.path.join(self.path, x) for x in folders]
+
+        self.lock = threading.Lock()
+        self.queued = set()
+        self.changes = queue.Queue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="digest"
+        )
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats = {"scans": 0, "files": 0}
+
+    def __repr__(self):
+        return (
+            f"DigestWorker(path={self.path}, queued={len(self.queued)}, "
+            f"scans={self.stats['scans']}, files={self.stats['files']})"
+        )
+
+    def start(self):
+        # all the files are checked once, after subscribing so that no
+        # change is missed
+        self.index.subscribe(self.changes.put)
+        self.changes.put(None)
+        self.thread = threading.Thread(target=self.run, name=f"digests-{self.path}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False)
+
+    def submit(self, path):
+        """Queues path for hashing, unless it is already queued"""
+
+        with self.lock:
+            if path in self.queued or self.stopped.is_set():
+                return
+            self.queued.add(path)
+
+        try:
+            self.executor.submit(self.hash, path)
+        except RuntimeError:
+            # shutting down
+            with self.lock:
+                self.queued.discard(path)
+
+    def hash(self, path):
+        try:
+            self.cache.digests(path, DIGEST_ALGORITHMS)
+            self.stats["files"] += 1
+        except Exception as err:  # pylint: disable=W0703
+            log.debug("Unable to compute the digests of %s: %s", path, err)
+        finally:
+            with self.lock:
+                self.queued.discard(path)
+
+    def process(self, paths):
+        """Queues the files in paths (None: all the indexed files) which
+        are in folders and whose digests are not cached"""
+
+        if paths is None:
+            paths = [path for folder in self.folders for path in self.index.files(folder)]
+            self.stats["scans"] += 1
+        else:
+            paths = [x for x in paths if any(x.startswith(y + os.sep) for y in self.folders)]
+
+        for path in paths:
+            if self.cache.pending(path):
+                self.submit(path)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                paths = self.changes.get(timeout=self.cache.SAVE_INTERVAL)
+            except queue.Empty:
+                paths = []
+            try:
+                self.process(paths)
+            except Exception as err:  # pylint: disable=W0703
+                log.error("Failed to queue %s for digests: %s", self.path, err)
+            self.cache.flush()
+        self.cache.flush()
+
+
+class CompressionWorker:
+    """The :py:class:`CompressionWorker` builds the compressed siblings of
+    the files served as is (e.g. actions) in the background, as soon as
+    the repository index reports them added or written, so that the first
+    request for a new version of a file does not wait for its compression.
+    """
+
+    def __init__(self, cache, index, patterns):
+        """The initialize method for :py:class:`CompressionWorker`
+
+        :param cache: the compression cache to fill
+        :type cache: :py:class:`CompressionCache`
+        :param index: the index of the repository
+        :type index: :py:class:`RepositoryIndex`
+        :param patterns: the files to compress, relative to the repository
+        :type patterns: list
+        :returns: object
+
+        """
+        self.cache = cache
+        self.index = index
+        self.path = index.path
+        self.patterns = patterns
+
+        # path -> signature of the last version compressed
+        self.signatures = {}
+        self.changes = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats = {"scans": 0, "files": 0}
+
+    def __repr__(self):
+        return (
+            f"CompressionWorker(path={self.path}, scans={self.stats['scans']}, "
+            f"files={self.stats['files']})"
+        )
+
+    def start(self):
+        self.index.subscribe(self.changes.put)
+        self.changes.put(None)
+        self.thread = threading.Thread(
+            target=self.run, name=f"compression-{self.path}", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.changes.put([])
+
+    def process(self, paths):
+        """Compresses the files in paths (None: all the indexed files)
+        which match the patterns"""
+
+        if paths is None:
+            paths = self.index.files()
+            self.stats["scans"] += 1
+
+        for path in paths:
+            name = os.path.relpath(path, self.path)
+            if any(fnmatch.fnmatch(name, x) for x in self.patterns):
+                self.compress(path, name)
+
+    def compress(self, path, name):
+        signature = file_signature(path)
+        if signature is None or self.signatures.get(path) == signature:
+            return
+
+        try:
+            with open(path, "rb") as fd:
+                data = fd.read()
+        except OSError as err:
+            log.debug("Unable to compress %s: %s", path, err)
+            return
+
+        if len(data) >= COMPRESS_MIN_SIZE:
+            for encoding in content_encodings():
+                self.cache.get(name, data, encoding)
+            self.stats["files"] += 1
+        self.signatures[path] = signature
+
+    def run(self):
+        while not self.stopped.is_set():
+            paths = self.changes.get()
+            try:
+                self.process(paths)
+            except Exception as err:  # pylint: disable=W0703
+                log.error("Failed to compress the files of %s: %s", self.path, err)
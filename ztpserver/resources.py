@@ -30,12 +30,45 @@
 # IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import collections
+import concurrent.futures
+import copy
+import hashlib
 import importlib.machinery
 import importlib.util
+import json
+import logging
 import os
 import sys
+import threading
+import time
+from collections import OrderedDict
 
 from ztpserver.config import runtime
+from ztpserver.constants import CONTENT_TYPE_YAML
+from ztpserver.serializers import dump, file_lock, load, write_file
+from ztpserver.utils import file_signature
+
+PLUGIN_IMPORT_LOCK = threading.Lock()
+
+# Number of journaled allocations after which a pool file is rewritten
+JOURNAL_COMPACT_ENTRIES = 1000
+
+# Number of seconds after an allocation within which the pool file is
+# rewritten with it (and the allocations journaled meanwhile)
+JOURNAL_COMPACT_DELAY = 1
+
+RESOURCE_POOLS = {}
+RESOURCE_POOLS_LOCK = threading.Lock()
+
+# Maximum number of plugin results kept by the plugin cache
+PLUGIN_CACHE_SIZE = 4096
+
+PLUGIN_EXECUTORS = {}
+PLUGIN_SEMAPHORES = {}
+PLUGIN_EXECUTORS_LOCK = threading.Lock()
+
+log = logging.getLogger(__name__)  # pylint: disable=C0103
 
 
 def resource_plugins():
@@ -48,17 +81,470 @@ def resource_plugins():
     return plugins
 
 
-def run_plugin(plugin, node_id, pool, node):
-    filename = os.path.join(runtime.default.data_root, "plugins", plugin)
-    try:
+def load_plugin(plugin):
+    """Returns the module of the plugin (imported on first use)"""
+
+    with PLUGIN_IMPORT_LOCK:
         if plugin not in sys.modules:
+            filename = os.path.join(runtime.default.data_root, "plugins", plugin)
             loader = importlib.machinery.SourceFileLoader(plugin, filename)
             spec = importlib.util.spec_from_loader(loader.name, loader)
             module = importlib.util.module_from_spec(spec)
             sys.modules[plugin] = module
-            spec.loader.exec_module(module)
+            try:
+                spec.loader.exec_module(module)
+            except Exception:
+                del sys.modules[plugin]
+                raise
+
+    return sys.modules[plugin]
+
+
+def neighbors_digest(node):
+    """Returns a digest of the neighbors of node, which the results of
+    plugins may depend on (e.g. mysql_vars)"""
 
-        module = sys.modules[plugin]
-        return module.main(node_id, pool, node)
+    if node is None:
+        return None
+    neighbors = json.dumps(sorted(node.neighbors.items()))
+    return hashlib.sha1(neighbors.encode("utf8")).hexdigest()
+
+
+def run_plugin(plugin, node_id, pool, node):
+    try:
+        module = load_plugin(plugin)
+
+        # plugins opt into the plugin cache by declaring CACHE_TTL
+        ttl = getattr(module, "CACHE_TTL", None)
+        if not ttl:
+            return module.main(node_id, pool, node)
+
+        key = (plugin, pool, node_id, neighbors_digest(node))
+        value = plugin_cache.get(key)
+        if value is plugin_cache.MISSING:
+            value = module.main(node_id, pool, node)
+            plugin_cache.set(key, value, ttl)
+        return value
     except Exception as exc:
         raise RuntimeError(f"failed to run plugin: {exc}") from exc
+
+
+def plugin_executor():
+    """Returns the (per process) thread pool running plugins"""
+
+    pid = os.getpid()
+    with PLUGIN_EXECUTORS_LOCK:
+        executor = PLUGIN_EXECUTORS.get(pid)
+        if executor is None:
+            executor = PLUGIN_EXECUTORS[pid] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=runtime.plugins.threads, thread_name_prefix="plugin"
+            )
+        return executor
+
+
+def plugin_limits(plugin):
+    """Returns the timeout of the calls to plugin and the semaphore
+    limiting the number of concurrent calls (or None).  Plugins declare
+    them as TIMEOUT (seconds) and CONCURRENCY."""
+
+    try:
+        module = load_plugin(plugin)
+    except Exception:  # pylint: disable=W0703
+        # reported by run_plugin
+        return runtime.plugins.timeout, None
+
+    timeout = getattr(module, "TIMEOUT", None) or runtime.plugins.timeout
+    concurrency = getattr(module, "CONCURRENCY", None)
+    if not concurrency:
+        return timeout, None
+
+    with PLUGIN_EXECUTORS_LOCK:
+        semaphore = PLUGIN_SEMAPHORES.get((plugin, concurrency))
+        if semaphore is None:
+            semaphore = PLUGIN_SEMAPHORES[(plugin, concurrency)] = threading.BoundedSemaphore(
+                concurrency
+            )
+    return timeout, semaphore
+
+
+def run_plugins(calls, node_id, node, run=run_plugin):
+    """Runs run(plugin, node_id, arg, node) for each (plugin, arg) in calls
+    concurrently, on the plugin thread pool, and returns the results keyed
+    on (plugin, arg).
+
+    Each call must complete within the timeout of its plugin.  As soon as
+    a call fails or is late, the calls which have not started are
+    cancelled and a RuntimeError is raised (calls which are running cannot
+    be interrupted: CONCURRENCY bounds the number of threads a plugin can
+    hold).
+    """
+
+    def call(plugin, arg, semaphore):
+        if semaphore is None:
+            return run(plugin, node_id, arg, node)
+        with semaphore:
+            return run(plugin, node_id, arg, node)
+
+    executor = plugin_executor()
+    futures = {}
+    start = time.monotonic()
+    for plugin, arg in calls:
+        timeout, semaphore = plugin_limits(plugin)
+        future = executor.submit(call, plugin, arg, semaphore)
+        futures[future] = (plugin, arg, start + timeout)
+
+    pending = set(futures)
+    try:
+        while pending:
+            deadline = min(futures[future][2] for future in pending)
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=max(deadline - time.monotonic(), 0),
+                return_when=concurrent.futures.FIRST_EXCEPTION,
+            )
+            for future in done:
+                if future.exception() is not None:
+                    plugin, arg, _ = futures[future]
+                    raise RuntimeError(
+                        f"{node_id}: {plugin}('{arg}') failed: {future.exception()}"
+                    ) from future.exception()
+
+            now = time.monotonic()
+            for future in pending:
+                plugin, arg, deadline = futures[future]
+                if deadline <= now:
+                    raise RuntimeError(
+                        f"{node_id}: {plugin}('{arg}') timed out after "
+                        f"{deadline - start:.0f} second(s)"
+                    )
+    finally:
+        for future in pending:
+            future.cancel()
+
+    return {futures[future][:2]: future.result() for future in futures}
+
+
+class PluginCache:
+    """Caches, across requests, the values returned by the resource
+    plugins which declare a CACHE_TTL (in seconds) - e.g. plugins which
+    query an external database.  Entries are keyed on (plugin, argument,
+    node_id, digest of the node's neighbors), so that a re-cabled node
+    does not get stale values, expire after CACHE_TTL seconds and the least recently used
+    entries are evicted beyond PLUGIN_CACHE_SIZE entries.
+
+    'memoized' counts the plugin calls saved within a request, where each
+    (plugin, argument) is only resolved once (see resolve_resources)."""
+
+    MISSING = object()
+
+    def __init__(self, size=PLUGIN_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = size
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "memoized": 0}
+
+    def __repr__(self):
+        return (
+            f"PluginCache(entries={len(self.entries)}, hits={self.stats['hits']}, "
+            f"misses={self.stats['misses']}, evictions={self.stats['evictions']}, "
+            f"memoized={self.stats['memoized']})"
+        )
+
+    def invalidate(self):
+        """Drops all cached values"""
+
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, key):
+        """Returns a copy of the value cached for key or MISSING if the
+        value is missing or expired"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.entries.pop(key, None)
+                self.stats["misses"] += 1
+                return self.MISSING
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+        return copy.deepcopy(entry[1])
+
+    def set(self, key, value, ttl):
+        value = copy.deepcopy(value)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def memoized(self, count=1):
+        with self.lock:
+            self.stats["memoized"] += count
+
+
+plugin_cache = PluginCache()  # pylint: disable=C0103
+
+
+class ResourcePoolError(Exception):
+    """Base exception class for :py:class:`ResourcePool`"""
+
+
+class ResourcePoolExhausted(ResourcePoolError):
+    """Raised when there is no free resource left in a pool"""
+
+
+def flush_resource_pools():
+    """Writes the journaled allocations of the pools of this process to
+    the pool files (e.g. before exiting)"""
+
+    with RESOURCE_POOLS_LOCK:
+        pools = [pool for (_, pid), pool in RESOURCE_POOLS.items() if pid == os.getpid()]
+    for pool in pools:
+        pool.flush()
+
+
+def get_resource_pool(filename):
+    """Returns the (per process) :py:class:`ResourcePool` for the pool file"""
+
+    filename = os.path.realpath(filename)
+    key = (filename, os.getpid())
+    with RESOURCE_POOLS_LOCK:
+        pool = RESOURCE_POOLS.get(key)
+        if pool is None:
+            pool = RESOURCE_POOLS[key] = ResourcePool(filename)
+        return pool
+
+
+class ResourcePool:
+    """The :py:class:`ResourcePool` allocates the entries of a resource
+    pool file (a YAML mapping of resources to the nodes they are allocated
+    to, or null) to nodes.
+
+    The pool is kept in memory together with the list of free entries (in
+    file order) and the reverse (node -> resource) index, so allocations
+    and lookups do not scan the pool.  Allocations are appended to a
+    journal (.<pool>.journal, next to the pool file) rather than rewriting
+    the whole pool file for each of them: the pool file is rewritten with
+    the allocations journaled meanwhile JOURNAL_COMPACT_DELAY seconds
+    after an allocation, or once the journal holds JOURNAL_COMPACT_ENTRIES
+    allocations.  The pool file thus remains the authoritative list of
+    allocations.  All operations hold the (cross-process) lock of the pool
+    file and first catch up with the changes made by other processes.
+
+    The journal starts with the signature of the pool file it applies to.
+    If the pool file was edited since (e.g. by hand, to free resources),
+    the edit wins: the journaled allocations are only replayed for
+    resources which are still free, for nodes which hold no resource, and
+    the pool is compacted.
+    """
+
+    def __init__(self, filename, node_id="N/A"):
+        self.filename = filename
+        folder, name = os.path.split(filename)
+        self.journal = os.path.join(folder, f".{name}.journal")
+        self.node_id = node_id
+        self.lock = file_lock(filename)
+
+        self.entries = OrderedDict()
+        self.nodes = {}
+        self.free = collections.deque()
+        self.signature = None
+        self.journal_signature = None
+        self.offset = 0
+        self.journaled = 0
+        self.timer = None
+        self.stats = {"allocations": 0, "lookups": 0, "reloads": 0, "compactions": 0}
+
+    def __repr__(self):
+        return (
+            f"ResourcePool(filename={self.filename}, entries={len(self.entries)}, "
+            f"free={len(self.free)}, journaled={self.journaled})"
+        )
+
+    def __len__(self):
+        return len(self.entries)
+
+    def assign(self, key, node_id):
+        self.entries[key] = node_id
+        if node_id is None:
+            self.free.append(key)
+        else:
+            self.nodes.setdefault(node_id, key)
+
+    def load(self):
+        """Loads the pool file and replays the journal"""
+
+        contents = load(self.filename, CONTENT_TYPE_YAML, self.node_id)
+        if not contents or not isinstance(contents, dict):
+            raise ResourcePoolError(contents or "empty pool")
+
+        self.stats["reloads"] += 1
+        self.entries = OrderedDict()
+        self.nodes = {}
+        self.free = collections.deque()
+        for key, value in contents.items():
+            self.assign(key, str(value) if value else None)
+        self.signature = file_signature(self.filename)
+
+        self.offset = 0
+        self.journaled = 0
+        self.journal_signature = None
+        base = self.replay()
+        if base is not None and base != list(self.signature[1:]):
+            log.info("%s: %s changed since it was journaled - compacting", self.node_id, self)
+            self.compact()
+        elif self.journaled:
+            # e.g. left by a process which exited before compacting
+            self.schedule()
+
+    def replay(self):
+        """Applies the journal entries written since the last call and
+        returns the signature of the pool file the journal applies to"""
+
+        base = None
+        try:
+            with open(self.journal, encoding="utf8") as fd:
+                fd.seek(self.offset)
+                for line in iter(fd.readline, ""):
+                    if not line.endswith("\n"):
+                        # partial entry (the writer died): ignored
+                        break
+                    self.offset += len(line.encode("utf8"))
+                    entry = json.loads(line)
+                    if "base" in entry:
+                        base = entry["base"]
+                    elif self.entries.get(entry["key"], "") is None and (
+                        entry["node"] not in self.nodes
+                    ):
+                        self.entries[entry["key"]] = entry["node"]
+                        self.nodes[entry["node"]] = entry["key"]
+                        self.journaled += 1
+            self.journal_signature = file_signature(self.journal)
+        except FileNotFoundError:
+            self.journal_signature = None
+        return base
+
+    def refresh(self):
+        """Catches up with the changes made by other processes"""
+
+        if self.signature is None or file_signature(self.filename) != self.signature:
+            self.load()
+            return
+
+        signature = file_signature(self.journal)
+        if signature != self.journal_signature:
+            if (
+                signature is None
+                or self.journal_signature is None
+                or signature[0] != self.journal_signature[0]
+            ):
+                # the journal was reset by a compaction
+                self.load()
+            else:
+                self.replay()
+
+    def compact(self):
+        """Writes the pool (with the journaled allocations) to the pool file
+        and resets the journal"""
+
+        dump(self.entries, self.filename, CONTENT_TYPE_YAML, self.node_id, lock=True)
+        self.signature = file_signature(self.filename)
+        write_file(self.journal, json.dumps({"base": list(self.signature[1:])}) + "\n")
+        self.journal_signature = file_signature(self.journal)
+        self.offset = self.journal_signature[1]
+        self.journaled = 0
+        self.stats["compactions"] += 1
+
+    def schedule(self):
+        """Compacts the pool in JOURNAL_COMPACT_DELAY seconds, unless
+        already scheduled"""
+
+        if self.timer is None:
+            self.timer = threading.Timer(JOURNAL_COMPACT_DELAY, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Writes the journaled allocations to the pool file"""
+
+        try:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if self.journaled:
+                    self.refresh()
+                if self.journaled:
+                    self.compact()
+        except Exception as err:  # pylint: disable=W0703
+            log.error("%s: unable to compact %s: %s", self.node_id, self, err)
+
+    def append(self, key, node_id):
+        line = json.dumps({"key": key, "node": node_id}) + "\n"
+        fd = os.open(self.journal, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, line.encode("utf8"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.offset += len(line.encode("utf8"))
+        self.journal_signature = file_signature(self.journal)
+        self.journaled += 1
+
+    def lookup(self, node_id):
+        """Returns the resource allocated to node_id, or None"""
+
+        with self.lock:
+            self.refresh()
+            self.stats["lookups"] += 1
+            return self.nodes.get(node_id)
+
+    def allocate(self, node_id):
+        """Returns the resource allocated to node_id, allocating the first
+        free resource if the node holds none
+
+        :raises: ResourcePoolError if there is no free resource
+        """
+
+        node_id = str(node_id)
+        with self.lock:
+            self.refresh()
+            key = self.nodes.get(node_id)
+            if key is not None:
+                log.debug("%s: already allocated resource '%s'", node_id, key)
+                return key
+
+            # entries allocated by other processes are skipped lazily
+            while self.free and self.entries.get(self.free[0], "") is not None:
+                self.free.popleft()
+            if not self.free:
+                raise ResourcePoolExhausted(f"{node_id}: no resource free in {self.filename}")
+
+            if self.journal_signature is None:
+                # start the journal
+                self.compact()
+
+            key = self.free.popleft()
+            self.entries[key] = node_id
+            self.nodes[node_id] = key
+            self.append(key, node_id)
+            self.stats["allocations"] += 1
+
+            if self.journaled >= JOURNAL_COMPACT_ENTRIES:
+                self.compact()
+            else:
+                self.schedule()
+            return key
+
+    def clear(self):
+        """Frees all the resources of the pool"""
+
+        with self.lock:
+            self.refresh()
+            for key in self.entries:
+                self.entries[key] = None
+            self.nodes = {}
+            self.free = collections.deque(self.entries)
+            self.compact()
@@ -32,18 +32,42 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 #
 
-import collections.abc
+import fcntl
+import functools
 import json
 import logging
+import math
 import os
+import secrets
+import stat
 import threading
+import weakref
 from collections import OrderedDict
 
 import yaml
 
+from ztpserver.config import runtime
 from ztpserver.constants import CONTENT_TYPE_JSON, CONTENT_TYPE_OTHER, CONTENT_TYPE_YAML
 
-READ_WRITE_LOCK = {}
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Per-process FileLock objects, keyed on path (see file_lock)
+FILE_LOCKS = weakref.WeakValueDictionary()
+FILE_LOCKS_GUARD = threading.Lock()
+
+# Available (loader, dumper) classes, per YAML backend
+YAML_BACKENDS = {"python": (yaml.SafeLoader, yaml.SafeDumper)}
+if getattr(yaml, "__with_libyaml__", False):
+    YAML_BACKENDS["libyaml"] = (yaml.CSafeLoader, yaml.CSafeDumper)
+
+# Available JSON backends
+JSON_BACKENDS = ["json"]
+if orjson is not None:
+    JSON_BACKENDS.append("orjson")
+
 log = logging.getLogger(__name__)  # pylint: disable=C0103
 
 
@@ -110,10 +134,48 @@ def represent_odict(dump_odict, tag, mapping, flow_style=None):
     return node
 
 
-yaml.SafeDumper.add_representer(
-    OrderedDict,
-    lambda dumper, value: represent_odict(dumper, "tag:yaml.org,2002:map", value),
-)
+for _, dumper_class in YAML_BACKENDS.values():
+    dumper_class.add_representer(
+        OrderedDict,
+        lambda dumper, value: represent_odict(dumper, "tag:yaml.org,2002:map", value),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def select_backend(kind, name):
+    """Returns the backend to use for kind ('yaml' or 'json'), given the
+    configured name: 'auto' selects the fastest available backend (libyaml
+    and orjson respectively)"""
+
+    available = list(YAML_BACKENDS) if kind == "yaml" else JSON_BACKENDS
+    if name == "auto":
+        return available[-1]
+    if name not in available:
+        log.warning("%s backend %s is not available, using %s", kind, name, available[0])
+        return available[0]
+    return name
+
+
+def yaml_backend():
+    """Returns the (loader, dumper) classes of the configured YAML backend"""
+    return YAML_BACKENDS[select_backend("yaml", runtime.serializers.yaml)]
+
+
+def json_backend():
+    """Returns the name of the configured JSON backend"""
+    return select_backend("json", runtime.serializers.json)
+
+
+def has_nonfinite(data):
+    """Returns True if data contains NaN or infinite floats"""
+
+    if isinstance(data, float):
+        return not math.isfinite(data)
+    if isinstance(data, dict):
+        return any(has_nonfinite(x) for x in data.values())
+    if isinstance(data, (list, tuple)):
+        return any(has_nonfinite(x) for x in data)
+    return False
 
 
 # ------------------------------------------------------------------------------
@@ -123,8 +185,9 @@ class YAMLSerializer(BaseSerializer):
     def deserialize(self, data):
         """Deserialize a YAML object and return a dict"""
 
+        loader, _ = yaml_backend()
         try:
-            return yaml.safe_load(data)
+            return yaml.load(data, Loader=loader)
         except yaml.YAMLError as err:
             msg = f"""{self.node_id}: unable to deserialize YAML data:
 {data}
@@ -136,8 +199,9 @@ Error:
     def serialize(self, data):
         """Serialize a dict object and return YAML"""
 
+        _, dumper = yaml_backend()
         try:
-            return yaml.safe_dump(data, default_flow_style=False)
+            return yaml.dump(data, Dumper=dumper, default_flow_style=False)
         except yaml.YAMLError as err:
             msg = f"""{self.node_id}: unable to serialize YAML data:
 {data}
@@ -152,6 +216,12 @@ class JSONSerializer(BaseSerializer):
         """Deserialize a JSON object and return a dict"""
 
         try:
+            if json_backend() == "orjson":
+                try:
+                    return orjson.loads(data)
+                except orjson.JSONDecodeError:
+                    # e.g. NaN, which is accepted by the json module
+                    pass
             return json.loads(data)
         except Exception as err:
             msg = f"""{self.node_id}: unable to deserialize JSON data:
@@ -165,6 +235,18 @@ Error:
         """Serialize a dict object and return JSON"""
 
         try:
+            if json_backend() == "orjson":
+                try:
+                    contents = orjson.dumps(data)
+                    # orjson writes NaN and infinity as null, the json module
+                    # keeps them (as it reads them back)
+                    if b"null" not in contents or not has_nonfinite(data):
+                        return contents.decode("utf8")
+                except TypeError:
+                    # e.g. non-string keys, which are converted by the json module
+                    pass
+                # in the (compact, UTF-8) format of orjson
+                return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
             return json.dumps(data)
         except Exception as err:
             msg = f"""{self.node_id}: unable to serialize JSON data:
@@ -204,18 +286,112 @@ class Serializer:
         """Deserialize the data based on the content_type"""
 
         handler = self.handlers.get(content_type, TextSerializer(self.node_id))
-        data = self._convert_from_unicode(handler.deserialize(data))
-        return data
+        return handler.deserialize(data)
+
+
+class FileLock:
+    """Re-entrant lock which serializes access to a file, across the
+    threads of a process (RLock) and across processes (flock on a
+    sidecar .<name>.lock file in the same folder, which is never
+    removed).  If the sidecar file cannot be created, only threads are
+    serialized."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        folder, name = os.path.split(file_path)
+        self.lock_path = os.path.join(folder, f".{name}.lock")
+        self.lock = threading.RLock()
+        self.count = 0
+        self.fd = None
+
+    def __repr__(self):
+        return f"FileLock(file_path={self.file_path}, count={self.count})"
+
+    def acquire(self):
+        self.lock.acquire()
+        if self.count == 0:
+            try:
+                self.fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError as err:
+                log.debug("Unable to lock %s across processes: %s", self.file_path, err)
+            else:
+                try:
+                    fcntl.flock(self.fd, fcntl.LOCK_EX)
+                except BaseException:
+                    os.close(self.fd)
+                    self.fd = None
+                    self.lock.release()
+                    raise
+        self.count += 1
+
+    def release(self):
+        self.count -= 1
+        if self.count == 0 and self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def file_lock(file_path):
+    """Returns the lock which serializes access to file_path
+
+    The lock is re-entrant, so callers which need to perform a
+    read-modify-write cycle can hold it around calls to :py:func:`load`
+    and :py:func:`dump` with lock=True.  Locks are only kept for as long
+    as they are referenced.
+    """
+
+    file_path = os.path.realpath(file_path)
+    with FILE_LOCKS_GUARD:
+        lock = FILE_LOCKS.get(file_path)
+        if lock is None:
+            lock = FILE_LOCKS[file_path] = FileLock(file_path)
+        return lock
 
-    @staticmethod
-    def _convert_from_unicode(data):
-        if isinstance(data, str):
-            return str(data)
-        if isinstance(data, collections.abc.Mapping):
-            return dict([Serializer._convert_from_unicode(x) for x in data.items()])
-        if isinstance(data, collections.abc.Iterable):
-            return type(data)([Serializer._convert_from_unicode(x) for x in data])
-        return data
+
+def write_file(file_path, data):
+    """Replaces the contents of file_path with data, atomically: readers
+    see either the previous or the new contents, never a partial file
+
+    The data is written to a temporary file in the same folder, flushed
+    to disk and renamed over file_path.  The permissions of an existing
+    file are kept (new files are created with 0754, minus the umask).
+    """
+
+    file_path = os.path.realpath(file_path)
+    folder, name = os.path.split(file_path)
+    while True:
+        temp_path = os.path.join(folder, f".{name}.{secrets.token_hex(4)}.tmp")
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o754)
+            break
+        except FileExistsError:
+            continue
+
+    try:
+        with os.fdopen(fd, "w", encoding="utf8") as fhandler:
+            fhandler.write(data)
+            fhandler.flush()
+            os.fsync(fhandler.fileno())
+        try:
+            os.chmod(temp_path, stat.S_IMODE(os.stat(file_path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
 
 
 def loads(data, content_type, node_id):
@@ -226,12 +402,9 @@ def loads(data, content_type, node_id):
 def load(file_path, content_type, node_id="N/A", lock=False):
     log.debug("%s: reading %s...", node_id, file_path)
 
-    if lock and file_path not in READ_WRITE_LOCK:
-        READ_WRITE_LOCK[file_path] = threading.Lock()
-
     try:
         if lock:
-            with READ_WRITE_LOCK[file_path]:
+            with file_lock(file_path):
                 with open(file_path, encoding="utf8") as fhandler:
                     data = fhandler.read()
         else:
@@ -258,22 +431,13 @@ def dumps(data, content_type, node_id):
 def dump(data, file_path, content_type, node_id="N/A", lock=False):
     log.debug("%s: writing %s...", node_id, file_path)
 
-    if lock and file_path not in READ_WRITE_LOCK:
-        READ_WRITE_LOCK[file_path] = threading.Lock()
-
     try:
+        contents = dumps(data, content_type, node_id)
         if lock:
-            with READ_WRITE_LOCK[file_path]:
-                with os.fdopen(
-                    os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o754),
-                    "w",
-                ) as fhandler:
-                    fhandler.write(dumps(data, content_type, node_id))
+            with file_lock(file_path):
+                write_file(file_path, contents)
         else:
-            with os.fdopen(
-                os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o754), "w"
-            ) as fhandler:
-                fhandler.write(dumps(data, content_type, node_id))
+            write_file(file_path, contents)
     except OSError as err:
         log.error("%s: failed to write file to %s (%s)", node_id, file_path, err)
         raise SerializerError(f"{node_id}: failed to write file to {file_path} ({err})") from err
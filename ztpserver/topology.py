@@ -31,27 +31,45 @@
 #
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 #
+import functools
+import gc
+import hashlib
 import logging
 import os
+import pickle
 import re
 import string
+import tempfile
+import threading
 from collections import OrderedDict, namedtuple
 from collections.abc import Mapping
 
 from ztpserver.config import runtime
 from ztpserver.constants import CONTENT_TYPE_YAML
-from ztpserver.resources import run_plugin
+from ztpserver.repository import STATE_FOLDER
+from ztpserver.resources import plugin_cache, run_plugin, run_plugins
 from ztpserver.serializers import SerializerError, load
-from ztpserver.utils import expand_range, parse_interface, url_path_join
+from ztpserver.utils import expand_range, file_signature, parse_interface, url_path_join
 from ztpserver.validators import validate_neighbordb, validate_pattern
 
 ANY_DEVICE_PARSER_RE = re.compile(r":(?=[any])")
 NONE_DEVICE_PARSER_RE = re.compile(r":(?=[none])")
+# Node attribute holding the resources resolved ahead of time by
+# 'ztps --preallocate', keyed on resource function (e.g. allocate('pool'))
+PINNED_RESOURCES = "pinned_resources"
+
 FUNC_RE = re.compile(r"(?P<function>\w+)(?=\(\S+\))\([\'|\"](?P<arg>.+?)[\'|\"]\)")
 
+REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
+
 ALL_CHARS = {chr(c) for c in range(256)}
 NON_HEX_CHARS = ALL_CHARS - set(string.hexdigits)
 
+# Compiled neighbordb snapshots (ztps --compile-neighbordb) are kept in
+# <data_root>/.ztps/<neighbordb filename>.snapshot
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SUFFIX = ".snapshot"
+
 log = logging.getLogger(__name__)
 
 Neighbor = namedtuple("Neighbor", ["device", "interface"])
@@ -65,6 +83,97 @@ def neighbordb_path():
     return os.path.join(filepath, filename)
 
 
+def snapshot_path():
+    """Returns the path of the compiled neighbordb snapshot"""
+
+    filename = f"{runtime.neighbordb.filename}{SNAPSHOT_SUFFIX}"
+    return os.path.join(runtime.default.data_root, STATE_FOLDER, filename)
+
+
+@functools.lru_cache(maxsize=1)
+def snapshot_code():
+    """Returns the digest of this module: snapshots are only loaded by the
+    code which wrote them"""
+
+    with open(__file__, "rb") as fd:
+        return hashlib.sha1(fd.read()).hexdigest()
+
+
+def snapshot_header(signature):
+    """Returns the header of the snapshot of the neighbordb file with the
+    given signature
+
+    The snapshot is only valid for the same version of the neighbordb file
+    (size and mtime - the inode is left out, so that copies made with
+    'cp -p' or 'rsync -t' still match) and of this module.  The node
+    identifier is included since neighbordb is validated against it.
+    """
+
+    return {
+        "version": SNAPSHOT_VERSION,
+        "code": snapshot_code(),
+        "identifier": runtime.default.identifier,
+        "source": list(signature[1:]),
+    }
+
+
+def write_snapshot(neighbordb, signature):
+    """Saves neighbordb, compiled from the neighbordb file with the given
+    signature, to the snapshot file and returns its path
+
+    :raises: OSError
+    """
+
+    path = snapshot_path()
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=folder, prefix=f".{os.path.basename(path)}.", delete=False
+    ) as fd:
+        try:
+            pickle.dump(snapshot_header(signature), fd, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(neighbordb, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            os.remove(fd.name)
+            raise
+    os.replace(fd.name, path)
+    return path
+
+
+def load_snapshot(node_id, signature):
+    """Returns the Neighbordb object saved in the snapshot file, or None
+    if there is no snapshot of the neighbordb file with the given
+    signature (e.g. neighbordb changed since the snapshot was written)"""
+
+    path = snapshot_path()
+    try:
+        with open(path, "rb") as fd:
+            if pickle.load(fd) != snapshot_header(signature):
+                log.info("%s: ignoring outdated neighbordb snapshot %s", node_id, path)
+                return None
+
+            # Unpickling creates a lot of objects, none of which is garbage
+            enabled = gc.isenabled()
+            gc.disable()
+            try:
+                neighbordb = pickle.load(fd)
+            finally:
+                if enabled:
+                    gc.enable()
+    except FileNotFoundError:
+        return None
+    except Exception as err:  # pylint: disable=W0703
+        log.warning("%s: ignoring neighbordb snapshot %s: %s", node_id, path, err)
+        return None
+
+    if not isinstance(neighbordb, Neighbordb):
+        log.warning("%s: ignoring neighbordb snapshot %s: invalid contents", node_id, path)
+        return None
+
+    log.info("%s: loaded neighbordb snapshot: %s", node_id, path)
+    return neighbordb
+
+
 def load_file(filename, content_type, node_id):
     """Returns the contents of a file specified by filename.
 
@@ -82,6 +191,16 @@ def load_file(filename, content_type, node_id):
 
 
 def load_neighbordb(node_id, contents=None):
+    """Returns the Neighbordb object built from contents or, if no
+    contents are specified, the (cached) Neighbordb object built from
+    the neighbordb file"""
+
+    if contents:
+        return compile_neighbordb(node_id, contents)
+    return neighbordb_cache.get(node_id)
+
+
+def compile_neighbordb(node_id, contents=None):
     try:
         if not contents:
             log.info("%s: loading neighbordb file: %s", node_id, neighbordb_path())
@@ -120,6 +239,75 @@ def load_neighbordb(node_id, contents=None):
         return None
 
 
+class NeighbordbCache:
+    """Per-process cache of the Neighbordb object built from the
+    neighbordb file
+
+    The cached object is rebuilt when the (inode, size, mtime_ns)
+    signature of the file changes or after :py:meth:`invalidate` is
+    called, from the compiled snapshot of the file if there is a current
+    one (see :py:func:`load_snapshot`).  If a rebuild fails, the last good copy keeps being served
+    until the file changes again.  The cache is bypassed if the file
+    cannot be accessed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key = None
+        self.failed_key = None
+        self.neighbordb = None
+        self.stats = {"hits": 0, "rebuilds": 0, "errors": 0}
+
+    def __repr__(self):
+        return (
+            f"NeighbordbCache(hits={self.stats['hits']}, rebuilds={self.stats['rebuilds']}, "
+            f"errors={self.stats['errors']})"
+        )
+
+    def invalidate(self):
+        """Forces the next lookup to reload neighbordb"""
+
+        with self.lock:
+            self.key = None
+            self.failed_key = None
+
+    def get(self, node_id):
+        path = neighbordb_path()
+        signature = file_signature(path)
+        if signature is None:
+            return compile_neighbordb(node_id)
+
+        key = (path, signature)
+        with self.lock:
+            if key in (self.key, self.failed_key):
+                self.stats["hits"] += 1
+                return self.neighbordb
+
+            neighbordb = load_snapshot(node_id, signature)
+            if neighbordb is None:
+                neighbordb = compile_neighbordb(node_id)
+            if neighbordb is None:
+                self.stats["errors"] += 1
+                self.failed_key = key
+                if self.neighbordb is not None:
+                    log.error(
+                        "%s: failed to reload neighbordb - using last good copy (%s)",
+                        node_id,
+                        self,
+                    )
+                return self.neighbordb
+
+            self.stats["rebuilds"] += 1
+            self.key = key
+            self.failed_key = None
+            self.neighbordb = neighbordb
+            log.info("%s: neighbordb (re)loaded (%s)", node_id, self)
+            return neighbordb
+
+
+neighbordb_cache = NeighbordbCache()  # pylint: disable=C0103
+
+
 def load_pattern(pattern, content_type=CONTENT_TYPE_YAML, node_id=None):
     """Returns an instance of Pattern"""
     try:
@@ -162,29 +350,75 @@ def create_node(nodeattrs):
     return None
 
 
-def load_resources(attributes, node, node_id):
-    log.debug("%s: computing resources (attr=%s)", node_id, attributes)
+def map_resources(attributes, resolve):
+    """Returns a copy of attributes in which the value of each resource
+    function, e.g. allocate('pool'), is replaced by
+    resolve(function, arg)"""
+
+    def resolve_value(value):
+        match = FUNC_RE.match(str(value))
+        if match:
+            return resolve(match.group("function"), match.group("arg"))
+        return value
 
     _attributes = {}
     for key, value in attributes.items():
         if hasattr(value, "items"):
-            value = load_resources(value, node, node_id)
+            value = map_resources(value, resolve)
         elif not isinstance(value, str) and hasattr(value, "__iter__"):
-            _value = []
-            for item in value:
-                match = FUNC_RE.match(item)
-                if match:
-                    plugin = match.group("function")
-                    _value.append(run_plugin(plugin, node_id, match.group("arg"), node))
-                else:
-                    _value.append(item)
-            value = _value
+            value = [resolve_value(item) for item in value]
         else:
-            match = FUNC_RE.match(str(value))
-            if match:
-                plugin = match.group("function")
-                value = run_plugin(plugin, node_id, match.group("arg"), node)
+            value = resolve_value(value)
         _attributes[key] = value
+    return _attributes
+
+
+def resource_key(function, arg):
+    """Returns the key of a resource function in the pinned resources"""
+
+    return f"{function}('{arg}')"
+
+
+def pin_resources(attributes, pinned):
+    """Returns a copy of attributes in which the resource functions which
+    were resolved ahead of time (see PINNED_RESOURCES) are replaced by
+    their values"""
+
+    def resolve(function, arg):
+        key = resource_key(function, arg)
+        return pinned.get(key, key)
+
+    return map_resources(attributes, resolve)
+
+
+def resolve_resources(attributes, node, node_id):
+    """Runs the plugins of the resource functions in attributes (a list of
+    attributes, e.g. those of all the actions of a definition) and returns
+    their values keyed on (plugin, argument).  Each (plugin, argument) is
+    run once and the plugins run concurrently (see run_plugins)."""
+
+    calls = []
+    for attrs in attributes:
+        map_resources(attrs, lambda function, arg: calls.append((function, arg)))
+
+    unique = list(dict.fromkeys(calls))
+    plugin_cache.memoized(len(calls) - len(unique))
+    if not unique:
+        return {}
+    return run_plugins(unique, node_id, node, run=run_plugin)
+
+
+def load_resources(attributes, node, node_id, memo=None):
+    """Returns a copy of attributes in which the resource functions are
+    replaced by their values, from memo (see resolve_resources) if
+    provided, otherwise by running the plugins"""
+
+    log.debug("%s: computing resources (attr=%s)", node_id, attributes)
+
+    if memo is None:
+        memo = resolve_resources([attributes], node, node_id)
+
+    _attributes = map_resources(attributes, lambda function, arg: memo[(function, arg)])
     log.debug("%s: resources: %s", node_id, _attributes)
     return _attributes
 
@@ -249,9 +483,17 @@ class ExcludesFunction(Function):
 
 
 class RegexFunction(Function):
+    def __init__(self, value):
+        super().__init__(value)
+        try:
+            self.regex = re.compile(value)
+        except (re.error, TypeError):
+            # Defer the error to match time
+            self.regex = None
+
     def match(self, arg):
-        match = re.match(self.value, arg)
-        return match is not None
+        regex = self.regex or re.compile(self.value)
+        return regex.match(arg) is not None
 
 
 class ExactFunction(Function):
@@ -337,6 +579,166 @@ class Node:
         return result
 
 
+def regex_prefix(regex):
+    """Returns a string which is a prefix of every string matched by
+    re.match(regex, ...) - an empty string if no such prefix can be
+    determined"""
+
+    if "|" in regex or "(?" in regex:
+        return ""
+
+    prefix = []
+    for char in regex.lstrip("^"):
+        if char in REGEX_SPECIAL_CHARS:
+            # the quantifier applies to the previous character
+            if char in "*?{" and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return "".join(prefix)
+
+
+class PatternIndex:
+    """Index of the global patterns of a neighbordb, used to select the
+    patterns which may match a node
+
+    A pattern is only left out if it cannot possibly match the node,
+    which is the case if:
+
+        - the node's model does not start with the literal prefix of
+          the pattern's model regex
+        - the node has no neighbors on an interface which is required
+          by a positive constraint of the pattern
+        - no interface of the node has, as its first neighbor, a
+          device (or device and remote interface) required by an exact
+          positive constraint of the pattern
+
+    The selected patterns are returned in the same order as in
+    neighbordb.  Patterns which cannot be evaluated safely (e.g.
+    invalid regular expressions) are always selected.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.requirements = []
+        self.buckets = {}
+        self.prefix_lengths = set()
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def pattern_requirements(pattern):
+        """Returns (model_prefix, interfaces, devices, neighbors) required
+        for pattern to match a node, or None if the pattern must always
+        be evaluated"""
+
+        model = pattern.model
+        prefix = ""
+        if model:
+            if not isinstance(model, str):
+                return None
+            try:
+                re.compile(model)
+            except re.error:
+                return None
+            prefix = regex_prefix(model)
+
+        interfaces = set()
+        devices = set()
+        neighbors = set()
+        for entry in pattern.interfaces:
+            for intf_pattern in entry["patterns"]:
+                for function in (intf_pattern.remote_device_re, intf_pattern.remote_interface_re):
+                    if isinstance(function, RegexFunction):
+                        try:
+                            re.compile(function.value)
+                        except (re.error, TypeError):
+                            return None
+
+                if not intf_pattern.is_positive_constraint():
+                    continue
+                if intf_pattern.interface not in ("any", "none"):
+                    interfaces.add(intf_pattern.interface)
+                if intf_pattern.remote_device not in ("any", "none") and isinstance(
+                    intf_pattern.remote_device_re, ExactFunction
+                ):
+                    device = intf_pattern.remote_device_re.value
+                    devices.add(device)
+                    if intf_pattern.remote_interface not in ("any", "none") and isinstance(
+                        intf_pattern.remote_interface_re, ExactFunction
+                    ):
+                        neighbors.add((device, intf_pattern.remote_interface_re.value))
+
+        return (prefix, frozenset(interfaces), frozenset(devices), frozenset(neighbors))
+
+    def add(self, pattern):
+        requirements = self.pattern_requirements(pattern)
+
+        if requirements is None:
+            key = None
+        else:
+            prefix, interfaces, devices, neighbors = requirements
+            if neighbors:
+                key = ("neighbor", min(neighbors))
+            elif devices:
+                key = ("device", min(devices))
+            elif interfaces:
+                key = ("interface", min(interfaces))
+            elif prefix:
+                key = ("model", prefix)
+                self.prefix_lengths.add(len(prefix))
+            else:
+                key = None
+
+        self.buckets.setdefault(key, []).append(self.size)
+        self.requirements.append((pattern, requirements))
+        self.size += 1
+
+    def select(self, node):
+        """Returns the patterns which may match node"""
+
+        model = node.model
+        if not isinstance(model, str):
+            # matching would fail on the model - leave it to the patterns
+            return [pattern for pattern, _ in self.requirements]
+
+        interfaces = set()
+        devices = set()
+        neighbors = set()
+        for interface, peers in node.neighbors.items():
+            interfaces.add(interface)
+            if peers:
+                devices.add(peers[0].device)
+                neighbors.add((peers[0].device, peers[0].interface))
+
+        keys = [None]
+        keys.extend(("neighbor", neighbor) for neighbor in neighbors)
+        keys.extend(("device", device) for device in devices)
+        keys.extend(("interface", interface) for interface in interfaces)
+        keys.extend(("model", model[:length]) for length in self.prefix_lengths)
+
+        candidates = []
+        for key in keys:
+            candidates.extend(self.buckets.get(key, []))
+        candidates.sort()
+
+        result = []
+        for index in candidates:
+            pattern, requirements = self.requirements[index]
+            if requirements is not None:
+                prefix, required_interfaces, required_devices, required_neighbors = requirements
+                if (
+                    not model.startswith(prefix)
+                    or not required_interfaces <= interfaces
+                    or not required_devices <= devices
+                    or not required_neighbors <= neighbors
+                ):
+                    continue
+            result.append(pattern)
+        return result
+
+
 class Neighbordb:
     RESERVED_VARIABLES = ["any", "none"]
 
@@ -345,6 +747,7 @@ class Neighbordb:
 
         self.variables = {}
         self.patterns = {"globals": [], "nodes": {}}
+        self.index = PatternIndex()
 
     def __repr__(self):
         return (
@@ -412,6 +815,7 @@ class Neighbordb:
                     )
             else:
                 self.patterns["globals"].append(pattern)
+                self.index.add(pattern)
         except KeyError as err:
             log.error(
                 "%s: failed to add pattern '%s' because of missing key (%s)",
@@ -466,24 +870,40 @@ class Neighbordb:
             result += [pattern]
 
         elif self.patterns["globals"]:
-            log.debug("%s: global patterns eligible in neighbordb", identifier)
-            result += self.patterns["globals"]
+            result += self.index.select(node)
+            log.debug(
+                "%s: %d/%d global patterns eligible in neighbordb",
+                identifier,
+                len(result),
+                len(self.patterns["globals"]),
+            )
         else:
             log.debug("%s: no patterns eligible in neighbordb", identifier)
 
         return result
 
-    def match_node(self, node):
+    def iter_matches(self, node):
+        """Yields the patterns matching node, in neighbordb order.  Each
+        pattern is only evaluated when the next match is requested."""
+
         identifier = node.identifier()
-        result = []
         for pattern in self.find_patterns(node):
             log.debug("%s: attempting to match pattern %s", identifier, pattern.name)
             if pattern.match_node(node):
                 log.debug("%s: pattern %s matched", identifier, pattern.name)
-                result.append(pattern)
+                yield pattern
             else:
                 log.debug("%s: pattern %s match failed", identifier, pattern.name)
-        return result
+
+    def first_match(self, node):
+        """Returns the first pattern matching node or None"""
+
+        return next(self.iter_matches(node), None)
+
+    def match_node(self, node):
+        """Returns the list of all patterns matching node"""
+
+        return list(self.iter_matches(node))
 
 
 class Pattern:
@@ -507,8 +927,23 @@ class Pattern:
         self.variables = variables or {}
 
         self.model = model
+        try:
+            self.model_re = re.compile(model) if model else None
+        except (re.error, TypeError):
+            # Defer the error to match time
+            self.model_re = None
 
         self.interfaces = []
+
+        # Interface patterns in definition order and, for each interface
+        # name, the (ordered) positions of the interface patterns which
+        # can apply to it: the 'any'/'none' wildcards plus those naming
+        # the interface explicitly. Any other interface pattern would not
+        # be relevant to the interface (see InterfacePattern.MATCH_RULES).
+        self.interface_patterns = []
+        self.interface_dispatch = {}
+        self.wildcard_patterns = []
+
         if interfaces:
             self.add_interfaces(interfaces)
 
@@ -604,6 +1039,8 @@ class Pattern:
                         )
                         patterns.append(pattern)
                 self.interfaces.append({"metadata": metadata, "patterns": patterns})
+                for pattern in patterns:
+                    self.dispatch_interface_pattern(pattern)
         except InterfacePatternError as exc:
             log.error(
                 "%s: pattern '%s' - failed to add interface %s",
@@ -615,6 +1052,19 @@ class Pattern:
                 f"{self.node_id}: pattern '{self.name}' - failed to add interface {interface}"
             ) from exc
 
+    def dispatch_interface_pattern(self, pattern):
+        index = len(self.interface_patterns)
+        self.interface_patterns.append(pattern)
+
+        if pattern.interface in ("any", "none"):
+            self.wildcard_patterns.append(index)
+            for indexes in self.interface_dispatch.values():
+                indexes.append(index)
+        else:
+            self.interface_dispatch.setdefault(
+                pattern.interface, list(self.wildcard_patterns)
+            ).append(index)
+
     def add_interfaces(self, interfaces):
         try:
             for interface in interfaces:
@@ -645,13 +1095,13 @@ class Pattern:
         # match.
 
         # Match the model first
-        if self.model and not re.match(self.model, node.model):
-            return False
+        if self.model:
+            model_re = self.model_re or re.compile(self.model)
+            if not model_re.match(node.model):
+                return False
 
-        patterns = []
-        for entry in self.interfaces:
-            for pattern in entry["patterns"]:
-                patterns.append(pattern)
+        patterns = self.interface_patterns
+        matched = set()
 
         for interface, neighbors in node.neighbors.items():
             log.debug(
@@ -663,7 +1113,11 @@ class Pattern:
             )
 
             match = False
-            for index, pattern in enumerate(patterns):
+            for index in self.interface_dispatch.get(interface, self.wildcard_patterns):
+                if index in matched:
+                    continue
+
+                pattern = patterns[index]
                 log.debug(
                     "%s: pattern '%s' - checking interface pattern for %s: %s",
                     self.node_id,
@@ -682,7 +1136,7 @@ class Pattern:
                         interface,
                         pattern,
                     )
-                    del patterns[index]
+                    matched.add(index)
                     match = True
                     break
                 if result is False:
@@ -703,8 +1157,8 @@ class Pattern:
                     interface,
                 )
 
-        for pattern in patterns:
-            if pattern.is_positive_constraint():
+        for index, pattern in enumerate(patterns):
+            if index not in matched and pattern.is_positive_constraint():
                 log.debug(
                     "%s: pattern '%s' - interface pattern %s did not match any interface",
                     self.node_id,
@@ -725,6 +1179,41 @@ class InterfacePattern:
         "regex": RegexFunction,
     }
 
+    # (interface, remote device, remote interface) kind -> (result,
+    # check interface, check remote device, check remote interface).
+    # The pattern matches a neighbor - returning result - only if all
+    # of the checks pass; otherwise the neighbor is not relevant to the
+    # pattern (None).
+    MATCH_RULES = {
+        ("any", "any", "any"): (True, False, False, False),
+        ("any", "any", "none"): (False, False, False, False),
+        ("any", "any", "value"): (True, False, False, True),
+        ("any", "none", "any"): (False, False, False, False),
+        ("any", "none", "none"): (False, False, False, False),
+        ("any", "none", "value"): (False, False, False, False),
+        ("any", "value", "any"): (True, False, True, False),
+        ("any", "value", "none"): (False, False, True, False),
+        ("any", "value", "value"): (True, False, True, True),
+        ("none", "any", "any"): (False, False, False, False),
+        ("none", "any", "none"): (False, False, False, False),
+        ("none", "any", "value"): (False, False, False, True),
+        ("none", "none", "any"): (False, False, False, False),
+        ("none", "none", "none"): (False, False, False, False),
+        ("none", "none", "value"): (False, False, False, False),
+        ("none", "value", "any"): (False, False, True, False),
+        ("none", "value", "none"): (False, False, True, False),
+        ("none", "value", "value"): (False, False, True, True),
+        ("value", "any", "any"): (True, True, False, False),
+        ("value", "any", "none"): (False, True, False, False),
+        ("value", "any", "value"): (True, True, False, True),
+        ("value", "none", "any"): (False, True, False, False),
+        ("value", "none", "none"): (False, True, False, False),
+        ("value", "none", "value"): (False, True, False, True),
+        ("value", "value", "any"): (True, True, True, False),
+        ("value", "value", "none"): (False, True, True, False),
+        ("value", "value", "value"): (True, True, True, True),
+    }
+
     def __init__(self, interface, remote_device, remote_interface, node_id):
         match = re.match(r"^[ehnrtE]+(\d.*)$", interface)
         if match:
@@ -738,6 +1227,7 @@ class InterfacePattern:
 
         self.remote_device_re = self.compile(remote_device)
         self.remote_interface_re = self.compile(remote_interface)
+        self.rule = self.match_rule()
 
     def __repr__(self):
         return (
@@ -748,6 +1238,14 @@ class InterfacePattern:
     def refresh(self):
         self.remote_device_re = self.compile(self.remote_device)
         self.remote_interface_re = self.compile(self.remote_interface)
+        self.rule = self.match_rule()
+
+    def match_rule(self):
+        kinds = tuple(
+            value if value in ("any", "none") else "value"
+            for value in (self.interface, self.remote_device, self.remote_interface)
+        )
+        return self.MATCH_RULES[kinds]
 
     def compile(self, value):
         if value in self.KEYWORDS:
@@ -777,7 +1275,6 @@ class InterfacePattern:
         return None
 
     def match_neighbor(self, interface, neighbor):
-        # pylint: disable=R0911,R0912
         log.debug(
             "%s: attempting to match %s(%s) against interface pattern %r",
             self.node_id,
@@ -786,107 +1283,14 @@ class InterfacePattern:
             self,
         )
 
-        if self.interface == "any":
-            if self.remote_device == "any":
-                if self.remote_interface == "any":
-                    return True
-                if self.remote_interface == "none":
-                    # bogus
-                    return False
-                if self.match_remote_interface(neighbor.interface):
-                    return True
-            elif self.remote_device == "none":
-                if self.remote_interface == "any":
-                    # bogus
-                    return False
-                if self.remote_interface == "none":
-                    # bogus
-                    return False
-                return False
-            else:
-                if self.remote_interface == "any":
-                    if self.match_remote_device(neighbor.device):
-                        return True
-                if self.remote_interface == "none":
-                    if self.match_remote_device(neighbor.device):
-                        return False
-                if self.match_remote_device(neighbor.device) and self.match_remote_interface(
-                    neighbor.interface
-                ):
-                    return True
-
-        elif self.interface == "none":
-            if self.remote_device == "any":
-                if self.remote_interface == "any":
-                    # bogus
-                    return False
-                if self.remote_interface == "none":
-                    # bogus
-                    return False
-                if self.match_remote_interface(neighbor.interface):
-                    return False
-            elif self.remote_device == "none":
-                if self.remote_interface == "any":
-                    # bogus
-                    return False
-                if self.remote_interface == "none":
-                    # no LLDP capable neighbors
-                    return False
-
-                # bogus
-                return False
-            else:
-                if self.remote_interface == "any":
-                    if self.match_remote_device(neighbor.device):
-                        return False
-                if self.remote_interface == "none":
-                    if self.match_remote_device(neighbor.device):
-                        return False
-                else:
-                    if self.match_remote_device(neighbor.device) and self.match_remote_interface(
-                        neighbor.interface
-                    ):
-                        return False
-        else:
-            if self.remote_device == "any":
-                if self.remote_interface == "any":
-                    if self.match_interface(interface):
-                        return True
-                elif self.remote_interface == "none":
-                    if self.match_interface(interface):
-                        return False
-                else:
-                    if self.match_interface(interface) and self.match_remote_interface(
-                        neighbor.interface
-                    ):
-                        return True
-            elif self.remote_device == "none":
-                if self.remote_interface == "any":
-                    if self.match_interface(interface):
-                        return False
-                elif self.remote_interface == "none":
-                    if self.match_interface(interface):
-                        return False
-                else:
-                    if self.match_interface(interface) and self.match_remote_interface(
-                        neighbor.interface
-                    ):
-                        return False
-            elif self.match_interface(interface):
-                if self.remote_interface == "any":
-                    if self.match_remote_device(neighbor.device):
-                        return True
-                elif self.remote_interface == "none":
-                    if self.match_remote_device(neighbor.device):
-                        return False
-                else:
-                    if (
-                        self.match_interface(interface)
-                        and self.match_remote_device(neighbor.device)
-                        and self.match_remote_interface(neighbor.interface)
-                    ):
-                        return True
-        return None
+        result, check_interface, check_device, check_port = self.rule
+        if check_interface and not self.match_interface(interface):
+            return None
+        if check_device and not self.match_remote_device(neighbor.device):
+            return None
+        if check_port and not self.match_remote_interface(neighbor.interface):
+            return None
+        return result
 
     def match_interface(self, interface):
         if self.interface == "any":
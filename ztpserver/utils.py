@@ -268,7 +268,30 @@ def get_first_token(sequence):
 
 
 def all_files(path):
+    """Returns the files below path, except hidden files (e.g. the .<name>.lock
+    files used by :py:func:`ztpserver.serializers.file_lock`)"""
+
     result = []
     for top, _, files in os.walk(path):
-        result += [os.path.join(top, f) for f in files]
+        result += [os.path.join(top, f) for f in files if not f.startswith(".")]
     return result
+
+
+def file_signature(path):
+    """Returns a tuple (inode, size, mtime_ns) identifying the current
+    version of the file at path, or None if the file cannot be accessed"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def file_etag(path):
+    """Returns a strong ETag for the current version of the file at path
+    (derived from its signature, so computing it does not read the file),
+    or None if the file cannot be accessed"""
+    signature = file_signature(path)
+    if signature is None:
+        return None
+    return "-".join(f"{x:x}" for x in signature)
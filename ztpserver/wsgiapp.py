@@ -32,12 +32,13 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 # pylint: disable=W0613,W0622,W0614
 #
+import itertools
 import logging
+import re
 
 import webob
 import webob.dec
 import webob.exc
-from routes.middleware import RoutesMiddleware
 
 from ztpserver.constants import CONTENT_TYPE_HTML, HTTP_STATUS_OK
 from ztpserver.serializers import dumps
@@ -70,6 +71,11 @@ class WSGIController:
     def response(self, **kwargs):
         return webob.Response(**kwargs)
 
+    def encode(self, request, response):
+        """Returns the response to request, possibly encoded (e.g.
+        compressed) - the default is to return the response as is"""
+        return response
+
     @webob.dec.wsgify
     def __call__(self, request):
         action = request.urlvars["action"]
@@ -94,7 +100,7 @@ class WSGIController:
             result.setdefault("content_type", CONTENT_TYPE_HTML)
             result.setdefault("charset", "UTF-8")
 
-            result = self.response(**result)
+            result = self.encode(request, self.response(**result))
 
         elif not isinstance(result, webob.Response) and not isinstance(
             result, webob.static.FileApp
@@ -104,22 +110,106 @@ class WSGIController:
         return result
 
 
+class RouteDispatcher:
+    """Matches requests against the routes of a :py:class:`routes.Mapper`
+
+    The routes are grouped, once, by the first segment of their path, so
+    that each request is only matched against the routes which can
+    possibly match it (in the order in which they were connected).
+    """
+
+    def __init__(self, mapper):
+        mapper.create_regs()
+
+        self.routes = []
+        for route in mapper.matchlist:
+            if route.static:
+                continue
+
+            methods = (route.conditions or {}).get("method")
+            if isinstance(methods, str):
+                methods = [methods]
+
+            prefix = "".join(itertools.takewhile(lambda p: isinstance(p, str), route.routelist))
+            segment, sep, _ = prefix.lstrip("/").partition("/")
+
+            # exact: the first segment of the route is entirely static
+            exact = bool(sep) or prefix == route.routepath
+            self.routes.append((route, frozenset(methods) if methods else None, segment, exact))
+
+        self.table = {}
+        for segment in {entry[2] for entry in self.routes if entry[3]}:
+            self.table[segment] = self.candidates(segment)
+
+    def candidates(self, segment):
+        result = []
+        for route, methods, prefix, exact in self.routes:
+            if segment == prefix if exact else segment.startswith(prefix):
+                result.append((route, methods))
+        return result
+
+    def match(self, environ):
+        """Returns a tuple (match, route) for the request, or (None, None)"""
+
+        url = environ["PATH_INFO"]
+        method = environ["REQUEST_METHOD"]
+
+        segment = url[1:].split("/", 1)[0]
+        candidates = self.table.get(segment)
+        if candidates is None:
+            candidates = self.candidates(segment)
+
+        for route, methods in candidates:
+            if methods is not None and method not in methods:
+                continue
+            match = route.match(url, environ)
+            if isinstance(match, dict) or match:
+                return match, route
+        return None, None
+
+
 class WSGIRouter:
     def __init__(self, mapper):
         self.map = mapper
-        self.router = RoutesMiddleware(self.route, self.map)
+        self.dispatcher = RouteDispatcher(mapper)
+        self.controllers = {}
 
-    @webob.dec.wsgify
-    def __call__(self, request):
-        return self.router
+    def __call__(self, environ, start_response):
+        match, route = self.dispatcher.match(environ)
 
-    @webob.dec.wsgify
-    def route(self, request):
+        environ["wsgiorg.routing_args"] = ((), match or {})
+        environ["routes.route"] = route
+
+        # routes with a path_info variable (e.g. /meta) hand the rest of
+        # the path over to the controller
+        if match and "path_info" in match:
+            oldpath = environ["PATH_INFO"]
+            newpath = match.get("path_info") or ""
+            environ["PATH_INFO"] = newpath if newpath.startswith("/") else "/" + newpath
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + re.sub(
+                r"^(.*?)/" + re.escape(newpath) + "$", r"\1", oldpath
+            )
+
+        return self.route(environ, start_response)
+
+    def controller(self, controller):
+        """Returns the (per router) instance of the controller class"""
+
+        instance = self.controllers.get(controller)
+        if instance is None:
+            instance = self.controllers.setdefault(controller, controller())
+        return instance
+
+    def route(self, environ, start_response):
         """Routes the incoming request to the appropriate controller"""
 
-        if "controller" not in request.urlvars:
-            log.debug("WSGIRouter: missing controller (request=%s)", request)
-            return webob.exc.HTTPNotFound()
+        urlvars = environ["wsgiorg.routing_args"][1]
+        if "controller" not in urlvars:
+            log.debug(
+                "WSGIRouter: missing controller (request=%s %s)",
+                environ["REQUEST_METHOD"],
+                environ["PATH_INFO"],
+            )
+            return webob.exc.HTTPNotFound()(environ, start_response)
 
-        controller = request.urlvars["controller"]
-        return controller()
+        return self.controller(urlvars["controller"])(environ, start_response)